@@ -0,0 +1,80 @@
+"""
+Microbenchmark comparing AllClients.broadcast with calling safe_write_message for every client.
+
+Streams are replaced with a stub which discards data so only the cost of encoding, framing and handing
+bytes to the stream is measured.
+
+Usage: python benchmarks/broadcast.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_websockets.tests.settings')
+
+import django  # noqa
+django.setup()
+
+from tornado.httputil import HTTPHeaders, HTTPServerRequest  # noqa
+from tornado.web import Application  # noqa
+
+from django_websockets.clients import AllClients  # noqa
+from django_websockets.handlers import AnonSocketHandler  # noqa
+
+MESSAGE = {'type': 'chat', 'user': 'testing', 'room': 'lobby', 'text': 'hello everyone ' * 8}
+
+
+class NullConnection(object):
+    def set_close_callback(self, callback):
+        pass
+
+
+class NullStream(object):
+    _write_buffer_size = 0
+
+    def write(self, data, callback=None):
+        pass
+
+    def closed(self):
+        return False
+
+
+def create_clients(n):
+    app = Application()
+    clients = AllClients()
+    headers = HTTPHeaders({'Sec-WebSocket-Version': '13'})
+    for _ in range(n):
+        request = HTTPServerRequest(method='GET', uri='/ws/', headers=headers, connection=NullConnection())
+        h = AnonSocketHandler(app, request)
+        h.stream = NullStream()
+        h.ws_connection = h.get_websocket_protocol()
+        h.ws_connection.stream = h.stream
+        clients.append(h)
+    return clients
+
+
+def loop_send(clients):
+    for cli in clients:
+        cli.safe_write_message(MESSAGE)
+
+
+def timeit(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    print('%10s %18s %18s %8s' % ('recipients', 'loop (ms)', 'broadcast (ms)', 'speedup'))
+    for n in (1000, 10000):
+        clients = create_clients(n)
+        repeat = 100000 // n
+        loop = timeit(lambda: loop_send(clients), repeat)
+        broadcast = timeit(lambda: clients.broadcast(MESSAGE), repeat)
+        print('%10d %18.3f %18.3f %7.1fx' % (n, loop * 1000, broadcast * 1000, loop / broadcast))
+
+
+if __name__ == '__main__':
+    main()
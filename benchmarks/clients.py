@@ -0,0 +1,54 @@
+"""
+Benchmark connect/disconnect cost of django_websockets.clients.AllClients.
+
+Usage: python benchmarks/clients.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_websockets.tests.settings')
+
+import django  # noqa
+django.setup()
+
+from django_websockets.clients import AllClients  # noqa
+
+
+class FakeHandler(object):
+    def __init__(self, user=None):
+        self.user = user
+
+
+def bench(n):
+    clients = AllClients()
+    handlers = [FakeHandler('user %d' % i if i % 2 else None) for i in range(n)]
+
+    start = time.perf_counter()
+    for h in handlers:
+        clients.append(h)
+    connect = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(1000):
+        clients.status
+    status = time.perf_counter() - start
+
+    # disconnect in connection order, the worst case for the old list based implementation
+    start = time.perf_counter()
+    for h in handlers:
+        clients.remove(h)
+    disconnect = time.perf_counter() - start
+    return connect, disconnect, status
+
+
+def main():
+    print('%8s %16s %16s %16s' % ('clients', 'connect (us)', 'disconnect (us)', 'status (us)'))
+    for n in (10000, 50000, 100000):
+        connect, disconnect, status = bench(n)
+        print('%8d %16.3f %16.3f %16.3f' % (n, connect / n * 1e6, disconnect / n * 1e6, status / 1000 * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Benchmark bytes on the wire, time to compress and zlib memory held per connection for each compression preset
+(see settings.WS_COMPRESSION).
+
+Memory is measured with tracemalloc after each connection has sent and received one message, so it's what each
+idle connection costs: a compressor and decompressor with context takeover, nothing without.
+
+Usage: python benchmarks/compression.py
+"""
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_websockets.tests.settings')
+
+import django  # noqa
+django.setup()
+
+from django_websockets.compression import COMPRESSION_PRESETS, compression_options, negotiate  # noqa
+from django_websockets.protocol import build_frame, OPCODE_TEXT  # noqa
+
+CONNECTIONS = 500
+
+
+def make_messages(count):
+    rnd = random.Random(1)
+    messages = []
+    for i in range(count):
+        shape = i % 3
+        if shape == 0:
+            msg = {'type': 'status', 'users': [{'id': rnd.randint(1, 10000), 'username': 'user%d' % rnd.randint(1, 999),
+                                                'online': rnd.random() > 0.5} for _ in range(20)]}
+        elif shape == 1:
+            msg = {'type': 'chat', 'room': 'lobby', 'user': 'testing', 'text': 'hello everyone, message %d' % i}
+        else:
+            msg = {'type': 'ping', 'ts': time.time()}
+        messages.append(json.dumps(msg).encode())
+    return messages
+
+
+class Connection(object):
+    """
+    Both ends of one connection's compression, as negotiated with a browser which offers client_max_window_bits.
+    """
+    def __init__(self, options):
+        params = {'client_max_window_bits': None}
+        self.compressor = negotiate(options, params)
+        self.min_size = options['min_size']
+        self.client_wbits = int(params['client_max_window_bits'])
+        self.decompressor = None if 'client_no_context_takeover' in params else self._decompressor()
+
+    def _decompressor(self):
+        return zlib.decompressobj(-self.client_wbits)
+
+    def send(self, data):
+        if len(data) < self.min_size:
+            return build_frame(OPCODE_TEXT, data)
+        return build_frame(OPCODE_TEXT, self.compressor.compress(data), flags=0x40)
+
+    def receive(self, data):
+        decompressor = self.decompressor or self._decompressor()
+        compressed = zlib.compressobj(6, zlib.DEFLATED, -self.client_wbits)
+        payload = compressed.compress(data) + compressed.flush(zlib.Z_SYNC_FLUSH)
+        return decompressor.decompress(payload)
+
+
+def wire_bytes(options, messages):
+    start = time.perf_counter()
+    if options is None:
+        total = sum(len(build_frame(OPCODE_TEXT, m)) for m in messages)
+    else:
+        conn = Connection(options)
+        total = sum(len(conn.send(m)) for m in messages)
+    return total, (time.perf_counter() - start) / len(messages)
+
+
+def memory_per_connection(options, message):
+    if options is None:
+        return 0
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    connections = []
+    for _ in range(CONNECTIONS):
+        conn = Connection(options)
+        conn.send(message)
+        conn.receive(message)
+        connections.append(conn)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used / CONNECTIONS
+
+
+def main():
+    messages = make_messages(600)
+    raw = sum(len(m) for m in messages)
+    print('%d messages, %d bytes of json\n' % (len(messages), raw))
+    print('%12s %12s %8s %14s %16s' % ('preset', 'wire bytes', 'ratio', 'compress (us)', 'memory/conn (KB)'))
+    presets = [('none', None)] + [(name, compression_options(name)) for name in sorted(COMPRESSION_PRESETS)]
+    for name, options in presets:
+        total, per_message = wire_bytes(options, messages)
+        memory = memory_per_connection(options, messages[0])
+        print('%12s %12d %7.2fx %14.1f %16.1f' % (name, total, raw / total, per_message * 1e6, memory / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Benchmark message codecs (see router.CODECS) for typical message shapes: encode and decode time and encoded size.
+Codecs whose packages aren't installed are skipped.
+
+Binary codecs decode from a memoryview of the payload as MessageRouterMixin does.
+
+Usage: python benchmarks/message_codecs.py
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_websockets.tests.settings')
+
+import django  # noqa
+django.setup()
+
+from django_websockets.router import CODECS, get_codec  # noqa
+
+rnd = random.Random(1)
+MESSAGES = {
+    'chat': {'type': 'chat', 'room': 'lobby', 'user': 'testing', 'text': 'hello everyone, how are you?'},
+    'telemetry': {'type': 'telemetry', 'device': 1234, 'ts': 1434567890.123,
+                  'readings': [rnd.random() * 100 for _ in range(32)]},
+    'status': {'type': 'status', 'users': [{'id': rnd.randint(1, 10000), 'username': 'user%d' % i, 'online': True}
+                                           for i in range(50)]},
+}
+
+
+def timeit(func, arg, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(arg)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    repeat = 20000
+    print('%12s %10s %8s %14s %14s' % ('message', 'codec', 'bytes', 'encode (us)', 'decode (us)'))
+    for msg_name, msg in sorted(MESSAGES.items()):
+        for codec_name in sorted(CODECS):
+            try:
+                codec = get_codec(codec_name)
+            except ImportError:
+                print('%12s %10s %8s' % (msg_name, codec_name, 'not installed'))
+                continue
+            data = codec.encode(msg)
+            payload = memoryview(data) if codec.binary else data
+            encode = timeit(codec.encode, msg, repeat)
+            decode = timeit(codec.decode, payload, repeat)
+            print('%12s %10s %8d %14.2f %14.2f' % (msg_name, codec_name, len(data), encode * 1e6, decode * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Benchmark rendering a template which uses the websocket_info tag several times, with and without token reuse
+(see settings.WS_TOKEN_REUSE_SECONDS), for each token format.
+
+"hash" tokens are only an hmac so reuse makes little difference, "claims" tokens query the user's groups so reuse
+saves a query per render. The user is saved in an in memory sqlite database and debug logging is disabled so it
+doesn't dominate.
+
+Usage: python benchmarks/templatetag.py
+"""
+import logging
+import os
+import sys
+import time
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_websockets.tests.settings')
+
+import django  # noqa
+django.setup()
+
+from django.contrib.auth.models import Group, User  # noqa
+from django.core.management import call_command  # noqa
+from django.db import connection, reset_queries  # noqa
+from django.template import RequestContext, Template  # noqa
+from django.test import RequestFactory  # noqa
+
+TEMPLATE = Template('{% load websockets %}' + '{% websocket_info %}' * 3)
+
+
+def render(request, repeat):
+    """
+    :return: tuple of seconds and queries per render
+    """
+    reset_queries()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        TEMPLATE.render(RequestContext(request, {'request': request}))
+    return (time.perf_counter() - start) / repeat, len(connection.queries) / repeat
+
+
+def create_user():
+    call_command('migrate', verbosity=0)
+    user = User.objects.create_user('testing', password='testing')
+    for name in ('staff', 'testers'):
+        user.groups.add(Group.objects.create(name=name))
+    return user
+
+
+def main():
+    logging.disable(logging.DEBUG)
+    request = RequestFactory().get('/')
+    request.user = create_user()
+    # record queries whatever DEBUG is, at most 9000 are kept so repeat * 3 must be less than that
+    connection.use_debug_cursor = True
+    repeat = 2000
+    print('%8s %14s %14s %14s %14s %8s' % ('format', 'new (us)', 'queries', 'reused (us)', 'queries', 'speedup'))
+    for token_format in ('hash', 'claims'):
+        with patch('django_websockets.settings.WS_TOKEN_FORMAT', token_format):
+            with patch('django_websockets.settings.WS_TOKEN_REUSE_SECONDS', 0):
+                new_tokens, new_queries = render(request, repeat)
+            reuse, reuse_queries = render(request, repeat)
+        row = token_format, new_tokens * 1e6, new_queries, reuse * 1e6, reuse_queries, new_tokens / reuse
+        print('%8s %14.1f %14.2f %14.1f %14.2f %7.1fx' % row)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,9 @@ from django_websockets.handlers import AnonSocketHandler, AuthSocketHandler, Pin
 
 
 class WsBase(PingPongMixin):
+    # open and on_message send several small messages at once, write them together
+    coalesce_writes = True
+
     def open(self):
         super(WsBase, self).open()
         self.ping_timer()
@@ -24,8 +27,7 @@ class WsBase(PingPongMixin):
             self.broadcast('%s: %s' % (self.user or 'anon', msg))
 
     def broadcast(self, msg):
-        for cli in all_clients:
-            cli.safe_write_message(msg)
+        all_clients.broadcast(msg)
 
 
 class AnonEchoHandler(WsBase, AnonSocketHandler):
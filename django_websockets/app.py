@@ -4,6 +4,10 @@ import tornado.web
 from django.utils.module_loading import import_string
 from django.contrib.staticfiles.handlers import StaticFilesHandler
 from . import settings
+from .clients import all_clients
+from .metrics import start_loop_lag_monitor
+from .prometheus import MetricsHandler
+from .wsgi import ThreadPoolWSGIContainer
 
 logger = logging.getLogger(settings.WS_LOGGER_NAME)
 
@@ -46,12 +50,24 @@ def get_app(serve_django, handler_defs=settings.WS_HANDLERS, serve_static_files=
     """
     handlers = [convert_handler_definition(*hd) for hd in handler_defs]
 
+    if settings.WS_BACKPLANE and all_clients.backplane is None:
+        backplane_cls = import_string(settings.WS_BACKPLANE)
+        all_clients.backplane = backplane_cls(all_clients, **settings.WS_BACKPLANE_OPTIONS)
+        logger.info('Using backplane %s', settings.WS_BACKPLANE)
+
+    if settings.WS_METRICS_URL:
+        handlers.append((settings.WS_METRICS_URL, MetricsHandler))
+        start_loop_lag_monitor()
+
     if serve_django:
         assert settings.WSGI_APPLICATION is not None, 'WSGI_APPLICATION maybe not be None or omitted'
         django_app = import_string(settings.WSGI_APPLICATION)
         if serve_static_files:
             django_app = StaticFilesHandler(django_app)
-        wsgi_app = tornado.wsgi.WSGIContainer(django_app)
+        if settings.WS_WSGI_THREADS:
+            wsgi_app = ThreadPoolWSGIContainer(django_app)
+        else:
+            wsgi_app = tornado.wsgi.WSGIContainer(django_app)
         dj_handler = ('.*', tornado.web.FallbackHandler, {'fallback': wsgi_app})
         handlers.append(dj_handler)
 
@@ -0,0 +1,152 @@
+"""
+Asynchronous websocket authentication. Checking a token requires a database query so users are loaded in
+a thread pool to avoid blocking the IOLoop, and lookups from handshakes arriving together are combined into
+one query.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from .tokens import (ClaimsUser, ParsedToken, User, check_claims_user, check_user_token, get_revocation_key,
+                     precheck_token)
+from . import settings
+
+logger = logging.getLogger(settings.WS_LOGGER_NAME)
+
+_executor = None
+_user_loader = None
+
+
+def get_auth_executor():
+    """
+    :return: the thread pool used to load users, created on first use so it's not shared by forked workers
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(settings.WS_AUTH_THREADS)
+    return _executor
+
+
+def get_user_loader():
+    """
+    :return: the UserLoader used by check_token_get_user_async
+    """
+    global _user_loader
+    if _user_loader is None:
+        _user_loader = UserLoader()
+    return _user_loader
+
+
+def _load_users(user_ids):
+    # like django's request_started and request_finished signals, make sure stale connections aren't reused
+    # and this thread's connection is closed when CONN_MAX_AGE says it should be
+    close_old_connections()
+    try:
+        return User.objects.in_bulk(user_ids)
+    finally:
+        close_old_connections()
+
+
+class UserLoader(object):
+    """
+    Combines user lookups requested close together into one "id IN (...)" query.
+
+    The first lookup starts a batch which is loaded after max_wait seconds (on the next IOLoop iteration
+    if max_wait is 0) or as soon as it contains max_batch ids, whichever comes first.
+    """
+    def __init__(self, max_batch=None, max_wait=None):
+        self.max_batch = max_batch or settings.WS_AUTH_BATCH_SIZE
+        self.max_wait = settings.WS_AUTH_BATCH_WAIT if max_wait is None else max_wait
+        # user id -> list of futures waiting for that user
+        self._pending = {}
+        self._timeout = None
+        self.batches = 0
+        self.loaded = 0
+
+    def load(self, user_id):
+        """
+        :param user_id: id of user to load
+        :return: future resolving to the user or None if no user exists with that id
+        """
+        future = Future()
+        if not self._pending:
+            io_loop = IOLoop.current()
+            if self.max_wait:
+                self._timeout = io_loop.add_timeout(io_loop.time() + self.max_wait, self.flush)
+            else:
+                io_loop.add_callback(self.flush)
+        self._pending.setdefault(user_id, []).append(future)
+        if len(self._pending) >= self.max_batch:
+            self.flush()
+        return future
+
+    @gen.coroutine
+    def flush(self):
+        """
+        Load users for every pending lookup and resolve their futures.
+        """
+        if self._timeout is not None:
+            IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = None
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        self.batches += 1
+        self.loaded += len(pending)
+        logger.debug('loading %d users for %d handshakes', len(pending), sum(len(f) for f in pending.values()))
+        users, errors = {}, {}
+        try:
+            users = yield self._load(list(pending))
+        except Exception as e:
+            if len(pending) == 1:
+                errors = dict.fromkeys(pending, e)
+            else:
+                # eg. an id the database can't compare with the primary key, don't fail every lookup in the batch
+                logger.warning('error loading %d users, loading them one at a time: %s', len(pending), e)
+                for user_id in pending:
+                    try:
+                        users.update((yield self._load([user_id])))
+                    except Exception as e:
+                        errors[user_id] = e
+        for user_id, futures in pending.items():
+            for future in futures:
+                if user_id in errors:
+                    future.set_exception(errors[user_id])
+                else:
+                    future.set_result(users.get(user_id))
+
+    @gen.coroutine
+    def _load(self, user_ids):
+        if settings.WS_AUTH_THREADS:
+            users = yield get_auth_executor().submit(_load_users, user_ids)
+        else:
+            users = _load_users(user_ids)
+        return users
+
+
+@gen.coroutine
+def check_token_get_user_async(token, ip_address):
+    """
+    Asynchronous version of tokens.check_token_get_user, users are loaded via a UserLoader.
+
+    :param: token to check
+    :param: ip_address of client
+    :return: future resolving to user instance or False if the token is invalid
+    """
+    result = precheck_token(token, ip_address)
+    if isinstance(result, ClaimsUser):
+        if settings.WS_TOKEN_REVOCATION_CACHE and settings.WS_AUTH_THREADS:
+            # the revocation cache may be remote, don't wait for it on the IOLoop
+            revocation_key = yield get_auth_executor().submit(get_revocation_key, result.pk)
+        else:
+            revocation_key = get_revocation_key(result.pk)
+        return check_claims_user(result, revocation_key)
+    if not isinstance(result, ParsedToken):
+        return result
+
+    user = yield get_user_loader().load(result.user_id)
+    return check_user_token(user, token, ip_address, result)
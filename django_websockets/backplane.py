@@ -0,0 +1,278 @@
+"""
+Backplanes carry broadcasts, group and user messages between processes so they reach clients connected to
+any process, not just the one which sent the message.
+
+A backplane is attached to an AllClients instance (see settings.WS_BACKPLANE), AllClients still writes to
+its own clients directly and publishes the message to the backplane which delivers it to every other
+process. Messages published in the same IOLoop iteration are sent as one batch.
+"""
+import json
+import logging
+import socket
+import struct
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.netutil import bind_sockets, bind_unix_socket
+from tornado.tcpserver import TCPServer
+
+from . import settings
+
+logger = logging.getLogger(settings.WS_LOGGER_NAME)
+
+# kinds of message, the index is used on the wire
+KINDS = ('all', 'group', 'user', 'codec')
+_KIND_CODES = {k: i for i, k in enumerate(KINDS)}
+
+# batch length prefix
+_LENGTH = struct.Struct('!I')
+# per message header: kind code, opcode, length of json encoded target, length of data
+_MESSAGE_HEADER = struct.Struct('!BBHI')
+
+
+def encode_batch(batch):
+    """
+    Encode a batch of messages into length prefixed bytes suitable for sending to the broker.
+    :param batch: list of (kind, target, opcode, data) tuples
+    :return: bytes
+    """
+    parts = []
+    for kind, target, opcode, data in batch:
+        target = json.dumps(target).encode()
+        parts.extend((_MESSAGE_HEADER.pack(_KIND_CODES[kind], opcode, len(target), len(data)), target, data))
+    body = b''.join(parts)
+    return _LENGTH.pack(len(body)) + body
+
+
+def decode_batch(body):
+    """
+    Decode the body of a batch as created by encode_batch, excluding the length prefix.
+    :param body: bytes
+    :return: list of (kind, target, opcode, data) tuples
+    """
+    batch = []
+    view = memoryview(body)
+    offset = 0
+    while offset < len(body):
+        kind, opcode, target_len, data_len = _MESSAGE_HEADER.unpack_from(body, offset)
+        offset += _MESSAGE_HEADER.size
+        target = json.loads(bytes(view[offset:offset + target_len]).decode())
+        offset += target_len
+        batch.append((KINDS[kind], target, opcode, bytes(view[offset:offset + data_len])))
+        offset += data_len
+    return batch
+
+
+def parse_address(address):
+    """
+    :param address: "unix:/path/to/socket", "host:port" or "port"
+    :return: tuple of (unix socket path, None, None) or (None, host, port)
+    """
+    if address.startswith('unix:'):
+        return address[5:], None, None
+    host, _, port = address.rpartition(':')
+    return None, host or '127.0.0.1', int(port)
+
+
+class Backplane(object):
+    """
+    Base class for backplanes. Children should implement send_batch to deliver batches to other processes and
+    call deliver for each message received from other processes.
+    """
+    def __init__(self, clients):
+        """
+        :param clients: AllClients instance messages are delivered to
+        """
+        self.clients = clients
+        self._batch = []
+        self.published = 0
+        self.delivered = 0
+
+    def publish(self, kind, target, opcode, data):
+        """
+        Queue a message to be sent to other processes at the end of this IOLoop iteration.
+        :param kind: one of "all", "group", "user", "codec"
+        :param target: group name, user id or [codec name, default], None for "all"
+        :param opcode: websocket opcode
+        :param data: encoded message payload
+        """
+        if not self._batch:
+            IOLoop.current().add_callback(self._flush)
+        self._batch.append((kind, target, opcode, data))
+        self.published += 1
+
+    def _flush(self):
+        batch, self._batch = self._batch, []
+        if batch:
+            self.send_batch(batch)
+
+    def send_batch(self, batch):
+        raise NotImplementedError
+
+    def deliver(self, kind, target, opcode, data):
+        """
+        Deliver a message received from another process to clients connected to this process.
+        """
+        self.delivered += 1
+        self.clients.deliver(kind, target, opcode, data)
+
+    def close(self):
+        pass
+
+
+class InProcessBackplane(Backplane):
+    """
+    Connects AllClients instances in the same process which share a bus name, mostly useful for testing.
+    """
+    buses = {}
+
+    def __init__(self, clients, bus='default'):
+        super(InProcessBackplane, self).__init__(clients)
+        self.bus = bus
+        self.buses.setdefault(bus, []).append(self)
+
+    def send_batch(self, batch):
+        for backplane in self.buses.get(self.bus, ()):
+            if backplane is not self:
+                for message in batch:
+                    backplane.deliver(*message)
+
+    def close(self):
+        self.buses[self.bus].remove(self)
+
+
+class BrokerBackplane(Backplane):
+    """
+    Backplane which connects to a BrokerServer over a unix or TCP socket, the broker relays each batch
+    to every other connected process. If the connection is lost it is retried every reconnect_delay seconds,
+    messages published while disconnected or while more than max_buffer bytes are waiting to be written to
+    the broker are dropped.
+    """
+    def __init__(self, clients, address=None, reconnect_delay=1, max_buffer=None):
+        super(BrokerBackplane, self).__init__(clients)
+        self.address = address or settings.WS_BROKER_ADDRESS
+        self.reconnect_delay = reconnect_delay
+        self.max_buffer = max_buffer or settings.WS_BACKPLANE_MAX_BUFFER
+        self.stream = None
+        self._closed = False
+        self.dropped = 0
+        IOLoop.current().add_callback(self.connect)
+
+    @gen.coroutine
+    def connect(self):
+        path, host, port = parse_address(self.address)
+        if path:
+            stream = IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+            connect_to = path
+        else:
+            stream = IOStream(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+            connect_to = host, port
+        try:
+            yield stream.connect(connect_to)
+        except (StreamClosedError, OSError):
+            logger.warning('unable to connect to broker at %s, retrying in %ss', self.address, self.reconnect_delay)
+            self._schedule_reconnect()
+            return
+        logger.info('connected to broker at %s', self.address)
+        self.stream = stream
+        stream.set_nodelay(True)
+        stream.set_close_callback(self._on_stream_close)
+        yield self._read_batches(stream)
+
+    @gen.coroutine
+    def _read_batches(self, stream):
+        try:
+            while True:
+                length, = _LENGTH.unpack((yield stream.read_bytes(_LENGTH.size)))
+                body = yield stream.read_bytes(length)
+                for message in decode_batch(body):
+                    self.deliver(*message)
+        except StreamClosedError:
+            pass
+
+    def _on_stream_close(self):
+        self.stream = None
+        if not self._closed:
+            logger.warning('connection to broker at %s lost, reconnecting', self.address)
+            self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        if not self._closed:
+            io_loop = IOLoop.current()
+            io_loop.add_timeout(io_loop.time() + self.reconnect_delay, self.connect)
+
+    def send_batch(self, batch):
+        if self.stream is None or self.stream.closed():
+            self.dropped += len(batch)
+            return
+        data = encode_batch(batch)
+        if self.stream._write_buffer_size + len(data) > self.max_buffer:
+            if not self.dropped:
+                logger.warning('broker at %s is not reading batches fast enough, dropping messages', self.address)
+            self.dropped += len(batch)
+            return
+        self.stream.write(data)
+
+    def close(self):
+        self._closed = True
+        if self.stream is not None:
+            self.stream.close()
+
+
+class BrokerServer(TCPServer):
+    """
+    Relays batches from each connected process to every other connected process without decoding them.
+
+    Processes with more than max_buffer bytes waiting to be written to them are disconnected rather than
+    letting the broker's memory grow, they reconnect but miss the messages sent in between.
+    """
+    def __init__(self, *args, **kwargs):
+        self.max_buffer = kwargs.pop('max_buffer', None) or settings.WS_BACKPLANE_MAX_BUFFER
+        super(BrokerServer, self).__init__(*args, **kwargs)
+        self.peers = set()
+        self.disconnected = 0
+
+    def bind_address(self, address):
+        """
+        Listen on a unix socket or TCP address, see parse_address.
+        """
+        path, host, port = parse_address(address)
+        if path:
+            self.add_socket(bind_unix_socket(path))
+        else:
+            self.add_sockets(bind_sockets(port, host))
+
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        self.peers.add(stream)
+        stream.set_nodelay(True)
+        logger.debug('broker peer connected, %d peers', len(self.peers))
+        try:
+            while True:
+                prefix = yield stream.read_bytes(_LENGTH.size)
+                length, = _LENGTH.unpack(prefix)
+                data = prefix + (yield stream.read_bytes(length))
+                self.relay(stream, data)
+        except StreamClosedError:
+            pass
+        finally:
+            self.peers.discard(stream)
+            logger.debug('broker peer disconnected, %d peers', len(self.peers))
+
+    def relay(self, sender, data):
+        """
+        Write a batch to every peer except the one which sent it.
+        :param sender: stream the batch was read from
+        :param data: batch including its length prefix
+        """
+        for peer in list(self.peers):
+            if peer is sender or peer.closed():
+                continue
+            if peer._write_buffer_size + len(data) > self.max_buffer:
+                logger.warning('broker peer has more than %d bytes waiting to be written, disconnecting it',
+                               self.max_buffer)
+                self.disconnected += 1
+                peer.close()
+            else:
+                peer.write(data)
@@ -0,0 +1,102 @@
+"""
+Small in memory cache with a maximum size (least recently used entries are evicted first) and per entry expiry.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """
+    Thread safe LRU cache where every entry also has a time to live.
+
+    hits, misses and evictions count cache activity, expired entries found by get count as misses.
+    """
+    def __init__(self, max_size, ttl, timer=time.monotonic, group=None):
+        """
+        :param max_size: maximum number of entries, 0 disables the cache
+        :param ttl: default time to live of entries in seconds
+        :param timer: function returning the current time in seconds
+        :param group: optional function returning a group for each key, all entries in a group can then be
+            removed by discard_group without scanning the whole cache
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.timer = timer
+        self.group = group
+        self._data = OrderedDict()
+        # group -> set of keys, only used if group is set
+        self._groups = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires > self.timer():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        """
+        :param key: cache key
+        :param value: value to cache
+        :param ttl: time to live in seconds, defaults to the cache's ttl, entries with ttl <= 0 aren't cached
+        """
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or self.max_size <= 0:
+            return
+        with self._lock:
+            if self.group is not None and key not in self._data:
+                self._groups.setdefault(self.group(key), set()).add(key)
+            self._data[key] = value, self.timer() + ttl
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        # must be called with the lock held
+        del self._data[key]
+        if self.group is not None:
+            group = self.group(key)
+            keys = self._groups[group]
+            keys.discard(key)
+            if not keys:
+                del self._groups[group]
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def discard_group(self, group):
+        """
+        Remove all entries in a group, the cache must have been created with a group function.
+        :return: number of entries removed
+        """
+        with self._lock:
+            keys = self._groups.pop(group, ())
+            for k in keys:
+                del self._data[k]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._groups.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return '<TTLCache: %d entries, %d hits, %d misses, %d evictions>' % (
+            len(self), self.hits, self.misses, self.evictions)
@@ -0,0 +1,368 @@
+import logging
+import time
+from functools import partial
+from itertools import chain
+
+from tornado.ioloop import IOLoop
+from tornado.websocket import WebSocketProtocol13
+
+from .compression import get_compression_executor
+from .metrics import record_broadcast
+from .protocol import encode_message, build_frame
+from . import settings
+
+logger = logging.getLogger(settings.WS_LOGGER_NAME)
+
+_NO_CLIENTS = {}
+
+
+class ClientsView(object):
+    """
+    Lazy, read only view of one or more client dicts, nothing is copied when the view is created.
+
+    len() is O(1) and iteration walks the underlying dicts directly, so clients must not be added or removed
+    while iterating over a view; take a copy with list(view) if you need that.
+    """
+    __slots__ = ('_sources',)
+
+    def __init__(self, *sources):
+        self._sources = sources
+
+    def __len__(self):
+        return sum(len(s) for s in self._sources)
+
+    def __iter__(self):
+        return chain.from_iterable(self._sources)
+
+    def __contains__(self, h):
+        return any(h in s for s in self._sources)
+
+    def __bool__(self):
+        return any(self._sources)
+
+    def __repr__(self):
+        return '<ClientsView: %d clients>' % len(self)
+
+
+class AllClients(object):
+    """
+    Registry of all handlers/clients connected to this server.
+
+    Clients are stored in dicts (used as insertion ordered sets) split by whether they have a user,
+    this makes append and remove O(1) and means the auth and anon counts never need to be calculated.
+
+    Authenticated clients are also indexed by user id so a user's connections can be found without
+    walking every client, the value stored against each client in _auth is the user id it was indexed under.
+
+    Groups are indexed both ways: group name -> clients and client -> group names, so sending to a group
+    only touches its members and removing a client only costs as much as the number of groups it joined.
+
+    Clients with a codec attribute (see router.MessageRouterMixin) are indexed by it when they're appended,
+    see codec_broadcast.
+    """
+    def __init__(self):
+        # see backplane.Backplane, used to send broadcasts, group and user messages to other processes
+        self.backplane = None
+        self._auth = {}
+        self._anon = {}
+        self._users = {}
+        self._groups = {}
+        self._client_groups = {}
+        self._codecs = {}
+        self._client_codecs = {}
+
+    def append(self, h):
+        if h.user:
+            user_id = getattr(h.user, 'pk', None)
+            self._auth[h] = user_id
+            if user_id is not None:
+                self._users.setdefault(user_id, {})[h] = None
+        else:
+            self._anon[h] = None
+        codec = getattr(h, 'codec', None)
+        if codec is not None:
+            self._codecs.setdefault(codec, {})[h] = None
+            self._client_codecs[h] = codec
+
+    def remove(self, h, lenient=False):
+        for name in self._client_groups.pop(h, ()):
+            self._discard_from_group(h, name)
+        codec = self._client_codecs.pop(h, None)
+        if codec is not None:
+            codec_clients = self._codecs[codec]
+            del codec_clients[h]
+            if not codec_clients:
+                del self._codecs[codec]
+
+        # the user might have changed since the handler was appended so check both dicts
+        if h in self._auth:
+            user_id = self._auth.pop(h)
+            if user_id is not None:
+                user_clients = self._users[user_id]
+                del user_clients[h]
+                if not user_clients:
+                    del self._users[user_id]
+        elif h in self._anon:
+            del self._anon[h]
+        elif not lenient:
+            raise ValueError('%r not in clients' % h)
+
+    @property
+    def all_clients(self):
+        """
+        All handlers/clients connected.
+        :return: lazy view of clients
+        """
+        return ClientsView(self._auth, self._anon)
+
+    def __iter__(self):
+        return chain(self._auth, self._anon)
+
+    def __len__(self):
+        return len(self._auth) + len(self._anon)
+
+    def __contains__(self, h):
+        return h in self._auth or h in self._anon
+
+    @property
+    def auth_clients(self):
+        """
+        Clients who are authenticated, eg. handlers with a user
+        :return: lazy view of clients
+        """
+        return ClientsView(self._auth)
+
+    @property
+    def anon_clients(self):
+        """
+        Clients who are anonymous, eg. handlers with no user
+        :return: lazy view of clients
+        """
+        return ClientsView(self._anon)
+
+    def clients_for_user(self, user_id):
+        """
+        Clients connected for a given user.
+        :param user_id: id (pk) of the user
+        :return: lazy view of clients, empty if the user has no connections
+        """
+        return ClientsView(self._users.get(user_id, _NO_CLIENTS))
+
+    def send_to_user(self, user_id, msg, binary=False):
+        """
+        Send a message to all of a user's connections, this only costs as much as the number of connections
+        that user has.
+        :param user_id: id (pk) of the user
+        :param msg: message to send, str, bytes or dict
+        :param binary: whether to send a binary frame
+        :return: number of clients in this process the message was sent to
+        """
+        opcode, data = encode_message(msg, binary)
+        self._publish('user', user_id, opcode, data)
+        return self._write_all(self._users.get(user_id, _NO_CLIENTS), opcode, data)
+
+    def join(self, h, name):
+        """
+        Add a client to a named group, joining a group twice has no effect.
+        :param h: handler/client
+        :param name: group name
+        """
+        self._groups.setdefault(name, {})[h] = None
+        self._client_groups.setdefault(h, set()).add(name)
+
+    def leave(self, h, name):
+        """
+        Remove a client from a named group, leaving a group the client isn't in has no effect.
+        :param h: handler/client
+        :param name: group name
+        """
+        client_groups = self._client_groups.get(h)
+        if client_groups is None or name not in client_groups:
+            return
+        client_groups.remove(name)
+        if not client_groups:
+            del self._client_groups[h]
+        self._discard_from_group(h, name)
+
+    def _discard_from_group(self, h, name):
+        members = self._groups[name]
+        del members[h]
+        if not members:
+            del self._groups[name]
+
+    def clients_in_group(self, name):
+        """
+        Members of a group.
+        :param name: group name
+        :return: lazy view of clients, empty if the group doesn't exist
+        """
+        return ClientsView(self._groups.get(name, _NO_CLIENTS))
+
+    def groups_for_client(self, h):
+        """
+        :param h: handler/client
+        :return: frozenset of the names of groups the client has joined
+        """
+        return frozenset(self._client_groups.get(h, ()))
+
+    @property
+    def groups(self):
+        """
+        :return: lazy view of the names of all groups with at least one member
+        """
+        return self._groups.keys()
+
+    def group_send(self, name, msg, binary=False):
+        """
+        Send a message to all members of a group, this only costs as much as the size of the group.
+        :param name: group name
+        :param msg: message to send, str, bytes or dict
+        :param binary: whether to send a binary frame
+        :return: number of clients in this process the message was sent to
+        """
+        opcode, data = encode_message(msg, binary)
+        self._publish('group', name, opcode, data)
+        return self._write_all(self._groups.get(name, _NO_CLIENTS), opcode, data)
+
+    def broadcast(self, msg, predicate=None, exclude=None, binary=False):
+        """
+        Send a message to all clients, the message is encoded and framed once and the same bytes written
+        to every client (unless they've negotiated compression with context takeover, clients without context
+        takeover share one compressed frame, see _write_all).
+        :param msg: message to send, str, bytes or dict
+        :param predicate: optional function called with each client, the message is only sent if it returns True.
+            Predicates can't be sent to other processes so broadcasts with a predicate are not published to the
+            backplane.
+        :param exclude: optional client or collection of clients not to send the message to, eg. the sender
+        :param binary: whether to send a binary frame
+        :return: number of clients in this process the message was sent to
+        """
+        opcode, data = encode_message(msg, binary)
+        if predicate is None:
+            self._publish('all', None, opcode, data)
+        return self._write_all(self, opcode, data, predicate, exclude)
+
+    def codec_broadcast(self, codec, msg, default=False, predicate=None, exclude=None, binary=False):
+        """
+        Send a message to clients using a codec, this only costs as much as the number of those clients unless
+        default is True. Like broadcast the message is only published to the backplane if there's no predicate.
+        :param codec: codec name, compared with each client's codec attribute
+        :param msg: message to send encoded with the codec, str or bytes
+        :param default: whether clients without a codec attribute should also get the message
+        :param predicate: optional function called with each client, the message is only sent if it returns True
+        :param exclude: optional client or collection of clients not to send the message to
+        :param binary: whether to send a binary frame
+        :return: number of clients in this process the message was sent to
+        """
+        opcode, data = encode_message(msg, binary)
+        if predicate is None:
+            self._publish('codec', [codec, default], opcode, data)
+        return self._write_all(self._clients_for_codec(codec, default), opcode, data, predicate, exclude)
+
+    def _clients_for_codec(self, codec, default):
+        clients = self._codecs.get(codec, _NO_CLIENTS)
+        if not default:
+            return clients
+        return chain(clients, (h for h in self if h not in self._client_codecs))
+
+    def deliver(self, kind, target, opcode, data):
+        """
+        Send a message received from the backplane to clients in this process.
+        :param kind: "all", "group", "user" or "codec"
+        :param target: group name, user id or [codec name, default] (see codec_broadcast), ignored for "all"
+        :param opcode: websocket opcode
+        :param data: encoded message payload
+        :return: number of clients the message was sent to
+        """
+        if kind == 'all':
+            clients = self
+        elif kind == 'group':
+            clients = self._groups.get(target, _NO_CLIENTS)
+        elif kind == 'codec':
+            clients = self._clients_for_codec(*target)
+        else:
+            clients = self._users.get(target, _NO_CLIENTS)
+        return self._write_all(clients, opcode, data)
+
+    def _publish(self, kind, target, opcode, data):
+        if self.backplane is not None:
+            self.backplane.publish(kind, target, opcode, data)
+
+    def _write_all(self, clients, opcode, data, predicate=None, exclude=None):
+        if not clients:
+            return 0
+        if exclude is not None and not isinstance(exclude, (set, frozenset, list, tuple, ClientsView)):
+            exclude = (exclude,)
+        start = time.perf_counter()
+        frame = build_frame(opcode, data)
+        sent = 0
+        # compressor key -> (compressor, connections) for clients compressing without context takeover
+        stateless = {}
+        for cli in clients:
+            if (exclude and cli in exclude) or (predicate and not predicate(cli)):
+                continue
+            conn = cli.ws_connection
+            if conn is not None:
+                sent += 1
+                compressor = conn.stateless_compressor(data)
+                if compressor is None:
+                    conn.write_prepared(opcode, data, frame)
+                else:
+                    stateless.setdefault(compressor.key, (compressor, []))[1].append(conn)
+        for compressor, conns in stateless.values():
+            self._write_compressed(compressor, conns, opcode, data)
+        record_broadcast(sent, time.perf_counter() - start)
+        return sent
+
+    def _write_compressed(self, compressor, conns, opcode, data):
+        """
+        Compress a message once for connections which share compression options without context takeover.
+        Large messages are compressed in a thread (see settings.WS_COMPRESSION_THREADS) so they don't block
+        the IOLoop, their place in each connection's stream is reserved so messages still arrive in order.
+        """
+        if not settings.WS_COMPRESSION_THREADS or len(data) < settings.WS_COMPRESSION_THREAD_BYTES:
+            try:
+                frame = _compressed_frame(compressor, opcode, data)
+            except Exception:
+                # other groups of clients should still get the message
+                logger.exception('error compressing broadcast for %d clients', len(conns))
+                return
+            for conn in conns:
+                conn.write_shared(data, frame)
+            return
+        held = [(conn, conn.hold()) for conn in conns]
+        future = get_compression_executor().submit(_compressed_frame, compressor, opcode, data)
+        IOLoop.current().add_future(future, partial(_release_compressed, held, len(data)))
+
+    @property
+    def auth_count(self):
+        return len(self._auth)
+
+    @property
+    def anon_count(self):
+        return len(self._anon)
+
+    @property
+    def status(self):
+        return '%d auth, %d anon, %d total' % (self.auth_count, self.anon_count, len(self))
+
+    def __str__(self):
+        return 'AllClients: %s' % self.status
+
+
+def _compressed_frame(compressor, opcode, data):
+    return build_frame(opcode, compressor.compress(data), flags=WebSocketProtocol13.RSV1)
+
+
+def _release_compressed(held, data_length, future):
+    try:
+        frame = future.result()
+    except Exception:
+        logger.exception('error compressing broadcast for %d clients', len(held))
+        frame = None
+    for conn, h in held:
+        conn.release(h, frame, data_length)
+
+
+# singleton containing all clients/handlers connected to this server.
+all_clients = AllClients()
@@ -0,0 +1,158 @@
+"""
+permessage-deflate (RFC 7692) options, see settings.WS_COMPRESSION.
+
+Each connection with context takeover keeps a zlib compressor (and decompressor) for its whole life, about
+2 ** (wbits + 2) + 2 ** (mem_level + 9) bytes to compress and 2 ** wbits to decompress, 256KB + 32KB with
+zlib's defaults. Without context takeover contexts only exist while a message is being (de)compressed,
+which costs some compression ratio but very little memory however many connections are open. Connections
+without context takeover and the same options can also share one compressed frame for broadcasts, see
+AllClients._write_all.
+"""
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from . import settings
+
+_executor = None
+
+COMPRESSION_DEFAULTS = {
+    # zlib compression level 1 (fastest) to 9 (smallest)
+    'level': 6,
+    # LZ77 window size of our compressor and the client's, 9 to 15, smaller windows use less memory
+    'wbits': zlib.MAX_WBITS,
+    # zlib memory level of our compressor, 1 to 9, smaller values use less memory
+    'mem_level': 8,
+    # messages smaller than this are sent uncompressed
+    'min_size': 0,
+    # whether compression contexts are kept between messages
+    'context_takeover': True,
+}
+
+COMPRESSION_PRESETS = {
+    'default': {},
+    'fast': {'level': 1, 'min_size': 256},
+    'small': {'level': 9, 'mem_level': 9},
+    'low_memory': {'wbits': 10, 'mem_level': 4, 'min_size': 256, 'context_takeover': False},
+    'no_context': {'min_size': 256, 'context_takeover': False},
+}
+
+
+def compression_options(compression):
+    """
+    Resolve a handler's compression value into full options.
+    :param compression: None or False to disable compression, a name from COMPRESSION_PRESETS or a dict of
+        options, dicts may include "preset" to override the options of a preset
+    :return: dict with every key in COMPRESSION_DEFAULTS or None if compression is disabled
+    """
+    if not compression:
+        return None
+    if isinstance(compression, str):
+        compression = {'preset': compression}
+    options = dict(compression)
+    preset = options.pop('preset', 'default')
+    if preset not in COMPRESSION_PRESETS:
+        raise ValueError('invalid compression preset %r, should be one of %s' %
+                         (preset, ', '.join(sorted(COMPRESSION_PRESETS))))
+    unknown = set(options) - set(COMPRESSION_DEFAULTS)
+    if unknown:
+        raise ValueError('invalid compression options: %s' % ', '.join(sorted(unknown)))
+    options = dict(COMPRESSION_DEFAULTS, **dict(COMPRESSION_PRESETS[preset], **options))
+    if not 9 <= options['wbits'] <= zlib.MAX_WBITS:
+        raise ValueError('invalid compression wbits %r, should be between 9 and %d' %
+                         (options['wbits'], zlib.MAX_WBITS))
+    return options
+
+
+def get_compression_executor():
+    """
+    :return: the thread pool broadcasts are compressed in, created on first use so it's not shared by
+        forked workers
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(settings.WS_COMPRESSION_THREADS)
+    return _executor
+
+
+class DeflateCompressor(object):
+    """
+    Equivalent of tornado's _PerMessageDeflateCompressor which also takes a compression level and memory level.
+    """
+    def __init__(self, level, wbits, mem_level, persistent):
+        self.level = level
+        self.wbits = wbits
+        self.mem_level = mem_level
+        self.persistent = persistent
+        self._compressor = self._create_compressor() if persistent else None
+
+    @property
+    def key(self):
+        """
+        Compressors with the same key produce the same output without context takeover.
+        """
+        return self.level, self.wbits, self.mem_level
+
+    def _create_compressor(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, -self.wbits, self.mem_level)
+
+    def compress(self, data):
+        """
+        :param data: message payload
+        :return: compressed payload without the trailing 0x00 0x00 0xff 0xff, see RFC 7692 section 7.2.1
+
+        Without context takeover a new zlib object is used for each message so this is thread safe
+        (and zlib releases the GIL while compressing).
+        """
+        compressor = self._compressor or self._create_compressor()
+        data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        return data[:-4]
+
+
+# parameters a client may offer and the window sizes allowed for each, see RFC 7692 section 7.1. Our compressor's
+# window can't be limited to 8 bits since zlib doesn't support raw deflate with an 8 bit window
+OFFER_WINDOW_BITS = {
+    'server_max_window_bits': range(9, zlib.MAX_WBITS + 1),
+    'client_max_window_bits': range(8, zlib.MAX_WBITS + 1),
+}
+OFFER_PARAMETERS = set(OFFER_WINDOW_BITS) | {'server_no_context_takeover', 'client_no_context_takeover'}
+
+
+def acceptable_offer(offered_parameters):
+    """
+    :param offered_parameters: dict of parameters of one permessage-deflate offer from a client
+    :return: whether negotiate can accept the offer, if not it should be declined so the connection isn't
+        compressed (unless the client made another offer)
+    """
+    for key, value in offered_parameters.items():
+        if key not in OFFER_PARAMETERS:
+            return False
+        if value is not None and key in OFFER_WINDOW_BITS:
+            try:
+                if int(value) not in OFFER_WINDOW_BITS[key]:
+                    return False
+            except ValueError:
+                return False
+    return True
+
+
+def negotiate(options, agreed_parameters):
+    """
+    Apply our options to the permessage-deflate parameters offered by a client, agreed_parameters is
+    modified in place and becomes the parameters of the response.
+    :param options: as returned by compression_options
+    :param agreed_parameters: dict of parameters from the client's offer, which must be an acceptable_offer
+    :return: DeflateCompressor to use for messages to the client
+    """
+    if not options['context_takeover']:
+        # both are allowed in a response even if the client didn't offer them
+        agreed_parameters['server_no_context_takeover'] = None
+        agreed_parameters['client_no_context_takeover'] = None
+    if 'client_max_window_bits' in agreed_parameters:
+        # the client supports limiting its window, limit it so our decompressor uses less memory
+        offered = agreed_parameters['client_max_window_bits']
+        agreed_parameters['client_max_window_bits'] = str(min(int(offered or zlib.MAX_WBITS), options['wbits']))
+    # the client can decompress anything compressed with a window no larger than the one it asked for,
+    # so our window isn't included in the response
+    wbits = min(int(agreed_parameters.get('server_max_window_bits') or zlib.MAX_WBITS), options['wbits'])
+    persistent = 'server_no_context_takeover' not in agreed_parameters
+    return DeflateCompressor(options['level'], wbits, options['mem_level'], persistent)
@@ -1,69 +1,31 @@
 import logging
-from operator import attrgetter
-from itertools import filterfalse
 import time
 
+import tornado.gen
 import tornado.websocket
 
-from .tokens import check_token_get_user
+from .auth import check_token_get_user_async
+from .clients import AllClients, all_clients  # noqa
+from .compression import compression_options
+from .heartbeat import get_heartbeat_scheduler
+from .metrics import handshakes_accepted, handshakes_rejected, record_rtt
+from .protocol import WebSocketProtocol
+from .shedding import load_shedder
 from . import settings
 
 logger = logging.getLogger(settings.WS_LOGGER_NAME)
 
 
-class AllClients(object):
-    def __init__(self):
-        self._clients = []
-
-    def append(self, h):
-        self._clients.append(h)
-
-    def remove(self, h, lenient=False):
-        try:
-            self._clients.remove(h)
-        except ValueError:
-            if not lenient:
-                raise
-
-    @property
-    def all_clients(self):
-        """
-        All handlers/clients connected, for consistency with properties
-        below this is returned as an iterator.
-        :return: client iterator
-        """
-        return self._clients
-
-    def __iter__(self):
-        for cli in self._clients:
-            yield cli
-
-    @property
-    def auth_clients(self):
-        """
-        Clients who are authenticated, eg. handlers with a user
-        :return: list of clients
-        """
-        return list(filter(attrgetter('user'), self._clients))
-
-    @property
-    def anon_clients(self):
-        """
-        Clients who are anonymous, eg. handlers with no user
-        :return: list of clients
-        """
-        return list(filterfalse(attrgetter('user'), self._clients))
-
-    @property
-    def status(self):
-        return '%d auth, %d anon, %d total' % (len(self.auth_clients), len(self.anon_clients), len(self._clients))
-
-    def __str__(self):
-        return 'AllClients: %s' % self.status
-
-
-# singleton containing list of all clients/handlers connected to this server.
-all_clients = AllClients()
+def split_subprotocol(subprotocol):
+    """
+    Subprotocols are "<token>" or "<codec>+<token>" where codec selects the message codec for the connection,
+    see AnonSocketHandler.negotiable_codecs. Tokens never contain "+".
+    :return: tuple of codec name (None if there isn't one) and token
+    """
+    codec, sep, token = subprotocol.partition('+')
+    if not sep:
+        return None, subprotocol
+    return codec, token
 
 
 class AnonSocketHandler(tornado.websocket.WebSocketHandler):
@@ -71,19 +33,80 @@ class AnonSocketHandler(tornado.websocket.WebSocketHandler):
     Child of tornado.websocket.WebSocketHandler, makes the following changes:
     * allow cross origin requests if DEBUG is true so dev separate servers can be used to run django and tornado ws.
     * store all handlers in AllClients to allow easy communication between different websockets.
+    * allow handlers to join and leave named groups of clients.
+    * limit the data waiting to be sent to slow clients, see the outbound_* attributes.
+    * ping clients periodically and close connections which stop responding, see heartbeat.
+    * refuse new connections while the process is overloaded, see shedding.LoadShedder.
+    * compress messages with permessage-deflate if the client supports it, see compression.
     """
     # user is always None in this class, it's included here for easy filtering of AllClients based on user value
     user = None
     # client added is used to indicate if the client has been added to AllClients
     _client_added = False
     _connection_allowed = True
+    # limits on messages waiting to be sent to the client, see settings for details
+    outbound_buffer_bytes = settings.WS_OUTBOUND_BUFFER_BYTES
+    outbound_max_bytes = settings.WS_OUTBOUND_MAX_BYTES
+    outbound_max_messages = settings.WS_OUTBOUND_MAX_MESSAGES
+    outbound_policy = settings.WS_OUTBOUND_POLICY
+    outbound_close_code = settings.WS_OUTBOUND_CLOSE_CODE
+    # whether data frames written close together are combined into one write, see settings.WS_COALESCE_WRITES
+    coalesce_writes = settings.WS_COALESCE_WRITES
+    coalesce_delay = settings.WS_COALESCE_DELAY
+    coalesce_max_bytes = settings.WS_COALESCE_MAX_BYTES
+    # whether the connection is pinged by the process's HeartbeatScheduler
+    heartbeat = bool(settings.WS_HEARTBEAT_INTERVAL)
+    # whether new connections are refused while the process is overloaded and how, see settings.WS_SHED_MODE
+    shed_load = True
+    shed_mode = settings.WS_SHED_MODE
+    # set in prepare if the connection is to be closed with 1013 "try again later" once open
+    _shed = False
+    # codecs clients may choose by offering "<codec>+<token>" subprotocols, see router.MessageRouterMixin
+    negotiable_codecs = ()
+    # permessage-deflate options: None or False to disable, a preset name or a dict, see settings.WS_COMPRESSION
+    compression = settings.WS_COMPRESSION
+
+    def initialize(self, compression=None):
+        """
+        :param compression: override the compression attribute, eg. from the options dict of a handler
+            definition in settings.WS_HANDLERS
+        """
+        if compression is not None:
+            self.compression = compression
+
+    def get_compression_options(self):
+        return compression_options(self.compression)
 
     def select_subprotocol(self, subprotocols):
+        """
+        Select the first subprotocol offered which doesn't include a codec or includes one in negotiable_codecs,
+        clients can offer one subprotocol for each codec they support in order of preference and find which
+        was chosen from the response.
+        """
         logger.debug('subprotocols: %r', subprotocols)
-        if subprotocols:
+        for subprotocol in subprotocols:
             # this is required to accept connection from authenticated users where the auth token
             # is supplied as a subprotocol, see below
-            return subprotocols[0]
+            codec, _ = split_subprotocol(subprotocol)
+            if codec is None or codec in self.negotiable_codecs:
+                if codec is not None:
+                    self.codec = codec
+                return subprotocol
+
+    def prepare(self):
+        """
+        Check load before anything else is done with the handshake, in "http" mode overloaded requests are
+        finished here with 503 so they cost as little as possible and are never upgraded.
+        """
+        if not self.shed_load or not load_shedder.check():
+            return
+        if self.shed_mode == 'close':
+            self._shed = True
+            return
+        handshakes_rejected[503] += 1
+        self.set_status(503)
+        self.set_header('Retry-After', str(settings.WS_SHED_RETRY_AFTER))
+        self.finish('server overloaded, try again later')
 
     def check_origin(self, origin):
         """
@@ -98,9 +121,20 @@ class AnonSocketHandler(tornado.websocket.WebSocketHandler):
 
     def open(self):
         logger.debug('new connection, allowed: %r', self._connection_allowed)
-        if self._connection_allowed:
+        if self._shed:
+            handshakes_rejected[1013] += 1
+            self.close(1013, 'try again later')
+        elif self._connection_allowed:
             all_clients.append(self)
             self._client_added = True
+            handshakes_accepted[self.__class__.__name__] += 1
+            if self.heartbeat:
+                get_heartbeat_scheduler().add(self)
+
+    def get_websocket_protocol(self):
+        websocket_version = self.request.headers.get('Sec-WebSocket-Version')
+        if websocket_version in ('7', '8', '13'):
+            return WebSocketProtocol(self, compression_options=self.get_compression_options())
 
     def close(self, code=None, reason=None):
         logger.debug('closing connection, close code: %r, close reason: %r', code, reason)
@@ -109,6 +143,24 @@ class AnonSocketHandler(tornado.websocket.WebSocketHandler):
     def on_close(self):
         logger.debug('client disconnected, close code: %r, close reason: %r', self.close_code, self.close_reason)
         all_clients.remove(self, not self._client_added)
+        if self.heartbeat:
+            get_heartbeat_scheduler().remove(self)
+
+    def on_heartbeat_rtt(self, rtt):
+        """
+        Called with the round trip time (in seconds) of each heartbeat ping, see metrics.rtt_histograms.
+        """
+        record_rtt(self, rtt * 1000)
+
+    def join_group(self, name):
+        """
+        Join a named group, see AllClients.group_send. Groups are left automatically when the client disconnects.
+        :param name: group name
+        """
+        all_clients.join(self, name)
+
+    def leave_group(self, name):
+        all_clients.leave(self, name)
 
     def safe_write_message(self, data):
         """
@@ -124,8 +176,14 @@ class AuthSocketHandler(AnonSocketHandler):
     """
     Child of AnonSocketHandler and therefore tornado.websocket.WebSocketHandler which authenticates
     the client via a token passed via a subprotocol.
+
+    The token is checked in a thread before the connection is accepted, so handshakes waiting on the database
+    don't block the IOLoop. Clients without a valid token get an HTTP 400, 401 or 403 response instead of
+    being upgraded, see get.
     """
     _connection_allowed = False
+    # result of checking the token, set in get before the connection is accepted
+    _token_user = False
 
     def _get_ip_address(self):
         # we have to do this as self.request is pretty flaky about giving up it's attributes
@@ -137,35 +195,81 @@ class AuthSocketHandler(AnonSocketHandler):
         else:
             return request_dict.get('remote_ip')
 
-    def select_subprotocol(self, subprotocols):
-        ip_address = self._get_ip_address()
-        logger.debug('select_subprotocol, subprotocols: %r, ip address: %s', subprotocols, ip_address)
-        if len(subprotocols) != 1:
-            self.close(1002, 'exactly one sub-protocol should be provided')
-            return
-        token = subprotocols[0]
-        if token == '':
-            # TODO, is there a better code to use?
-            self.close(2000, 'permission denied - no token supplied')
-            return
-        if token in {'null', 'anon'}:
-            # TODO, is there a better code to use?
-            self.close(2001, 'permission denied - anonymous users not permitted to connect to this socket')
-        user = check_token_get_user(token, ip_address)
-        if not user:
-            self.close(2002, 'permission denied - invalid token')
+    @tornado.gen.coroutine
+    def get(self, *args, **kwargs):
+        """
+        Check the token before tornado accepts the connection. The request stays pending until the check in
+        auth.check_token_get_user_async completes, requests without a valid token are refused with an HTTP
+        error so they're never upgraded.
+
+        Several subprotocols may be offered to negotiate a codec (see AnonSocketHandler.select_subprotocol)
+        but they must all have the same token.
+        """
+        error = self._upgrade_error()
+        if error:
+            self._reject(*error)
             return
-        logger.debug('new valid connection from %s at %s' % (user, ip_address))
-        self.user = user
+        if not self._shed:
+            subprotocols = [s.strip() for s in self.request.headers.get('Sec-WebSocket-Protocol', '').split(',')]
+            offered = [split_subprotocol(s) for s in subprotocols]
+            tokens = {token for _, token in offered}
+            if len(tokens) != 1:
+                self._reject(400, 'exactly one token should be provided')
+                return
+            if not any(codec is None or codec in self.negotiable_codecs for codec, _ in offered):
+                self._reject(400, 'no supported sub-protocol offered')
+                return
+            token = tokens.pop()
+            if token == '':
+                self._reject(401, 'permission denied - no token supplied')
+                return
+            if token in {'null', 'anon'}:
+                self._reject(403, 'permission denied - anonymous users not permitted to connect to this socket')
+                return
+            self._token_user = yield check_token_get_user_async(token, self._get_ip_address())
+            if not self._token_user:
+                self._reject(401, 'permission denied - invalid token')
+                return
+        super(AuthSocketHandler, self).get(*args, **kwargs)
+
+    def _upgrade_error(self):
+        """
+        The header and origin checks tornado makes before upgrading, made here before the token is checked so
+        requests which would never be upgraded don't cost a database query.
+        :return: tuple of status and reason or None if the request can be upgraded
+        """
+        headers = self.request.headers
+        if headers.get('Upgrade', '').lower() != 'websocket':
+            return 400, 'Can "Upgrade" only to "WebSocket".'
+        if 'upgrade' not in (s.strip().lower() for s in headers.get('Connection', '').split(',')):
+            return 400, '"Connection" must be "Upgrade".'
+        origin = headers.get('Origin', headers.get('Sec-Websocket-Origin'))
+        if origin is not None and not self.check_origin(origin):
+            return 403, 'Cross origin websockets not allowed'
+
+    def select_subprotocol(self, subprotocols):
+        if self._shed:
+            # the token wasn't checked, accept the connection so open can close it with 1013
+            return super(AuthSocketHandler, self).select_subprotocol(subprotocols)
+        # the token has already been checked in get
+        logger.debug('new valid connection from %s at %s', self._token_user, self._get_ip_address())
+        self.user = self._token_user
         self._connection_allowed = True
-        return token
+        return super(AuthSocketHandler, self).select_subprotocol(subprotocols)
+
+    def _reject(self, status, reason):
+        logger.debug('rejecting connection, status: %d, reason: %s', status, reason)
+        handshakes_rejected[status] += 1
+        self.set_status(status)
+        self.finish(reason)
 
 
 class PingPongMixin(object):
     """
     Mixin to check ping --> pong time on a websocket connection.
 
-    Override pong_time_handler to do something with the time found (in ms).
+    Times are recorded in metrics.rtt_histograms, override pong_time_handler to do something else with the time
+    found (in ms).
     """
     def ping_timer(self):
         if not self.ws_connection or self.ws_connection.client_terminated:
@@ -179,7 +283,8 @@ class PingPongMixin(object):
         self.pong_time_handler(response_time)
 
     def pong_time_handler(self, response_time):
-        logger.info('ping pong: %0.2fms' % response_time)
+        logger.debug('ping pong: %0.2fms', response_time)
+        record_rtt(self, response_time)
 
 
 class AnonEchoHandler(PingPongMixin, AnonSocketHandler):
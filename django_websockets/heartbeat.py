@@ -0,0 +1,169 @@
+"""
+Keepalive pings and dead peer detection for every connection in the process using one timer.
+
+Connections are spread over the slots of a timing wheel, each tick visits one slot and pings the connections in
+it, so each connection is pinged once per interval and the IOLoop only has one timer however many connections
+there are.
+"""
+import logging
+import struct
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from . import settings
+
+logger = logging.getLogger(settings.WS_LOGGER_NAME)
+
+# prefix of the payload of pings sent by the scheduler, followed by the ping's sequence number, used to tell their
+# pongs apart from others (eg. PingPongMixin's) in WebSocketProtocol
+HEARTBEAT_PING = b'hb'
+_SEQUENCE = struct.Struct('!I')
+HEARTBEAT_PING_LENGTH = len(HEARTBEAT_PING) + _SEQUENCE.size
+
+_scheduler = None
+
+
+def is_heartbeat_pong(data):
+    """
+    :param data: pong payload
+    :return: whether the pong answers a heartbeat ping
+    """
+    return len(data) == HEARTBEAT_PING_LENGTH and data.startswith(HEARTBEAT_PING)
+
+
+def get_heartbeat_scheduler():
+    """
+    :return: the process's HeartbeatScheduler, created on first use so it belongs to the IOLoop of the worker
+    """
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = HeartbeatScheduler()
+    return _scheduler
+
+
+class _Beat(object):
+    __slots__ = ('slot', 'sequence', 'sent', 'missed')
+
+    def __init__(self, slot):
+        self.slot = slot
+        # sequence number of the last ping sent
+        self.sequence = 0
+        # sequence number -> IOLoop time the ping was sent for unanswered pings
+        self.sent = {}
+        self.missed = 0
+
+
+class HeartbeatScheduler(object):
+    """
+    Timing wheel of interval / slots second ticks. Each connection is pinged every interval seconds,
+    a connection which hasn't answered max_missed pings in a row is closed.
+
+    Pong round trip times are measured from the ping each pong answers, reported to the handler's
+    on_heartbeat_rtt method (if it has one) and summarised in rtt_count, rtt_total and rtt_max (all in seconds).
+    """
+    def __init__(self, interval=None, slots=None, max_missed=None):
+        self.interval = interval or settings.WS_HEARTBEAT_INTERVAL
+        self.slots = slots or settings.WS_HEARTBEAT_SLOTS
+        self.max_missed = max_missed or settings.WS_HEARTBEAT_MAX_MISSED
+        self._wheel = [{} for _ in range(self.slots)]
+        self._beats = {}
+        self._position = 0
+        self._next_slot = 0
+        self._periodic = None
+        self.pings = 0
+        self.reaped = 0
+        self.rtt_count = 0
+        self.rtt_total = 0.0
+        self.rtt_max = 0.0
+
+    def add(self, h):
+        """
+        Start pinging a connection, connections are added to slots in turn so they're spread evenly.
+        :param h: handler
+        """
+        if h in self._beats:
+            return
+        slot = self._next_slot
+        self._next_slot = (slot + 1) % self.slots
+        self._beats[h] = self._wheel[slot][h] = _Beat(slot)
+        if self._periodic is None:
+            self.start()
+
+    def remove(self, h):
+        """
+        Stop pinging a connection, removing a connection which wasn't added has no effect.
+        The timer is stopped when the last connection is removed.
+        :param h: handler
+        """
+        beat = self._beats.pop(h, None)
+        if beat is not None:
+            del self._wheel[beat.slot][h]
+            if not self._beats:
+                # no need to tick with no connections, this also means the timer is always on the current IOLoop
+                self.stop()
+
+    def __len__(self):
+        return len(self._beats)
+
+    def __contains__(self, h):
+        return h in self._beats
+
+    def start(self):
+        self._periodic = PeriodicCallback(self.tick, self.interval * 1000 / self.slots)
+        self._periodic.start()
+
+    def stop(self):
+        if self._periodic is not None:
+            self._periodic.stop()
+            self._periodic = None
+
+    def tick(self):
+        """
+        Visit the next slot: close connections which have missed too many pings and ping the rest.
+        """
+        slot = self._wheel[self._position]
+        self._position = (self._position + 1) % self.slots
+        now = IOLoop.current().time()
+        for h, beat in list(slot.items()):
+            if beat.sent:
+                beat.missed += 1
+                if beat.missed >= self.max_missed:
+                    self.reap(h)
+                    continue
+            conn = h.ws_connection
+            if conn is None:
+                self.remove(h)
+                continue
+            beat.sequence = sequence = (beat.sequence + 1) % 0x100000000
+            beat.sent[sequence] = now
+            conn.write_ping(HEARTBEAT_PING + _SEQUENCE.pack(sequence))
+            self.pings += 1
+
+    def reap(self, h):
+        logger.info('closing connection, %d heartbeat pings unanswered', self.max_missed)
+        self.remove(h)
+        self.reaped += 1
+        h.close(settings.WS_HEARTBEAT_CLOSE_CODE, 'heartbeat timeout')
+
+    def pong(self, h, data):
+        """
+        Called when a connection answers a heartbeat ping, earlier pings which are still unanswered are
+        forgotten.
+        :param h: handler
+        :param data: pong payload, see is_heartbeat_pong
+        """
+        beat = self._beats.get(h)
+        if beat is None:
+            return
+        sent = beat.sent.get(_SEQUENCE.unpack_from(data, len(HEARTBEAT_PING))[0])
+        if sent is None:
+            return
+        rtt = IOLoop.current().time() - sent
+        beat.sent.clear()
+        beat.missed = 0
+        self.rtt_count += 1
+        self.rtt_total += rtt
+        self.rtt_max = max(self.rtt_max, rtt)
+        on_rtt = getattr(h, 'on_heartbeat_rtt', None)
+        if on_rtt is not None:
+            on_rtt(rtt)
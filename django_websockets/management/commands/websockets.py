@@ -5,12 +5,17 @@ from colorlog import ColoredFormatter
 import tornado
 from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+from tornado.process import cpu_count, fork_processes
 
 import django
-from django.core.management.base import BaseCommand
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand, CommandError
 
 from django_websockets import settings
 from django_websockets.app import get_app
+from django_websockets.watchdog import start_watchdog
 
 logger = logging.getLogger(settings.WS_LOGGER_NAME)
 if not logger.hasHandlers():
@@ -33,13 +38,42 @@ if not logger.hasHandlers():
     logger.addHandler(handler)
 
 
-def main(serve_django, port, verbosity, **other_options):
+class WorkerLogFilter(logging.Filter):
+    """
+    Prefix log messages with the id of the worker process.
+    """
+    def __init__(self, task_id):
+        super(WorkerLogFilter, self).__init__()
+        self.prefix = 'worker %d: ' % task_id
+
+    def filter(self, record):
+        record.msg = self.prefix + str(record.msg)
+        return True
+
+
+def main(serve_django, port, verbosity, workers=None, watchdog=None, **other_options):
     if port is None:
         port = os.getenv('PORT')
         if port is not None:
             port = int(port)
     if port is None:
         port = 8000 if serve_django else 8001
+    if workers is None:
+        workers = settings.WS_WORKERS
+    if watchdog is None:
+        watchdog = settings.WS_WATCHDOG
+    if workers <= 0:
+        workers = cpu_count()
+    if workers > 1 and settings.DEBUG:
+        raise CommandError("multiple workers can't be used with DEBUG = True since tornado's debug mode "
+                           "is not compatible with multiple processes")
+    if workers > 1 and not settings.WS_BACKPLANE:
+        logger.warning('WARNING: %d workers without settings.WS_BACKPLANE, broadcasts, group and user messages '
+                       'will only reach clients connected to the same worker', workers)
+    revocation_cache = settings.WS_TOKEN_REVOCATION_CACHE
+    if revocation_cache and isinstance(caches[revocation_cache], LocMemCache):
+        logger.warning('WARNING: settings.WS_TOKEN_REVOCATION_CACHE "%s" is a local memory cache, users saved by '
+                       'other processes will not revoke their claims tokens', revocation_cache)
     if verbosity >= 1:
         print(('\ndjango-websockets version %s\n'
                'Django version %s, Tornado version %s, using settings "%s"\n'
@@ -48,9 +82,16 @@ def main(serve_django, port, verbosity, **other_options):
                                                 tornado.version,
                                                 os.getenv('DJANGO_SETTINGS_MODULE', 'unknown'),
                                                 port))
-    app = get_app(serve_django)
-    http_server = HTTPServer(app)
-    _start_server(http_server, port)
+        if workers > 1:
+            print('Using %d worker processes' % workers)
+    if workers > 1:
+        _start_workers(serve_django, port, workers, watchdog)
+    else:
+        app = get_app(serve_django)
+        http_server = HTTPServer(app)
+        if watchdog:
+            start_watchdog(IOLoop.instance())
+        _start_server(http_server, port)
 
 
 def _start_server(http_server, port):
@@ -62,6 +103,26 @@ def _start_server(http_server, port):
     main_loop.start()
 
 
+def _start_workers(serve_django, port, workers, watchdog=False):
+    """
+    Bind the port once then fork worker processes which each run their own IOLoop and accept connections
+    from the shared socket, fork_processes restarts children which exit with an error.
+    """
+    sockets = bind_sockets(port)
+    # this only returns in the child processes
+    task_id = fork_processes(workers)
+    logger.addFilter(WorkerLogFilter(task_id))
+    logger.info('started, pid %d', os.getpid())
+    # the app has to be created after forking so anything created with it (eg. the backplane) isn't shared
+    app = get_app(serve_django)
+    http_server = HTTPServer(app)
+    http_server.add_sockets(sockets)
+    if watchdog:
+        # threads don't survive fork so each worker starts its own watchdog
+        start_watchdog(IOLoop.instance())
+    IOLoop.instance().start()
+
+
 class Command(BaseCommand):
     help = 'serve websockets and optionally django with tornado'
 
@@ -70,6 +131,12 @@ class Command(BaseCommand):
                             help='disable serving django')
         parser.add_argument('--port', default=None, action='store', type=int,
                             help="port to serve on, default to 8000 unless nodjango is set in which case it's 8001")
+        parser.add_argument('--workers', default=None, action='store', type=int,
+                            help='number of worker processes to fork, 0 for one per CPU, defaults to '
+                                 'settings.WS_WORKERS')
+        parser.add_argument('--watchdog', default=None, action='store_true',
+                            help='log the stack of the IOLoop thread when the loop is blocked, defaults to '
+                                 'settings.WS_WATCHDOG')
 
     def handle(self, *args, **options):
         try:
@@ -0,0 +1,36 @@
+from tornado.ioloop import IOLoop
+
+from django.core.management.base import BaseCommand
+
+from django_websockets import settings
+from django_websockets.backplane import BrokerServer
+
+
+def main(address, verbosity, **other_options):
+    address = address or settings.WS_BROKER_ADDRESS
+    if verbosity >= 1:
+        print('\ndjango-websockets broker, listening on %s' % address)
+    server = BrokerServer()
+    server.bind_address(address)
+    _start_server(server)
+
+
+def _start_server(server):
+    # split out to allow mocking
+    server.start()
+    IOLoop.instance().start()
+
+
+class Command(BaseCommand):
+    help = 'run the broker which relays messages between websockets processes using BrokerBackplane'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--address', default=None, action='store',
+                            help='address to listen on, "host:port" or "unix:/path/to/socket", '
+                                 'defaults to settings.WS_BROKER_ADDRESS')
+
+    def handle(self, *args, **options):
+        try:
+            main(**options)
+        except KeyboardInterrupt:  # pragma: no cover
+            print('KeyboardInterrupt')
@@ -0,0 +1,265 @@
+"""
+Fixed memory latency histograms, used to record ping round trip times (see PingPongMixin and heartbeat).
+
+Values are counted in logarithmically sized buckets (like HdrHistogram) so percentiles have a bounded relative
+error and memory doesn't grow with the number of samples. WindowedHistogram keeps several histograms covering
+consecutive slices of time so old samples age out.
+
+Counters here and in protocol and tokens are exposed by prometheus.MetricsHandler.
+"""
+import logging
+import math
+import time
+from collections import Counter
+
+from tornado.ioloop import IOLoop
+
+from . import settings
+
+logger = logging.getLogger(settings.WS_LOGGER_NAME)
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class LogHistogram(object):
+    """
+    Histogram of values between lowest and highest where each bucket is growth times wider than the last,
+    values outside that range are counted in the first or last bucket.
+    """
+    def __init__(self, lowest=0.01, highest=3600000, growth=1.05):
+        """
+        :param lowest: upper bound of the first bucket
+        :param highest: values above this are counted in the last bucket
+        :param growth: ratio between the bounds of consecutive buckets, this is the maximum relative error
+            of percentiles
+        """
+        self.lowest = lowest
+        self.highest = highest
+        self.growth = growth
+        self._log_growth = math.log(growth)
+        self.max_bucket = int(math.ceil(math.log(highest / lowest) / self._log_growth)) + 1
+        self.counts = [0] * (self.max_bucket + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def bucket(self, value):
+        if value <= self.lowest:
+            return 0
+        return min(int(math.log(value / self.lowest) / self._log_growth) + 1, self.max_bucket)
+
+    def bucket_upper(self, i):
+        return self.lowest * self.growth ** i
+
+    def record(self, value):
+        self.counts[self.bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """
+        Add the counts of another histogram with the same buckets to this one.
+        """
+        if other.count == 0:
+            return
+        for i, c in enumerate(other.counts):
+            if c:
+                self.counts[i] += c
+        self.count += other.count
+        self.total += other.total
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def clear(self):
+        self.counts = [0] * (self.max_bucket + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def percentile(self, p):
+        """
+        :param p: percentile between 0 and 100
+        :return: upper bound of the bucket containing the percentile (limited to the min and max values
+            recorded) or None if the histogram is empty
+        """
+        if not self.count:
+            return None
+        rank = max(int(math.ceil(p / 100 * self.count)), 1)
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                if i == self.max_bucket:
+                    # the last bucket has no upper bound
+                    return self.max
+                return min(max(self.bucket_upper(i), self.min), self.max)
+
+    def summary(self):
+        """
+        :return: dict of count, mean, min, max and the percentiles in PERCENTILES, eg. "p50" and "p999"
+        """
+        summary = {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+        }
+        for p in PERCENTILES:
+            summary['p' + str(p).replace('.', '')] = self.percentile(p)
+        return summary
+
+
+class WindowedHistogram(object):
+    """
+    LogHistogram of samples from the last window seconds, made up of slices histograms each covering
+    window / slices seconds, when a slice gets too old it's cleared and reused.
+    """
+    def __init__(self, window=None, slices=None, timer=time.monotonic, **histogram_kwargs):
+        self.window = window or settings.WS_METRICS_WINDOW
+        self.slices = slices or settings.WS_METRICS_WINDOW_SLICES
+        self.timer = timer
+        self._histogram_kwargs = histogram_kwargs
+        self._slices = [LogHistogram(**histogram_kwargs) for _ in range(self.slices)]
+        self._slice_length = self.window / self.slices
+        self._current = 0
+        self._slice_start = timer()
+
+    def _rotate(self):
+        now = self.timer()
+        if now - self._slice_start < self._slice_length:
+            return
+        if now - self._slice_start >= self.window:
+            for h in self._slices:
+                h.clear()
+            self._slice_start = now
+            return
+        while now - self._slice_start >= self._slice_length:
+            self._current = (self._current + 1) % self.slices
+            self._slices[self._current].clear()
+            self._slice_start += self._slice_length
+
+    def record(self, value):
+        self._rotate()
+        self._slices[self._current].record(value)
+
+    def snapshot(self):
+        """
+        :return: LogHistogram of all samples in the window
+        """
+        self._rotate()
+        h = LogHistogram(**self._histogram_kwargs)
+        for s in self._slices:
+            h.merge(s)
+        return h
+
+    def summary(self):
+        return self.snapshot().summary()
+
+
+# ping round trip times in milliseconds, keyed by handler class name or "all" for every handler in the process
+rtt_histograms = {}
+
+
+def record_rtt(h, response_time):
+    """
+    Record a ping round trip time in the process's histogram and, if settings.WS_RTT_PER_HANDLER is True,
+    the histogram for the handler's class.
+    :param h: handler
+    :param response_time: round trip time in milliseconds
+    """
+    names = ('all', h.__class__.__name__) if settings.WS_RTT_PER_HANDLER else ('all',)
+    for name in names:
+        histogram = rtt_histograms.get(name)
+        if histogram is None:
+            histogram = rtt_histograms[name] = WindowedHistogram()
+        histogram.record(response_time)
+
+
+# websocket connections accepted, keyed by handler class name
+handshakes_accepted = Counter()
+# websocket connections rejected during the handshake, keyed by close code
+handshakes_rejected = Counter()
+
+# cumulative "broadcasts", "recipients" and "seconds" of every AllClients send (broadcast, group_send, send_to_user
+# and delivery of backplane messages)
+broadcast_stats = Counter()
+# number of clients each message was written to and the time taken in milliseconds
+broadcast_fanout = WindowedHistogram()
+broadcast_duration = WindowedHistogram()
+
+
+def record_broadcast(recipients, duration):
+    """
+    :param recipients: number of clients the message was written to
+    :param duration: time taken in seconds
+    """
+    broadcast_stats['broadcasts'] += 1
+    broadcast_stats['recipients'] += recipients
+    broadcast_stats['seconds'] += duration
+    broadcast_fanout.record(recipients)
+    broadcast_duration.record(duration * 1000)
+
+
+# delay in milliseconds between when LoopLagMonitor's callbacks were due and when they ran
+loop_lag = WindowedHistogram()
+
+
+class LoopLagMonitor(object):
+    """
+    Measures IOLoop lag by scheduling a callback every interval seconds and recording how late it runs
+    in loop_lag.
+    """
+    def __init__(self, interval=None):
+        self.interval = interval or settings.WS_LOOP_LAG_INTERVAL
+        self.io_loop = None
+        self._timeout = None
+        self._due = None
+        # lag found by the most recent check in seconds
+        self.lag = None
+
+    def start(self, io_loop=None):
+        self.stop()
+        self.io_loop = io_loop or IOLoop.current()
+        self._schedule()
+
+    def stop(self):
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+
+    def _schedule(self):
+        self._due = self.io_loop.time() + self.interval
+        self._timeout = self.io_loop.add_timeout(self._due, self._check)
+
+    def _check(self):
+        self.lag = lag = max(self.io_loop.time() - self._due, 0)
+        loop_lag.record(lag * 1000)
+        self.on_lag(lag)
+        self._schedule()
+
+    def on_lag(self, lag):
+        """
+        Called with the lag in seconds after each check, override to act on it.
+        """
+        pass
+
+
+_loop_lag_monitor = None
+
+
+def start_loop_lag_monitor():
+    """
+    Start measuring lag of the current IOLoop, if the monitor is already running on this IOLoop nothing is changed.
+    """
+    global _loop_lag_monitor
+    if _loop_lag_monitor is None:
+        _loop_lag_monitor = LoopLagMonitor()
+    if _loop_lag_monitor.io_loop is not IOLoop.current() or _loop_lag_monitor._timeout is None:
+        _loop_lag_monitor.start()
+    return _loop_lag_monitor
@@ -0,0 +1,155 @@
+"""
+Expose metrics in prometheus' text format, see settings.WS_METRICS_URL.
+
+Everything here is calculated when metrics are requested, the counters updated while serving connections
+are plain Counters and histograms.
+"""
+import tornado.web
+
+from . import heartbeat
+from .clients import all_clients
+from .metrics import (broadcast_duration, broadcast_fanout, broadcast_stats, handshakes_accepted, handshakes_rejected,
+                      loop_lag, rtt_histograms, PERCENTILES)
+from .protocol import slow_consumer_stats, traffic_stats
+from .shedding import load_shedder
+from .tokens import issued_token_cache, rejected_token_cache, rejected_tokens, token_cache
+from .watchdog import watchdog_stats
+
+PREFIX = 'djws_'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+class MetricsWriter(object):
+    """
+    Builds the text exposition format, one call to metric per metric family.
+    """
+    def __init__(self):
+        self.lines = []
+
+    def metric(self, name, metric_type, help_text, samples):
+        """
+        :param name: metric name without PREFIX
+        :param metric_type: "counter", "gauge" or "summary"
+        :param help_text: description of the metric
+        :param samples: list of (labels dict, value) or (suffix, labels dict, value) tuples
+        """
+        name = PREFIX + name
+        self.lines.append('# HELP %s %s' % (name, help_text))
+        self.lines.append('# TYPE %s %s' % (name, metric_type))
+        for sample in samples:
+            suffix, labels, value = sample if len(sample) == 3 else ('',) + sample
+            if value is None:
+                continue
+            if labels:
+                label_str = ','.join('%s="%s"' % (k, _escape(v)) for k, v in sorted(labels.items()))
+                self.lines.append('%s%s{%s} %s' % (name, suffix, label_str, _format_value(value)))
+            else:
+                self.lines.append('%s%s %s' % (name, suffix, _format_value(value)))
+
+    def summary(self, name, help_text, windowed_histograms, count=None, total=None):
+        """
+        Add a summary with quantiles from the last window of one or more WindowedHistograms.
+        :param windowed_histograms: list of (labels dict, WindowedHistogram)
+        :param count: cumulative count, optional
+        :param total: cumulative sum, optional
+        """
+        samples = []
+        for labels, windowed in windowed_histograms:
+            histogram = windowed.snapshot()
+            for p in PERCENTILES:
+                samples.append((dict(labels, quantile=p / 100), histogram.percentile(p)))
+        if count is not None:
+            samples += [('_sum', {}, total), ('_count', {}, count)]
+        self.metric(name, 'summary', help_text, samples)
+
+    def render(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def render_metrics():
+    """
+    :return: all metrics as a string in prometheus' text exposition format
+    """
+    w = MetricsWriter()
+
+    connections = {}
+    for auth, clients in (('auth', all_clients.auth_clients), ('anon', all_clients.anon_clients)):
+        for h in clients:
+            key = h.__class__.__name__, auth
+            connections[key] = connections.get(key, 0) + 1
+    w.metric('connections', 'gauge', 'Open websocket connections.',
+             [({'handler': handler, 'auth': auth}, n) for (handler, auth), n in sorted(connections.items())])
+    w.metric('groups', 'gauge', 'Groups with at least one member.', [({}, len(all_clients.groups))])
+
+    w.metric('handshakes_accepted_total', 'counter', 'Websocket connections accepted.',
+             [({'handler': k}, v) for k, v in sorted(handshakes_accepted.items())])
+    w.metric('handshakes_rejected_total', 'counter', 'Websocket connections rejected during the handshake.',
+             [({'code': k}, v) for k, v in sorted(handshakes_rejected.items())])
+    w.metric('shedding', 'gauge', 'Whether new connections are being refused because the process is overloaded.',
+             [({}, int(load_shedder.shedding))])
+
+    for name, help_text in (('messages', 'Websocket data messages.'),
+                            ('bytes', 'Websocket data bytes, including frame headers for outgoing messages.')):
+        w.metric(name + '_total', 'counter', help_text,
+                 [({'direction': d}, traffic_stats['%s_%s' % (name, d)]) for d in ('in', 'out')])
+    w.metric('writes_coalesced_total', 'counter', 'Data frames combined with earlier frames into one write.',
+             [({}, traffic_stats['writes_coalesced'])])
+    w.metric('slow_consumer_total', 'counter', 'Times an outbound policy was applied to a slow client.',
+             [({'policy': k}, v) for k, v in sorted(slow_consumer_stats.items())])
+
+    w.summary('broadcast_fanout', 'Clients each broadcast was written to.', [({}, broadcast_fanout)],
+              broadcast_stats['broadcasts'], broadcast_stats['recipients'])
+    w.summary('broadcast_duration_milliseconds', 'Time taken to write each broadcast to all clients.',
+              [({}, broadcast_duration)], broadcast_stats['broadcasts'], broadcast_stats['seconds'] * 1000)
+
+    caches = (('validated', token_cache), ('rejected', rejected_token_cache), ('issued', issued_token_cache))
+    for name, help_text in (('hits', 'hits'), ('misses', 'misses'), ('evictions', 'entries evicted')):
+        w.metric('token_cache_%s_total' % name, 'counter', 'Token cache %s.' % help_text,
+                 [({'cache': cache_name}, getattr(cache, name)) for cache_name, cache in caches])
+    w.metric('token_cache_size', 'gauge', 'Entries in token caches.',
+             [({'cache': cache_name}, len(cache)) for cache_name, cache in caches])
+    w.metric('tokens_rejected_total', 'counter', 'Tokens rejected by stage of validation.',
+             [({'stage': k}, v) for k, v in sorted(rejected_tokens.items())])
+
+    w.summary('loop_lag_milliseconds', 'Delay of IOLoop callbacks.', [({}, loop_lag)])
+    w.metric('loop_blocked_total', 'counter', 'Times the watchdog found the IOLoop blocked.',
+             [({}, watchdog_stats['blocked'])])
+    # the process wide histogram is exported on its own so summing the per handler series doesn't count samples twice
+    w.summary('ping_rtt_milliseconds', 'Ping round trip time of every handler.',
+              [({}, rtt_histograms['all'])] if 'all' in rtt_histograms else [])
+    w.summary('handler_ping_rtt_milliseconds', 'Ping round trip time by handler class, see WS_RTT_PER_HANDLER.',
+              [({'handler': k}, v) for k, v in sorted(rtt_histograms.items()) if k != 'all'])
+
+    scheduler = heartbeat._scheduler
+    if scheduler is not None:
+        w.metric('heartbeat_pings_total', 'counter', 'Heartbeat pings sent.', [({}, scheduler.pings)])
+        w.metric('heartbeat_reaped_total', 'counter', 'Connections closed for not answering heartbeat pings.',
+                 [({}, scheduler.reaped)])
+
+    backplane = all_clients.backplane
+    if backplane is not None:
+        w.metric('backplane_messages_total', 'counter', 'Messages published to and delivered from the backplane.',
+                 [({'direction': 'published'}, backplane.published), ({'direction': 'delivered'}, backplane.delivered)])
+        if hasattr(backplane, 'dropped'):
+            w.metric('backplane_dropped_total', 'counter',
+                     'Messages dropped because the broker was unreachable or not reading.', [({}, backplane.dropped)])
+    return w.render()
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+    Serves render_metrics(), mounted at settings.WS_METRICS_URL by get_app.
+    """
+    def get(self):
+        self.set_header('Content-Type', CONTENT_TYPE)
+        self.write(render_metrics())
@@ -0,0 +1,367 @@
+"""
+Low level websocket framing, used to encode and frame a message once and write the same bytes to many clients,
+and the per connection outbound queue which stops slow clients using unbounded memory.
+"""
+import logging
+import struct
+from collections import Counter, deque
+
+import tornado.escape
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.websocket import WebSocketProtocol13
+
+from .compression import COMPRESSION_DEFAULTS, acceptable_offer, negotiate
+from .heartbeat import get_heartbeat_scheduler, is_heartbeat_pong
+from . import settings
+
+logger = logging.getLogger(settings.WS_LOGGER_NAME)
+
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+# control frames (close, ping, pong) all have this bit set in their opcode
+OPCODE_CONTROL = 0x8
+OPCODE_CLOSE = 0x8
+OPCODE_PONG = 0xA
+
+OUTBOUND_POLICIES = ('drop_oldest', 'drop_newest', 'coalesce', 'close')
+
+# number of times each outbound policy has been applied to a slow client, keyed by policy name
+slow_consumer_stats = Counter()
+
+# data messages and their wire bytes received ("messages_in", "bytes_in") and sent ("messages_out", "bytes_out")
+# by every connection, messages queued for slow clients are counted as sent. "writes_coalesced" counts frames
+# which were combined with earlier frames into one stream write rather than written on their own
+traffic_stats = Counter()
+
+# bytes waiting to be sent by every connection: "queued" in outbound queues and "buffered" in the streams' write
+# buffers. Write buffers are sampled by each connection when it writes and once the buffer has been flushed, so
+# the total is kept without visiting every connection, see shedding.LoadShedder
+outbound_bytes = Counter()
+
+
+def encode_message(message, binary=False):
+    """
+    Encode a message the same way tornado.websocket.WebSocketHandler.write_message does.
+    :param message: str, bytes or dict (which will be encoded as json)
+    :param binary: whether the message should be sent as a binary frame
+    :return: tuple of opcode and payload bytes
+    """
+    if isinstance(message, dict):
+        message = tornado.escape.json_encode(message)
+    return (OPCODE_BINARY if binary else OPCODE_TEXT), tornado.escape.utf8(message)
+
+
+def build_frame(opcode, data, flags=0, fin=True):
+    """
+    Build an unmasked (server to client) websocket frame.
+    :param opcode: frame opcode
+    :param data: payload bytes
+    :param flags: RSV bits, eg. RSV1 for compressed frames
+    :param fin: whether this is the final frame of a message
+    :return: frame bytes
+    """
+    first = (WebSocketProtocol13.FIN if fin else 0) | opcode | flags
+    length = len(data)
+    if length < 126:
+        header = struct.pack('BB', first, length)
+    elif length <= 0xFFFF:
+        header = struct.pack('!BBH', first, 126, length)
+    else:
+        header = struct.pack('!BBQ', first, 127, length)
+    return header + data
+
+
+class _HeldFrame(object):
+    __slots__ = ('frame', 'ready')
+
+    def __init__(self, frame=None):
+        self.frame = frame
+        self.ready = frame is not None
+
+
+class WebSocketProtocol(WebSocketProtocol13):
+    """
+    Child of tornado.websocket.WebSocketProtocol13 which routes every outgoing frame through write_frame,
+    so frames built by tornado and frames built once for many clients (see AllClients.broadcast) share
+    a single write path.
+
+    permessage-deflate is negotiated with the options returned by handler.get_compression_options, see
+    compression.COMPRESSION_DEFAULTS.
+
+    Once the stream's write buffer holds more than handler.outbound_buffer_bytes, data frames are held in a
+    queue limited by handler.outbound_max_messages and handler.outbound_max_bytes, handler.outbound_policy
+    decides what happens when those limits are reached. Control frames are never queued or dropped.
+
+    If handler.coalesce_writes is True data frames are collected and written to the stream together, after
+    handler.coalesce_delay seconds (or on the next IOLoop iteration if it's 0) or once handler.coalesce_max_bytes
+    are waiting, so bursts of small messages cost one write (and usually one send syscall).
+
+    A place for a data frame which is still being built (eg. compressed in a thread) can be reserved with hold,
+    later data frames wait behind it until it's released so messages are always sent in order.
+    """
+    def __init__(self, handler, mask_outgoing=False, compression_options=None):
+        super(WebSocketProtocol, self).__init__(handler, mask_outgoing, compression_options)
+        if handler.outbound_policy not in OUTBOUND_POLICIES:
+            raise ValueError('invalid outbound_policy %r, should be one of %s' %
+                             (handler.outbound_policy, ', '.join(OUTBOUND_POLICIES)))
+        self._queue = deque()
+        self._queue_bytes = 0
+        self._buffered_bytes = 0
+        self._compress_min_size = 0
+        self._held = deque()
+        self._coalesced = []
+        self._coalesced_bytes = 0
+        self._coalesce_timeout = None
+
+    def _create_compressors(self, side, agreed_parameters):
+        # handlers may return tornado's {} from get_compression_options, treat that as the defaults
+        options = dict(COMPRESSION_DEFAULTS, **self._compression_options)
+        compressor = negotiate(options, agreed_parameters)
+        super(WebSocketProtocol, self)._create_compressors(side, agreed_parameters)
+        self._compressor = compressor
+        self._compress_min_size = options['min_size']
+
+    def _parse_extensions_header(self, headers):
+        # offers negotiate can't accept are removed so tornado uses the next one or doesn't compress
+        extensions = super(WebSocketProtocol, self)._parse_extensions_header(headers)
+        return [ext for ext in extensions if ext[0] != 'permessage-deflate' or acceptable_offer(ext[1])]
+
+    def _compresses(self, data):
+        return self._compressor is not None and len(data) >= self._compress_min_size
+
+    def stateless_compressor(self, data):
+        """
+        :param data: message payload
+        :return: the compressor if this message would be compressed without context takeover, so the compressed
+            frame can be shared with other connections, else None
+        """
+        if self._compresses(data) and not self._compressor.persistent:
+            return self._compressor
+
+    def write_message(self, message, binary=False):
+        """
+        Equivalent of WebSocketProtocol13.write_message except messages smaller than the "min_size"
+        compression option are sent uncompressed.
+        """
+        message = tornado.escape.utf8(message)
+        assert isinstance(message, bytes)
+        self._message_bytes_out += len(message)
+        flags = 0
+        if self._compresses(message):
+            message = self._compressor.compress(message)
+            flags |= self.RSV1
+        self._write_frame(True, OPCODE_BINARY if binary else OPCODE_TEXT, message, flags=flags)
+
+    def _write_frame(self, fin, opcode, data, flags=0):
+        if self.mask_outgoing:
+            # client connections must mask every frame so can't share frames, this is never the case for handlers
+            return super(WebSocketProtocol, self)._write_frame(fin, opcode, data, flags)
+        frame = build_frame(opcode, data, flags, fin)
+        if opcode & OPCODE_CONTROL:
+            # pings can overtake waiting data frames but the close frame must be the last frame sent
+            if opcode == OPCODE_CLOSE:
+                self._flush_coalesced()
+                # frames reserved with hold will never be released
+                self._held.clear()
+                if self._queue:
+                    self._queue.append(frame)
+                    self._count_queued(len(frame))
+                    return
+            self._write_stream(frame)
+        else:
+            self.write_frame(frame)
+
+    def write_frame(self, frame):
+        """
+        Write a complete data frame to the stream, or queue it if the client isn't keeping up or frames
+        reserved with hold are waiting to be released.
+        :param frame: frame bytes as returned by build_frame
+        """
+        if self.server_terminated:
+            # the close frame has been written (or queued), nothing may follow it
+            return
+        if self._held:
+            self._held.append(_HeldFrame(frame))
+        else:
+            self._send_frame(frame)
+
+    def hold(self):
+        """
+        Reserve a place for a data frame, data frames written after this are held until it's released.
+        :return: _HeldFrame to pass to release
+        """
+        held = _HeldFrame()
+        self._held.append(held)
+        return held
+
+    def release(self, held, frame, data_length=0):
+        """
+        Fill a place reserved by hold and send it and any frames waiting behind it.
+        :param held: as returned by hold
+        :param frame: frame bytes or None to send nothing in its place
+        :param data_length: length of the uncompressed payload the frame contains
+        """
+        if self.server_terminated:
+            # the close frame has been written so held frames were discarded
+            return
+        if frame is not None:
+            self._message_bytes_out += data_length
+        held.frame = frame
+        held.ready = True
+        while self._held and self._held[0].ready:
+            frame = self._held.popleft().frame
+            if frame is not None and not self.stream.closed():
+                self._send_frame(frame)
+
+    def _send_frame(self, frame):
+        traffic_stats['messages_out'] += 1
+        traffic_stats['bytes_out'] += len(frame)
+        if self._queue or self._stream_buffer_size() + self._coalesced_bytes > self.handler.outbound_buffer_bytes:
+            # coalesced frames must be written before the queue starts flushing
+            self._flush_coalesced()
+            self._enqueue(frame)
+        elif self.handler.coalesce_writes:
+            self._coalesce(frame)
+        else:
+            self._write_stream(frame)
+
+    def _coalesce(self, frame):
+        self._coalesced.append(frame)
+        self._coalesced_bytes += len(frame)
+        if self._coalesced_bytes >= self.handler.coalesce_max_bytes:
+            self._flush_coalesced()
+        elif self._coalesce_timeout is None:
+            io_loop = IOLoop.current()
+            delay = self.handler.coalesce_delay
+            if delay:
+                self._coalesce_timeout = io_loop.add_timeout(io_loop.time() + delay, self._flush_coalesced)
+            else:
+                # callbacks can't be cancelled, if the frames are flushed sooner this just finds nothing to write
+                self._coalesce_timeout = True
+                io_loop.add_callback(self._flush_coalesced)
+
+    def _flush_coalesced(self):
+        if self._coalesce_timeout not in (None, True):
+            IOLoop.current().remove_timeout(self._coalesce_timeout)
+        self._coalesce_timeout = None
+        if not self._coalesced:
+            return
+        frames = self._coalesced
+        self._coalesced = []
+        self._coalesced_bytes = 0
+        traffic_stats['writes_coalesced'] += len(frames) - 1
+        if not self.stream.closed():
+            self._write_stream(frames[0] if len(frames) == 1 else b''.join(frames))
+
+    def _handle_message(self, opcode, data):
+        if not opcode & OPCODE_CONTROL:
+            traffic_stats['messages_in'] += 1
+            traffic_stats['bytes_in'] += len(data)
+        elif opcode == OPCODE_PONG and is_heartbeat_pong(data):
+            # handled here rather than in on_pong so handlers overriding on_pong can't break heartbeats
+            get_heartbeat_scheduler().pong(self.handler, data)
+            return
+        return super(WebSocketProtocol, self)._handle_message(opcode, data)
+
+    @property
+    def queued_messages(self):
+        return len(self._queue)
+
+    @property
+    def queued_bytes(self):
+        return self._queue_bytes
+
+    def _stream_buffer_size(self):
+        # tornado doesn't expose the size of the write buffer so we have to use this private attribute
+        return self.stream._write_buffer_size
+
+    def _write_stream(self, frame, callback=None):
+        self._wire_bytes_out += len(frame)
+        try:
+            future = self.stream.write(frame, callback)
+        except StreamClosedError:
+            self._abort()
+            return
+        self._sample_buffer()
+        if future is not None and self._buffered_bytes:
+            # sample again once the buffer has been flushed so idle connections don't leave a stale size
+            future.add_done_callback(self._sample_buffer)
+
+    def _sample_buffer(self, future=None):
+        size = 0 if self.stream.closed() else self._stream_buffer_size()
+        outbound_bytes['buffered'] += size - self._buffered_bytes
+        self._buffered_bytes = size
+
+    def _count_queued(self, size):
+        self._queue_bytes += size
+        outbound_bytes['queued'] += size
+
+    def _abort(self):
+        # nothing waiting will be sent once the stream is closed
+        self._clear_queue()
+        super(WebSocketProtocol, self)._abort()
+        self._sample_buffer()
+
+    def _enqueue(self, frame):
+        h = self.handler
+        if len(self._queue) >= h.outbound_max_messages or self._queue_bytes + len(frame) > h.outbound_max_bytes:
+            policy = h.outbound_policy
+            slow_consumer_stats[policy] += 1
+            logger.debug('slow client, %d messages %d bytes queued, applying "%s"',
+                         len(self._queue), self._queue_bytes, policy)
+            if policy == 'drop_newest':
+                return
+            elif policy == 'close':
+                self._clear_queue()
+                h.close(h.outbound_close_code, 'client too slow')
+                return
+            elif policy == 'coalesce':
+                self._clear_queue()
+            else:
+                while self._queue and (len(self._queue) >= h.outbound_max_messages or
+                                       self._queue_bytes + len(frame) > h.outbound_max_bytes):
+                    self._count_queued(-len(self._queue.popleft()))
+
+        self._queue.append(frame)
+        self._count_queued(len(frame))
+        if len(self._queue) == 1:
+            # flush the queue once the stream's write buffer is empty
+            self._write_stream(b'', self._flush_queue)
+
+    def _flush_queue(self):
+        limit = self.handler.outbound_buffer_bytes
+        while self._queue and not self.stream.closed():
+            frame = self._queue.popleft()
+            self._count_queued(-len(frame))
+            if self._queue and self._stream_buffer_size() + len(frame) > limit:
+                self._write_stream(frame, self._flush_queue)
+                return
+            self._write_stream(frame)
+
+    def _clear_queue(self):
+        self._queue.clear()
+        self._count_queued(-self._queue_bytes)
+
+    def write_shared(self, data, frame):
+        """
+        Write a frame built once for many connections.
+        :param data: uncompressed payload the frame contains
+        :param frame: frame bytes
+        """
+        self._message_bytes_out += len(data)
+        self.write_frame(frame)
+
+    def write_prepared(self, opcode, data, frame):
+        """
+        Write a message which has already been encoded and framed, if permessage-deflate has been negotiated
+        the frame can't be shared and the message is compressed and framed for this connection (unless it's
+        smaller than the "min_size" compression option).
+        :param opcode: frame opcode
+        :param data: payload bytes
+        :param frame: frame bytes as returned by build_frame(opcode, data)
+        """
+        if self._compresses(data):
+            self.write_message(data, binary=opcode == OPCODE_BINARY)
+        else:
+            self.write_shared(data, frame)
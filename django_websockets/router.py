@@ -0,0 +1,238 @@
+"""
+Typed messages: each message is an object with a type field, MessageRouterMixin decodes it once and calls the
+method registered for that type with message_handler.
+
+Messages are decoded and encoded by a codec, see settings.WS_MESSAGE_CODEC. Clients can also choose a codec
+from negotiable_codecs per connection by offering "<codec>+<token>" subprotocols, eg. in javascript:
+
+    ws = new WebSocket(url, ['msgpack+' + token, token]);
+    ws.binaryType = 'arraybuffer';
+    ws.onopen = function () { var binary = ws.protocol != token; };
+"""
+import json
+import logging
+from collections import Counter
+
+from django.utils.module_loading import import_string
+
+from .clients import all_clients
+from . import settings
+
+logger = logging.getLogger(settings.WS_LOGGER_NAME)
+
+# "routed": messages passed to a handler method, "invalid": messages rejected before reaching one
+router_stats = Counter()
+
+
+class JsonCodec(object):
+    """
+    json using the standard library.
+    """
+    name = 'json'
+    # whether encoded messages should be sent as binary frames
+    binary = False
+
+    def decode(self, data):
+        """
+        :param data: str or bytes
+        :return: decoded message, raises ValueError if data is invalid
+        """
+        if isinstance(data, bytes):
+            data = data.decode()
+        return json.loads(data)
+
+    def encode(self, msg):
+        return json.dumps(msg, separators=(',', ':'))
+
+
+class OrjsonCodec(object):
+    """
+    json using orjson which is several times faster than the standard library, orjson must be installed.
+    """
+    name = 'orjson'
+    binary = False
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def decode(self, data):
+        # orjson.JSONDecodeError is a ValueError
+        return self._orjson.loads(data)
+
+    def encode(self, msg):
+        return self._orjson.dumps(msg)
+
+
+class MsgpackCodec(object):
+    """
+    MessagePack sent as binary frames, msgpack must be installed.
+    """
+    name = 'msgpack'
+    binary = True
+
+    def __init__(self):
+        import msgpack
+        self._msgpack = msgpack
+        # raw=False was added in 0.5.2, older versions (the last to support python 3.4) decode str with encoding
+        self._unpack_options = {'raw': False} if msgpack.version >= (0, 5, 2) else {'encoding': 'utf-8'}
+
+    def decode(self, data):
+        """
+        :param data: bytes, or a memoryview of them which msgpack reads without copying
+        :return: decoded message, raises ValueError if data is invalid
+        """
+        if isinstance(data, str):
+            data = data.encode()
+        try:
+            return self._msgpack.unpackb(data, **self._unpack_options)
+        except Exception as e:
+            # msgpack raises a variety of exceptions for invalid data
+            raise ValueError('invalid msgpack: %s' % e)
+
+    def encode(self, msg):
+        return self._msgpack.packb(msg, use_bin_type=True)
+
+
+CODECS = {
+    'json': JsonCodec,
+    'orjson': OrjsonCodec,
+    'msgpack': MsgpackCodec,
+}
+
+_codecs = {}
+
+
+def get_codec(codec):
+    """
+    :param codec: name from CODECS or dotted path of a codec class
+    :return: codec instance, created on first use and shared after that
+    """
+    instance = _codecs.get(codec)
+    if instance is None:
+        codec_cls = CODECS[codec] if codec in CODECS else import_string(codec)
+        instance = _codecs[codec] = codec_cls()
+    return instance
+
+
+def message_handler(*message_types):
+    """
+    Decorator registering a MessageRouterMixin method as the handler for one or more message types. The method
+    is called with the decoded message, if it returns anything other than None that's sent as the reply.
+    """
+    def decorator(method):
+        method.message_types = message_types
+        return method
+    return decorator
+
+
+class MessageRouterMixin(object):
+    """
+    Mixin for AnonSocketHandler (and therefore AuthSocketHandler) which dispatches messages to methods by their
+    type field, eg.
+
+        class ChatHandler(MessageRouterMixin, AuthSocketHandler):
+            @message_handler('chat')
+            def on_chat(self, msg):
+                self.broadcast_message({'type': 'chat', 'user': self.user.username, 'text': msg['text']})
+
+    Messages which are too large, can't be decoded, aren't objects or have an unknown type are passed to
+    on_invalid_message without calling any other handler code.
+    """
+    type_field = 'type'
+    # codec used unless the client chose one of negotiable_codecs, this is set per connection when it does
+    codec = settings.WS_MESSAGE_CODEC
+    negotiable_codecs = settings.WS_MESSAGE_NEGOTIABLE_CODECS
+    # in bytes, text messages are limited by the size of their utf-8 encoding
+    max_message_size = settings.WS_MESSAGE_MAX_SIZE
+
+    @classmethod
+    def get_routes(cls):
+        """
+        :return: dict of message type -> method name, built once per class from message_handler methods
+        """
+        routes = cls.__dict__.get('_routes')
+        if routes is None:
+            routes = {}
+            # walk the mro from the base classes down so subclasses' handlers win
+            for klass in reversed(cls.__mro__):
+                for name, attr in vars(klass).items():
+                    for message_type in getattr(attr, 'message_types', ()):
+                        routes[message_type] = name
+            cls._routes = routes
+        return routes
+
+    def get_codec(self):
+        return get_codec(self.codec)
+
+    def on_message(self, data):
+        size = len(data)
+        if isinstance(data, str) and size * 4 > self.max_message_size >= size:
+            # utf-8 uses at most 4 bytes per character so text is only encoded if it might be too large
+            size = len(data.encode())
+        if size > self.max_message_size:
+            return self._invalid(data, 'message too large')
+        codec = self.get_codec()
+        if codec.binary and isinstance(data, bytes):
+            # binary codecs are given a view of the frame's payload rather than a copy
+            data = memoryview(data)
+        try:
+            msg = codec.decode(data)
+        except (ValueError, RuntimeError):
+            # deeply nested messages make json raise RecursionError, a RuntimeError
+            return self._invalid(data, 'invalid %s' % codec.name)
+        if not isinstance(msg, dict):
+            return self._invalid(data, 'message is not an object')
+        message_type = msg.get(self.type_field)
+        method_name = self.get_routes().get(message_type) if isinstance(message_type, str) else None
+        if method_name is None:
+            return self._invalid(data, 'unknown message type')
+        router_stats['routed'] += 1
+        reply = getattr(self, method_name)(msg)
+        if reply is not None:
+            self.send_message(reply)
+
+    def _invalid(self, data, reason):
+        router_stats['invalid'] += 1
+        logger.debug('invalid message: %s', reason)
+        self.on_invalid_message(data, reason)
+
+    def on_invalid_message(self, data, reason):
+        """
+        Called with messages which can't be routed, by default an error message is sent to the client.
+        :param data: raw message
+        :param reason: description of the problem
+        """
+        self.send_message({self.type_field: 'error', 'error': reason})
+
+    def send_message(self, msg):
+        """
+        Encode a message with the handler's codec and send it to this client.
+        :param msg: message, usually a dict with a type field
+        """
+        if self.ws_connection is not None:
+            codec = self.get_codec()
+            self.write_message(codec.encode(msg), binary=codec.binary)
+
+    def broadcast_message(self, msg, predicate=None, **kwargs):
+        """
+        Send a message to every client, see AllClients.broadcast. The message is encoded once for each codec
+        clients might be using: the class's default codec and negotiable_codecs.
+
+        If codecs can be negotiated each encoding is sent with AllClients.codec_broadcast to the clients using
+        that codec (clients which aren't routers get the default codec), so it's still published to the backplane
+        unless there's a predicate.
+        :param msg: message, usually a dict with a type field
+        :param predicate: optional function called with each client, the message is only sent if it returns True
+        :return: number of clients the message was sent to
+        """
+        default = type(self).codec
+        if not self.negotiable_codecs:
+            codec = get_codec(default)
+            return all_clients.broadcast(codec.encode(msg), predicate=predicate, binary=codec.binary, **kwargs)
+        sent = 0
+        for name in (default,) + tuple(c for c in self.negotiable_codecs if c != default):
+            codec = get_codec(name)
+            sent += all_clients.codec_broadcast(name, codec.encode(msg), default=name == default, predicate=predicate,
+                                                binary=codec.binary, **kwargs)
+        return sent
@@ -8,6 +8,41 @@ WSGI_APPLICATION = settings.WSGI_APPLICATION
 # dictates how long after a websocket authentication token has been generated it will expire
 TOKEN_VALIDITY_SECONDS = getattr(settings, 'TOKEN_VALIDITY_SECONDS', 86400)
 
+# tokens rendered by the websocket_info template tag are reused for up to this many seconds rather than creating
+# a new token for every render, 0 to always create a new token
+WS_TOKEN_REUSE_SECONDS = getattr(settings, 'WS_TOKEN_REUSE_SECONDS', 60)
+
+# format of tokens created by make_token: "hash" tokens are checked against the user's password hash so require
+# a database query, "claims" tokens contain signed details of the user so don't, see tokens.make_claims_token
+WS_TOKEN_FORMAT = getattr(settings, 'WS_TOKEN_FORMAT', 'hash')
+
+# included in claims tokens, changing it invalidates all existing claims tokens
+WS_TOKEN_EPOCH = getattr(settings, 'WS_TOKEN_EPOCH', 0)
+
+# alias of the django cache used to revoke a single user's claims tokens: when a user is saved or deleted a digest
+# of their password, ws_auth_key_salt and is_active is stored there and claims tokens with a different digest are
+# rejected. It's read in the auth thread pool during handshakes and must be shared by all processes (eg. memcached
+# or redis) for revocations to reach the websockets processes, a local memory cache logs a warning on start.
+# None (the default) to disable.
+WS_TOKEN_REVOCATION_CACHE = getattr(settings, 'WS_TOKEN_REVOCATION_CACHE', None)
+
+# number of threads used to load users when checking websocket tokens during the handshake,
+# 0 to query the database directly on the IOLoop
+WS_AUTH_THREADS = getattr(settings, 'WS_AUTH_THREADS', 4)
+
+# user lookups from handshakes are combined into one query, at most WS_AUTH_BATCH_SIZE users are loaded at once
+# and the first lookup waits at most WS_AUTH_BATCH_WAIT seconds for others to join it
+WS_AUTH_BATCH_SIZE = getattr(settings, 'WS_AUTH_BATCH_SIZE', 100)
+WS_AUTH_BATCH_WAIT = getattr(settings, 'WS_AUTH_BATCH_WAIT', 0.002)
+
+# maximum number of validated tokens cached (saving a database query and hmac when clients reconnect),
+# 0 to disable the cache, the same size is used for the cache of recently rejected tokens
+WS_TOKEN_CACHE_SIZE = getattr(settings, 'WS_TOKEN_CACHE_SIZE', 10000)
+
+# maximum time in seconds a validated token is cached for, entries are removed when the user is saved or
+# deleted in this process, so this limits how long other processes can accept a token after a password change
+WS_TOKEN_CACHE_TTL = getattr(settings, 'WS_TOKEN_CACHE_TTL', 60)
+
 WS_LOGGER_NAME = getattr(settings, 'WS_LOGGER_NAME', 'websockets')
 
 # URL of websocket connection, if None it's obtained from the domain and path below
@@ -23,6 +58,120 @@ WS_URL_ROOT = getattr(settings, 'WS_URL_ROOT', 'ws').strip('/')
 # TODO add warning if this hasn't been set
 WS_HANDLERS = getattr(settings, 'WS_HANDLERS', (('', 'django_websockets.handlers.AnonEchoHandler'),))
 
+# permessage-deflate compression used by handlers unless they set the compression attribute or the handler definition
+# in WS_HANDLERS has options eg. ('feed', 'app.ws.FeedHandler', {'compression': 'low_memory'}). None to disable
+# compression, a preset name ("default", "fast", "small", "low_memory", "no_context") or a dict of options
+# ("level", "wbits", "mem_level", "min_size", "context_takeover" and optionally "preset"). see compression
+WS_COMPRESSION = getattr(settings, 'WS_COMPRESSION', None)
+
+# broadcasts to clients compressing without context takeover are compressed once and the frame shared, payloads of at
+# least WS_COMPRESSION_THREAD_BYTES are compressed in a pool of WS_COMPRESSION_THREADS threads (0 to always
+# compress on the IOLoop) so large broadcasts don't block the IOLoop
+WS_COMPRESSION_THREADS = getattr(settings, 'WS_COMPRESSION_THREADS', 2)
+WS_COMPRESSION_THREAD_BYTES = getattr(settings, 'WS_COMPRESSION_THREAD_BYTES', 16384)
+
+# limits on data waiting to be sent to each client. Once more than WS_OUTBOUND_BUFFER_BYTES are waiting to be written
+# to a client's socket further messages are queued, the queue is limited to WS_OUTBOUND_MAX_MESSAGES messages and
+# WS_OUTBOUND_MAX_BYTES bytes. WS_OUTBOUND_POLICY decides what happens when either limit would be exceeded:
+# * "drop_oldest" drop queued messages, oldest first, until the new message fits
+# * "drop_newest" drop the new message
+# * "coalesce" drop all queued messages, only the new message is kept (useful when each message is a full state update)
+# * "close" close the connection with WS_OUTBOUND_CLOSE_CODE (1008 "policy violation" or 1013 "try again later")
+# These can also be overridden per handler with the outbound_* attributes of AnonSocketHandler.
+WS_OUTBOUND_BUFFER_BYTES = getattr(settings, 'WS_OUTBOUND_BUFFER_BYTES', 64 * 1024)
+WS_OUTBOUND_MAX_BYTES = getattr(settings, 'WS_OUTBOUND_MAX_BYTES', 1024 * 1024)
+WS_OUTBOUND_MAX_MESSAGES = getattr(settings, 'WS_OUTBOUND_MAX_MESSAGES', 1000)
+WS_OUTBOUND_POLICY = getattr(settings, 'WS_OUTBOUND_POLICY', 'drop_oldest')
+WS_OUTBOUND_CLOSE_CODE = getattr(settings, 'WS_OUTBOUND_CLOSE_CODE', 1013)
+
+# if WS_COALESCE_WRITES is True messages written to a client are collected and written to its socket together after
+# WS_COALESCE_DELAY seconds (0 to write at the end of the current IOLoop iteration) or once WS_COALESCE_MAX_BYTES are
+# waiting, this saves syscalls and packets for handlers which send bursts of small messages at the cost of latency
+WS_COALESCE_WRITES = getattr(settings, 'WS_COALESCE_WRITES', False)
+WS_COALESCE_DELAY = getattr(settings, 'WS_COALESCE_DELAY', 0)
+WS_COALESCE_MAX_BYTES = getattr(settings, 'WS_COALESCE_MAX_BYTES', 65536)
+
+# new connections are refused while the process has more than WS_SHED_MAX_CONNECTIONS connections, IOLoop lag is
+# more than WS_SHED_MAX_LOOP_LAG milliseconds or more than WS_SHED_MAX_OUTBOUND_BYTES are waiting to be sent to
+# clients (None for no limit). Connections are accepted again once every load is below WS_SHED_RESUME_RATIO times
+# its limit. Loads are measured at most every WS_SHED_CHECK_INTERVAL seconds. see shedding.LoadShedder
+WS_SHED_MAX_CONNECTIONS = getattr(settings, 'WS_SHED_MAX_CONNECTIONS', None)
+WS_SHED_MAX_LOOP_LAG = getattr(settings, 'WS_SHED_MAX_LOOP_LAG', None)
+WS_SHED_MAX_OUTBOUND_BYTES = getattr(settings, 'WS_SHED_MAX_OUTBOUND_BYTES', None)
+WS_SHED_RESUME_RATIO = getattr(settings, 'WS_SHED_RESUME_RATIO', 0.8)
+WS_SHED_CHECK_INTERVAL = getattr(settings, 'WS_SHED_CHECK_INTERVAL', 0.25)
+
+# how refused connections are rejected:
+# * "http" respond 503 with a Retry-After header of WS_SHED_RETRY_AFTER seconds before upgrading, this is cheapest
+# * "close" upgrade then close the connection with 1013 "try again later", useful since browsers don't expose
+#   the status of failed handshakes to javascript
+WS_SHED_MODE = getattr(settings, 'WS_SHED_MODE', 'http')
+WS_SHED_RETRY_AFTER = getattr(settings, 'WS_SHED_RETRY_AFTER', 5)
+
+# codec used by router.MessageRouterMixin to decode and encode messages, a name ("json", "orjson" which is faster but
+# requires orjson to be installed or "msgpack") or the dotted path of a codec class. Messages larger than
+# WS_MESSAGE_MAX_SIZE bytes (utf-8 encoded for text) are rejected without being decoded
+WS_MESSAGE_CODEC = getattr(settings, 'WS_MESSAGE_CODEC', 'json')
+WS_MESSAGE_MAX_SIZE = getattr(settings, 'WS_MESSAGE_MAX_SIZE', 65536)
+# codecs clients may choose per connection with a "<codec>+<token>" subprotocol, eg. ('msgpack',) to allow binary
+# MessagePack (requires msgpack to be installed)
+WS_MESSAGE_NEGOTIABLE_CODECS = tuple(getattr(settings, 'WS_MESSAGE_NEGOTIABLE_CODECS', ()))
+
+# every connection is pinged every WS_HEARTBEAT_INTERVAL seconds (0 to disable) by one timer per process which
+# ticks WS_HEARTBEAT_SLOTS times per interval, connections which don't answer WS_HEARTBEAT_MAX_MISSED pings in
+# a row are closed with WS_HEARTBEAT_CLOSE_CODE. see heartbeat.HeartbeatScheduler
+WS_HEARTBEAT_INTERVAL = getattr(settings, 'WS_HEARTBEAT_INTERVAL', 30)
+WS_HEARTBEAT_SLOTS = getattr(settings, 'WS_HEARTBEAT_SLOTS', 30)
+WS_HEARTBEAT_MAX_MISSED = getattr(settings, 'WS_HEARTBEAT_MAX_MISSED', 2)
+WS_HEARTBEAT_CLOSE_CODE = getattr(settings, 'WS_HEARTBEAT_CLOSE_CODE', 1001)
+
+# ping round trip times are recorded in histograms covering the last WS_METRICS_WINDOW seconds, divided into
+# WS_METRICS_WINDOW_SLICES slices which age out one at a time, see metrics.WindowedHistogram
+WS_METRICS_WINDOW = getattr(settings, 'WS_METRICS_WINDOW', 60)
+WS_METRICS_WINDOW_SLICES = getattr(settings, 'WS_METRICS_WINDOW_SLICES', 6)
+
+# interval in seconds between checks of IOLoop lag, see metrics.LoopLagMonitor
+WS_LOOP_LAG_INTERVAL = getattr(settings, 'WS_LOOP_LAG_INTERVAL', 0.5)
+
+# whether the websockets command starts the watchdog (also enabled with --watchdog), when the IOLoop is blocked
+# for more than WS_WATCHDOG_THRESHOLD seconds the stack of the loop thread is logged, at most once every
+# WS_WATCHDOG_LOG_INTERVAL seconds. see watchdog.LoopWatchdog
+WS_WATCHDOG = getattr(settings, 'WS_WATCHDOG', False)
+WS_WATCHDOG_THRESHOLD = getattr(settings, 'WS_WATCHDOG_THRESHOLD', 0.5)
+WS_WATCHDOG_LOG_INTERVAL = getattr(settings, 'WS_WATCHDOG_LOG_INTERVAL', 10)
+
+# path to serve metrics in prometheus' text format on, eg. "/metrics", None to not serve metrics.
+# Metrics aren't protected so this path should only be reachable from your monitoring system.
+WS_METRICS_URL = getattr(settings, 'WS_METRICS_URL', None)
+
+# whether to keep a round trip time histogram for each handler class as well as one for the whole process
+WS_RTT_PER_HANDLER = getattr(settings, 'WS_RTT_PER_HANDLER', False)
+
+# backplane used to send broadcasts, group and user messages between processes, either None (messages only reach
+# clients connected to the same process) or the dotted path of a django_websockets.backplane.Backplane child,
+# WS_BACKPLANE_OPTIONS are passed to the backplane as keyword arguments.
+WS_BACKPLANE = getattr(settings, 'WS_BACKPLANE', None)
+WS_BACKPLANE_OPTIONS = getattr(settings, 'WS_BACKPLANE_OPTIONS', {})
+
+# address of the broker used by django_websockets.backplane.BrokerBackplane and run by the websockets_broker
+# management command, either "host:port" or "unix:/path/to/socket"
+WS_BROKER_ADDRESS = getattr(settings, 'WS_BROKER_ADDRESS', '127.0.0.1:8002')
+
+# limit on bytes waiting to be written to the broker by each process and to each process by the broker. Beyond it
+# BrokerBackplane drops new messages and the broker disconnects the process, it then reconnects
+WS_BACKPLANE_MAX_BUFFER = getattr(settings, 'WS_BACKPLANE_MAX_BUFFER', 16 * 1024 * 1024)
+
+# number of worker processes started by the websockets management command, 0 means one per CPU.
+# Workers only see their own clients, so this defaults to one per CPU only when WS_BACKPLANE is set to connect
+# them and DEBUG is off (tornado's autoreload is not compatible with multiple processes), otherwise to 1.
+WS_WORKERS = getattr(settings, 'WS_WORKERS', 0 if WS_BACKPLANE and not DEBUG else 1)
+
+# django is served in a pool of WS_WSGI_THREADS threads so slow views don't block websockets, at most
+# WS_WSGI_MAX_QUEUE requests can wait for a free thread before further requests are refused with a 503 response.
+# Set WS_WSGI_THREADS to 0 to call django directly on the IOLoop.
+WS_WSGI_THREADS = getattr(settings, 'WS_WSGI_THREADS', 10)
+WS_WSGI_MAX_QUEUE = getattr(settings, 'WS_WSGI_MAX_QUEUE', 100)
+
 # name of the variable used to expose info to javascript about websockets
 MAIN_JS_VARIABLE = getattr(settings, 'MAIN_JS_VARIABLE', 'djws')
 
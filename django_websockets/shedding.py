@@ -0,0 +1,86 @@
+"""
+Refuse new websocket connections while the process is overloaded so existing connections keep being served.
+"""
+import logging
+import time
+
+from .clients import all_clients
+from .metrics import start_loop_lag_monitor
+from .protocol import outbound_bytes
+from . import settings
+
+logger = logging.getLogger(settings.WS_LOGGER_NAME)
+
+SHED_MODES = ('http', 'close')
+
+
+class LoadShedder(object):
+    """
+    Decides whether new connections should be refused based on the number of connections, IOLoop lag and
+    data waiting to be sent to clients. Limits which are None aren't checked.
+
+    Shedding starts when any load exceeds its limit and only stops when every load is below resume_ratio times
+    its limit, so it doesn't flap on and off around the limit. Loads are measured at most every check_interval
+    seconds, so checking is cheap even during a flood of handshakes.
+    """
+    def __init__(self, clients=all_clients, max_connections=None, max_loop_lag=None, max_outbound_bytes=None,
+                 resume_ratio=None, check_interval=None):
+        """
+        :param clients: AllClients instance used to count connections
+        :param max_connections: maximum number of connections
+        :param max_loop_lag: maximum IOLoop lag in milliseconds, see metrics.LoopLagMonitor
+        :param max_outbound_bytes: maximum bytes waiting to be written to clients
+        :param resume_ratio: fraction of each limit every load must be below for shedding to stop
+        :param check_interval: minimum time in seconds between measuring loads
+        """
+        self.clients = clients
+        self.limits = {
+            'connections': settings.WS_SHED_MAX_CONNECTIONS if max_connections is None else max_connections,
+            'loop_lag': settings.WS_SHED_MAX_LOOP_LAG if max_loop_lag is None else max_loop_lag,
+            'outbound_bytes': settings.WS_SHED_MAX_OUTBOUND_BYTES if max_outbound_bytes is None else max_outbound_bytes,
+        }
+        self.resume_ratio = resume_ratio or settings.WS_SHED_RESUME_RATIO
+        self.check_interval = settings.WS_SHED_CHECK_INTERVAL if check_interval is None else check_interval
+        self.shedding = False
+        self._checked = None
+
+    def loads(self):
+        """
+        :return: dict of current loads which have a limit
+        """
+        loads = {}
+        if self.limits['connections'] is not None:
+            loads['connections'] = len(self.clients)
+        if self.limits['loop_lag'] is not None:
+            lag = start_loop_lag_monitor().lag
+            loads['loop_lag'] = 0 if lag is None else lag * 1000
+        if self.limits['outbound_bytes'] is not None:
+            # kept up to date by every WebSocketProtocol so this doesn't depend on the number of connections
+            loads['outbound_bytes'] = outbound_bytes['queued'] + outbound_bytes['buffered']
+        return loads
+
+    def check(self):
+        """
+        :return: whether new connections should currently be refused
+        """
+        now = time.monotonic()
+        if self._checked is not None and now - self._checked < self.check_interval:
+            return self.shedding
+        self._checked = now
+        loads = self.loads()
+        if self.shedding:
+            if all(value <= self.limits[name] * self.resume_ratio for name, value in loads.items()):
+                self.shedding = False
+                logger.warning('load reduced, accepting new connections, %s', self._describe(loads))
+        else:
+            if any(value > self.limits[name] for name, value in loads.items()):
+                self.shedding = True
+                logger.warning('overloaded, refusing new connections, %s', self._describe(loads))
+        return self.shedding
+
+    def _describe(self, loads):
+        return ', '.join('%s %d (limit %d)' % (name, loads[name], self.limits[name]) for name in sorted(loads))
+
+
+# used by AnonSocketHandler to decide whether to accept connections
+load_shedder = LoadShedder()
@@ -1,10 +1,11 @@
 import logging
 import json
 import re
+from functools import lru_cache
 from django import template
 from django.utils.safestring import mark_safe
 from .. import settings
-from ..tokens import make_token
+from ..tokens import get_or_make_token
 
 register = template.Library()
 
@@ -14,14 +15,25 @@ logger = logging.getLogger(settings.WS_LOGGER_NAME)
 def get_ws_url(request, ws_suffix):
     if settings.WS_URL:
         return settings.WS_URL
-    prefix = 'wss://' if request.is_secure() else 'ws://'
-    host = request.get_host().rstrip('/')
-    if settings.WS_PORT:
-        host = re.sub(r':\d+$', ':' + str(settings.WS_PORT), host)
+    return _ws_url_prefix(request.is_secure(), request.get_host(), settings.WS_PORT, settings.WS_URL_ROOT) + \
+        _ws_url_suffix(ws_suffix)
+
+
+@lru_cache(maxsize=256)
+def _ws_url_prefix(secure, host, port, url_root):
+    prefix = 'wss://' if secure else 'ws://'
+    host = host.rstrip('/')
+    if port:
+        host = re.sub(r':\d+$', ':' + str(port), host)
+    return '%s%s/%s/' % (prefix, host, url_root)
+
+
+@lru_cache(maxsize=256)
+def _ws_url_suffix(ws_suffix):
     ws_suffix = ws_suffix.strip('/')
     if ws_suffix:
         ws_suffix += '/'
-    return '%s%s/%s/%s' % (prefix, host, settings.WS_URL_ROOT, ws_suffix)
+    return ws_suffix
 
 
 def get_request_ip(request):
@@ -44,7 +56,7 @@ def websocket_info(context, ws_suffix='', **kwargs):
     # token has to be a string as it's the second argument in js Websocket method
     token = 'anon'
     if request.user.is_authenticated():
-        token = make_token(request.user, get_request_ip(request))
+        token = get_or_make_token(request.user, get_request_ip(request))
     variables = dict(
         ws_url=get_ws_url(request, ws_suffix),
         token=token,
@@ -1,15 +1,22 @@
 import datetime
 import logging
+import threading
 from unittest.mock import patch
 from functools import partial
 
-from django.test import TestCase
-from django.contrib.auth.models import User
+from tornado.testing import AsyncTestCase, gen_test
+
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.contrib.auth.models import Group, User
+from django.utils.crypto import salted_hmac
 from django.utils.http import base36_to_int, int_to_base36
 
 from django_websockets.handlers import AnonEchoHandler, all_clients, AuthEchoHandler
 from django_websockets.app import get_app
-from django_websockets.tokens import make_token, check_token_get_user
+from django_websockets.tokens import (make_token, check_token_get_user, token_cache, rejected_token_cache,
+                                      rejected_tokens, _token_hmac, KEY_SALT, ClaimsUser)
+from django_websockets.auth import UserLoader, check_token_get_user_async
+from django_websockets.metrics import handshakes_rejected
 from django_websockets import settings
 from .utils import WebSocketClient, AsyncHTTPTestCaseExtra
 
@@ -74,6 +81,181 @@ class LowLevelAuthTestCase(TestCase):
         self.assertEqual(check_token_get_user(token, self.ip), user)
 
 
+class TokenCacheTestCase(TestCase):
+    ip = '127.0.0.1'
+
+    def setUp(self):
+        token_cache.clear()
+        rejected_token_cache.clear()
+        self.user = User.objects.create_user('testing', email='testing@example.com')
+        self.token = make_token(self.user, self.ip)
+
+    def test_cached(self):
+        hits = token_cache.hits
+        self.assertEqual(check_token_get_user(self.token, self.ip), self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(check_token_get_user(self.token, self.ip), self.user)
+        self.assertEqual(token_cache.hits, hits + 1)
+
+    def test_different_ip(self):
+        self.assertEqual(check_token_get_user(self.token, self.ip), self.user)
+        self.assertFalse(check_token_get_user(self.token, '127.0.0.2'))
+
+    def test_password_change(self):
+        self.assertEqual(check_token_get_user(self.token, self.ip), self.user)
+        self.assertEqual(len(token_cache), 1)
+        self.user.set_password('new password')
+        self.user.save()
+        self.assertEqual(len(token_cache), 0)
+        self.assertFalse(check_token_get_user(self.token, self.ip))
+
+    def test_user_deleted(self):
+        self.assertEqual(check_token_get_user(self.token, self.ip), self.user)
+        self.user.delete()
+        self.assertFalse(check_token_get_user(self.token, self.ip))
+
+    def test_rejected_cached(self):
+        secs, uid, hash = self.token.split('-')
+        wrong_token = '%s-%s-%s' % (secs, uid, 'x' * len(hash))
+        before = rejected_tokens.copy()
+        self.assertFalse(check_token_get_user(wrong_token, self.ip))
+        with self.assertNumQueries(0):
+            self.assertFalse(check_token_get_user(wrong_token, self.ip))
+        self.assertEqual(rejected_tokens['signature'], before['signature'] + 1)
+        self.assertEqual(rejected_tokens['rejected_cache'], before['rejected_cache'] + 1)
+        # the valid token isn't affected
+        self.assertEqual(check_token_get_user(self.token, self.ip), self.user)
+
+    def test_rejected_missing_user(self):
+        secs, uid, hash = self.token.split('-')
+        wrong_token = '%s-%s-%s' % (secs, int_to_base36(self.user.id + 42), hash)
+        before = rejected_tokens['user']
+        self.assertFalse(check_token_get_user(wrong_token, self.ip))
+        with self.assertNumQueries(0):
+            self.assertFalse(check_token_get_user(wrong_token, self.ip))
+        self.assertEqual(rejected_tokens['user'], before + 1)
+
+    def test_cheap_rejections(self):
+        before = rejected_tokens.copy()
+        with self.assertNumQueries(0):
+            self.assertFalse(check_token_get_user('null', self.ip))
+            self.assertFalse(check_token_get_user('x-?-z', self.ip))
+            self.assertFalse(check_token_get_user('1-1-abc', self.ip))
+            self.assertFalse(check_token_get_user(self.token.replace('-%s-' % int_to_base36(self.user.pk),
+                                                                     '-zzzzzzzzzzzzz-'), self.ip))
+        self.assertEqual(rejected_tokens['format'], before['format'] + 3)
+        self.assertEqual(rejected_tokens['expired'], before['expired'] + 1)
+
+    def test_token_hmac(self):
+        self.assertEqual(_token_hmac('testing').hexdigest(), salted_hmac(KEY_SALT, 'testing').hexdigest())
+        with override_settings(SECRET_KEY='different'):
+            self.assertEqual(_token_hmac('testing').hexdigest(), salted_hmac(KEY_SALT, 'testing').hexdigest())
+            self.assertFalse(check_token_get_user(self.token, '127.0.0.2'))
+        self.assertEqual(_token_hmac('testing').hexdigest(), salted_hmac(KEY_SALT, 'testing').hexdigest())
+
+    @patch('django_websockets.tokens._now')
+    def test_cached_token_expires(self, now_func):
+        n = datetime.datetime.now()
+        now_func.side_effect = [n, n + datetime.timedelta(seconds=settings.TOKEN_VALIDITY_SECONDS + 60)]
+        token = make_token(self.user, self.ip)
+        token_cache.set((self.user.pk, token, self.ip), self.user)
+        self.assertFalse(check_token_get_user(token, self.ip))
+
+
+class ClaimsTokenTestCase(TestCase):
+    ip = '127.0.0.1'
+
+    def setUp(self):
+        self.user = User.objects.create_user('testing', email='testing@example.com')
+        self.user.is_staff = True
+        self.user.save()
+        self.user.groups.add(Group.objects.create(name='testers'))
+
+    def test_claims_token(self):
+        token = make_token(self.user, self.ip, 'claims')
+        self.assertTrue(token.startswith('c.'))
+        self.assertRegex(token, r'^[a-zA-Z0-9_.\-]+$')
+        with self.assertNumQueries(0):
+            user = check_token_get_user(token, self.ip)
+            self.assertIsInstance(user, ClaimsUser)
+            self.assertEqual((user.pk, user.id, user.username), (self.user.pk, self.user.pk, 'testing'))
+            self.assertEqual((user.is_staff, user.is_superuser), (True, False))
+            self.assertEqual(user.group_names, {'testers'})
+            self.assertTrue(user.is_authenticated())
+            self.assertEqual(user, self.user)
+            self.assertEqual(str(user), 'testing')
+            self.assertEqual(repr(user), '<ClaimsUser: testing>')
+
+        with self.assertNumQueries(1):
+            self.assertEqual(user.email, 'testing@example.com')
+            self.assertEqual(user.get_user(), self.user)
+
+    @patch('django_websockets.settings.WS_TOKEN_FORMAT', 'claims')
+    def test_default_format(self):
+        self.assertTrue(make_token(self.user, self.ip).startswith('c.'))
+
+    def test_invalid_format(self):
+        with self.assertRaises(ValueError):
+            make_token(self.user, self.ip, 'foobar')
+
+    def test_wrong_ip(self):
+        token = make_token(self.user, self.ip, 'claims')
+        self.assertFalse(check_token_get_user(token, '127.0.0.2'))
+
+    def test_tampered(self):
+        token = make_token(self.user, self.ip, 'claims')
+        prefix, payload, signature = token.split('.')
+        self.assertFalse(check_token_get_user('c.%s.%s' % (payload[:-2], signature), self.ip))
+        self.assertFalse(check_token_get_user('c.%s' % payload, self.ip))
+
+    def test_epoch(self):
+        token = make_token(self.user, self.ip, 'claims')
+        with patch('django_websockets.settings.WS_TOKEN_EPOCH', 1):
+            self.assertFalse(check_token_get_user(token, self.ip))
+            self.assertTrue(check_token_get_user(make_token(self.user, self.ip, 'claims'), self.ip))
+
+    @patch('django_websockets.tokens._now')
+    def test_expired(self, now_func):
+        n = datetime.datetime.now()
+        now_func.side_effect = [n, n + datetime.timedelta(seconds=settings.TOKEN_VALIDITY_SECONDS + 60)]
+        token = make_token(self.user, self.ip, 'claims')
+        self.assertFalse(check_token_get_user(token, self.ip))
+
+    @patch('django_websockets.settings.WS_TOKEN_REVOCATION_CACHE', 'default')
+    def test_deactivated(self):
+        token = make_token(self.user, self.ip, 'claims')
+        self.assertTrue(check_token_get_user(token, self.ip).is_active)
+        self.user.is_active = False
+        self.user.save()
+        revoked = rejected_tokens['revoked']
+        self.assertFalse(check_token_get_user(token, self.ip))
+        self.assertEqual(rejected_tokens['revoked'], revoked + 1)
+        user = check_token_get_user(make_token(self.user, self.ip, 'claims'), self.ip)
+        self.assertFalse(user.is_active)
+
+    @patch('django_websockets.settings.WS_TOKEN_REVOCATION_CACHE', 'default')
+    def test_password_changed(self):
+        token = make_token(self.user, self.ip, 'claims')
+        # saves which don't change the key (eg. update_last_login) leave tokens valid
+        self.user.save()
+        self.assertTrue(check_token_get_user(token, self.ip))
+        self.user.set_password('foobar')
+        self.user.save()
+        self.assertFalse(check_token_get_user(token, self.ip))
+
+    @patch('django_websockets.settings.WS_TOKEN_REVOCATION_CACHE', 'default')
+    def test_deleted(self):
+        token = make_token(self.user, self.ip, 'claims')
+        self.user.delete()
+        self.assertFalse(check_token_get_user(token, self.ip))
+
+    def test_revocation_cache_disabled(self):
+        token = make_token(self.user, self.ip, 'claims')
+        self.user.set_password('foobar')
+        self.user.save()
+        self.assertTrue(check_token_get_user(token, self.ip))
+
+
 class AnonHandlerWebSocketTest(AsyncHTTPTestCaseExtra, TestCase):
     def get_app(self):
         return get_app(False, [('/', AnonEchoHandler)])
@@ -147,83 +329,72 @@ class AnonHandlerWebSocketTest(AsyncHTTPTestCaseExtra, TestCase):
         test_case.assertEqual(len(all_clients.all_clients), 0)
         test_case.assertEqual(len(all_clients.anon_clients), 0)
         test_case.assertEqual(len(all_clients.auth_clients), 0)
+        test_case.assertEqual(len(all_clients.clients_for_user(user.id)), 0)
 
 
-class AuthHandlerWebSocketTest(AsyncHTTPTestCaseExtra, TestCase):
+class AuthHandlerWebSocketTest(AsyncHTTPTestCaseExtra, TransactionTestCase):
+    """
+    Users are loaded in a thread with its own database connection, so the user must be committed to be
+    visible to it, hence TransactionTestCase.
+    """
     def get_app(self):
         return get_app(False, [('/', AuthEchoHandler)])
 
+    def _fetch_rejected(self, subprotocol=None, **extra_headers):
+        headers = {'Upgrade': 'websocket', 'Connection': 'Upgrade', 'Sec-WebSocket-Version': '13',
+                   'Sec-WebSocket-Key': 'dGhlIHNhbXBsZSBub25jZQ=='}
+        headers.update(extra_headers)
+        if subprotocol is not None:
+            headers['Sec-WebSocket-Protocol'] = subprotocol
+        response = self.fetch('/ws/', headers=headers)
+        self.assertEqual(len(all_clients.all_clients), 0)
+        self.assertEqual(len(all_clients.anon_clients), 0)
+        self.assertEqual(len(all_clients.auth_clients), 0)
+        return response.code, response.body.decode()
+
     def test_anon_client(self):
         """
-        anonymous user connecting to auth socket, should be permission denied
+        anonymous user connecting to auth socket, should be permission denied before upgrading
         """
         self.assertEqual(User.objects.count(), 0)
-        test_case = self
-
-        class WSClient(WebSocketClient):
-            def on_close(self, code=None, reason=None):
-                test_case.delayed_assertions.extend([
-                    (code, 2001),
-                    (reason, 'permission denied - anonymous users not permitted to connect to this socket'),
-                    (len(all_clients.all_clients), 0),
-                    (len(all_clients.anon_clients), 0),
-                    (len(all_clients.auth_clients), 0),
-                ])
-                test_case.io_loop.add_callback(test_case.stop)
-
-        self.io_loop.add_callback(partial(WSClient, self.get_url('/ws/'), self.io_loop, 'anon'))
-        self.wait()
-        test_case.assertEqual(len(all_clients.all_clients), 0)
-        test_case.assertEqual(len(all_clients.anon_clients), 0)
-        test_case.assertEqual(len(all_clients.auth_clients), 0)
+        self.assertEqual(self._fetch_rejected('anon'),
+                         (403, 'permission denied - anonymous users not permitted to connect to this socket'))
 
     def test_no_subprotocol_client(self):
         """
-        anonymous user (no subprotocol) connecting to auth socket, should be permission denied
+        anonymous user (no subprotocol) connecting to auth socket, should be permission denied before upgrading
         """
         self.assertEqual(User.objects.count(), 0)
-        test_case = self
+        self.assertEqual(self._fetch_rejected(), (401, 'permission denied - no token supplied'))
 
-        class WSClient(WebSocketClient):
-            def on_close(self, code=None, reason=None):
-                test_case.delayed_assertions.extend([
-                    (code, 2000),
-                    (reason, 'permission denied - no token supplied'),
-                    (len(all_clients.all_clients), 0),
-                    (len(all_clients.anon_clients), 0),
-                    (len(all_clients.auth_clients), 0),
-                ])
-                test_case.io_loop.add_callback(test_case.stop)
-
-        self.io_loop.add_callback(partial(WSClient, self.get_url('/ws/'), self.io_loop))
-        self.wait()
-        test_case.assertEqual(len(all_clients.all_clients), 0)
-        test_case.assertEqual(len(all_clients.anon_clients), 0)
-        test_case.assertEqual(len(all_clients.auth_clients), 0)
+    def test_multiple_subprotocols(self):
+        self.assertEqual(self._fetch_rejected('foo, bar'), (400, 'exactly one token should be provided'))
+        self.assertEqual(self._fetch_rejected('msgpack+foo, bar'), (400, 'exactly one token should be provided'))
+        self.assertEqual(self._fetch_rejected('msgpack+foo'), (400, 'no supported sub-protocol offered'))
 
     def test_bad_client(self):
         """
-        client with bad token connecting to auth socket, should be permission denied
+        client with bad token connecting to auth socket, should be permission denied before upgrading
         """
         self.assertEqual(User.objects.count(), 0)
-        test_case = self
-
-        class WSClient(WebSocketClient):
-            def on_close(self, code=None, reason=None):
-                test_case.delayed_assertions.extend([
-                    (code, 2002),
-                    (reason, 'permission denied - invalid token'),
-                    (len(all_clients.all_clients), 0),
-                    (len(all_clients.anon_clients), 0),
-                    (len(all_clients.auth_clients), 0),
-                ])
-                test_case.io_loop.add_callback(test_case.stop)
-
-        self.io_loop.add_callback(partial(WSClient, self.get_url('/ws/'), self.io_loop, 'this is bad!'))
-        self.wait()
-        test_case.assertEqual(len(all_clients.all_clients), 0)
-        test_case.assertEqual(len(all_clients.anon_clients), 0)
-        test_case.assertEqual(len(all_clients.auth_clients), 0)
+        rejected = handshakes_rejected[401]
+        self.assertEqual(self._fetch_rejected('this is bad!'), (401, 'permission denied - invalid token'))
+        self.assertEqual(handshakes_rejected[401], rejected + 1)
+
+    def test_upgrade_checked_before_token(self):
+        with patch('django_websockets.handlers.check_token_get_user_async') as check_token:
+            self.assertEqual(self._fetch_rejected('this is bad!', Upgrade='h2c'),
+                             (400, 'Can "Upgrade" only to "WebSocket".'))
+            self.assertEqual(self._fetch_rejected('this is bad!', Connection='keep-alive'),
+                             (400, '"Connection" must be "Upgrade".'))
+            self.assertEqual(self._fetch_rejected('this is bad!', Origin='http://example.com'),
+                             (403, 'Cross origin websockets not allowed'))
+        self.assertFalse(check_token.called)
+
+    def test_anon_not_loaded(self):
+        with patch('django_websockets.handlers.check_token_get_user_async') as check_token:
+            self.assertEqual(self._fetch_rejected('null')[0], 403)
+        self.assertFalse(check_token.called)
 
     def test_auth_echo(self):
         """
@@ -244,6 +415,7 @@ class AuthHandlerWebSocketTest(AsyncHTTPTestCaseExtra, TestCase):
                     (len(all_clients.all_clients), 1),
                     (len(all_clients.anon_clients), 0),
                     (len(all_clients.auth_clients), 1),
+                    (list(all_clients.clients_for_user(user.id)), list(all_clients.auth_clients)),
                 ])
                 test_case.ws_close_properly = True
                 self.close()
@@ -263,3 +435,126 @@ class AuthHandlerWebSocketTest(AsyncHTTPTestCaseExtra, TestCase):
         test_case.assertEqual(len(all_clients.all_clients), 0)
         test_case.assertEqual(len(all_clients.anon_clients), 0)
         test_case.assertEqual(len(all_clients.auth_clients), 0)
+        test_case.assertEqual(len(all_clients.clients_for_user(user.id)), 0)
+
+    def _auth_echo_thread(self):
+        user = User.objects.create_user('testing', email='testing@example.com')
+        token = make_token(user, '127.0.0.1')
+        token_cache.clear()
+        threads = []
+
+        def load_users(user_ids):
+            threads.append(threading.current_thread())
+            return User.objects.in_bulk(user_ids)
+        test_case = self
+
+        class WSClient(WebSocketClient):
+            def on_open(self):
+                test_case.delayed_assertions.append((len(all_clients.clients_for_user(user.id)), 1))
+                self.close()
+
+            def on_close(self, code=None, reason=None):
+                test_case.io_loop.add_callback(test_case.stop)
+
+        with patch('django_websockets.auth._load_users', side_effect=load_users):
+            self.io_loop.add_callback(partial(WSClient, self.get_url('/ws/'), self.io_loop, token))
+            self.wait()
+        self.assertEqual(len(threads), 1)
+        return threads[0]
+
+    def test_token_checked_in_thread(self):
+        self.assertIsNot(self._auth_echo_thread(), threading.current_thread())
+
+    @patch('django_websockets.settings.WS_AUTH_THREADS', 0)
+    def test_token_checked_inline(self):
+        self.assertIs(self._auth_echo_thread(), threading.current_thread())
+
+
+class AsyncTokenTestCase(AsyncTestCase, TransactionTestCase):
+    ip = '127.0.0.1'
+
+    def setUp(self):
+        super(AsyncTokenTestCase, self).setUp()
+        token_cache.clear()
+
+    @gen_test
+    def test_check_token_async(self):
+        user = User.objects.create_user('testing', email='testing@example.com')
+        token = make_token(user, self.ip)
+        self.assertEqual((yield check_token_get_user_async(token, self.ip)), user)
+        self.assertFalse((yield check_token_get_user_async(token, '127.0.0.2')))
+        self.assertFalse((yield check_token_get_user_async('null', self.ip)))
+
+    @gen_test
+    def test_claims_token_no_load(self):
+        user = User.objects.create_user('testing', email='testing@example.com')
+        token = make_token(user, self.ip, 'claims')
+        with patch('django_websockets.auth._load_users') as load_users:
+            result = yield check_token_get_user_async(token, self.ip)
+        self.assertEqual(result, user)
+        self.assertFalse(load_users.called)
+
+    @gen_test
+    def test_claims_revocation_in_thread(self):
+        user = User.objects.create_user('testing', email='testing@example.com')
+        token = make_token(user, self.ip, 'claims')
+        threads = []
+
+        def get_revocation_key(user_id):
+            threads.append(threading.current_thread())
+            return 'different'
+
+        with patch('django_websockets.settings.WS_TOKEN_REVOCATION_CACHE', 'default'), \
+                patch('django_websockets.auth.get_revocation_key', side_effect=get_revocation_key):
+            self.assertFalse((yield check_token_get_user_async(token, self.ip)))
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+
+    @gen_test
+    def test_user_deleted(self):
+        user = User.objects.create_user('testing', email='testing@example.com')
+        token = make_token(user, self.ip)
+        user.delete()
+        self.assertFalse((yield check_token_get_user_async(token, self.ip)))
+
+    @gen_test
+    def test_lookups_batched(self):
+        users = [User.objects.create_user('testing%d' % i, email='testing@example.com') for i in range(5)]
+        tokens = [make_token(user, self.ip) for user in users]
+        loader = UserLoader()
+        with patch('django_websockets.auth.get_user_loader', return_value=loader):
+            results = yield [check_token_get_user_async(token, self.ip) for token in tokens + tokens]
+        self.assertEqual(results, users + users)
+        self.assertEqual((loader.batches, loader.loaded), (1, 5))
+
+    @gen_test
+    def test_max_batch(self):
+        users = [User.objects.create_user('testing%d' % i, email='testing@example.com') for i in range(5)]
+        loader = UserLoader(max_batch=2, max_wait=10)
+        results = yield [loader.load(user.id) for user in users] + [loader.load(42)]
+        self.assertEqual(results, users + [None])
+        self.assertEqual(loader.batches, 3)
+
+    @gen_test
+    def test_batch_error_retried(self):
+        users = [User.objects.create_user('testing%d' % i, email='testing@example.com') for i in range(2)]
+        loader = UserLoader()
+
+        def load_users(user_ids):
+            if 42 in user_ids:
+                raise OverflowError('id out of range')
+            return User.objects.in_bulk(user_ids)
+
+        with patch('django_websockets.auth._load_users', side_effect=load_users):
+            futures = [loader.load(user.id) for user in users] + [loader.load(42)]
+            results = yield futures[:2]
+            self.assertEqual(results, users)
+            with self.assertRaises(OverflowError):
+                yield futures[2]
+
+    @gen_test
+    def test_batch_error(self):
+        loader = UserLoader()
+        with patch('django_websockets.auth._load_users', side_effect=RuntimeError('database down')):
+            with self.assertRaises(RuntimeError):
+                yield [loader.load(1), loader.load(2)]
@@ -0,0 +1,169 @@
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+
+from django_websockets.backplane import (BrokerBackplane, BrokerServer, InProcessBackplane, decode_batch,
+                                         encode_batch, parse_address)
+from django_websockets.clients import AllClients
+from django_websockets.protocol import OPCODE_BINARY, OPCODE_TEXT
+from .utils import MessageHandler
+
+
+class FakeUser(object):
+    pk = 42
+
+
+class BatchEncodingTestCase(TestCase):
+    def test_round_trip(self):
+        batch = [
+            ('all', None, OPCODE_TEXT, b'hello'),
+            ('group', 'lobby', OPCODE_BINARY, b'\x00\x01'),
+            ('user', 42, OPCODE_TEXT, b''),
+            ('codec', ['msgpack', False], OPCODE_BINARY, b'\x81'),
+        ]
+        data = encode_batch(batch)
+        self.assertEqual(int.from_bytes(data[:4], 'big'), len(data) - 4)
+        self.assertEqual(decode_batch(data[4:]), batch)
+
+    def test_parse_address(self):
+        self.assertEqual(parse_address('unix:/tmp/x.sock'), ('/tmp/x.sock', None, None))
+        self.assertEqual(parse_address('localhost:1234'), (None, 'localhost', 1234))
+        self.assertEqual(parse_address('1234'), (None, '127.0.0.1', 1234))
+
+
+def create_clients(backplane_cls, **kwargs):
+    clients = AllClients()
+    clients.backplane = backplane_cls(clients, **kwargs)
+    handlers = [MessageHandler(), MessageHandler(FakeUser())]
+    for h in handlers:
+        clients.append(h)
+    clients.join(handlers[0], 'lobby')
+    return clients, handlers
+
+
+class InProcessBackplaneTestCase(AsyncTestCase):
+    def setUp(self):
+        super(InProcessBackplaneTestCase, self).setUp()
+        self.clients1, self.handlers1 = create_clients(InProcessBackplane, bus='testing')
+        self.clients2, self.handlers2 = create_clients(InProcessBackplane, bus='testing')
+
+    def tearDown(self):
+        self.clients1.backplane.close()
+        self.clients2.backplane.close()
+        super(InProcessBackplaneTestCase, self).tearDown()
+
+    def test_messages(self):
+        self.assertEqual(self.clients1.broadcast('all', exclude=self.handlers1[0]), 1)
+        self.clients1.group_send('lobby', 'group')
+        self.clients1.send_to_user(42, 'user')
+        self.clients1.broadcast('local', predicate=lambda h: True)
+        # nothing is delivered until the end of the IOLoop iteration
+        self.assertEqual(self.handlers2[0].messages, [])
+        self.io_loop.add_callback(self.stop)
+        self.wait()
+        self.assertEqual(self.handlers1[0].messages, ['group', 'local'])
+        self.assertEqual(self.handlers1[1].messages, ['all', 'user', 'local'])
+        self.assertEqual(self.handlers2[0].messages, ['all', 'group'])
+        self.assertEqual(self.handlers2[1].messages, ['all', 'user'])
+        self.assertEqual((self.clients1.backplane.published, self.clients2.backplane.delivered), (3, 3))
+
+
+class BrokerBackplaneTestCase(AsyncTestCase):
+    def setUp(self):
+        super(BrokerBackplaneTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        address = 'unix:%s' % os.path.join(self.tmpdir, 'broker.sock')
+        self.server = BrokerServer()
+        self.server.bind_address(address)
+        self.server.start()
+        self.clients1, self.handlers1 = create_clients(BrokerBackplane, address=address)
+        self.clients2, self.handlers2 = create_clients(BrokerBackplane, address=address)
+
+    def tearDown(self):
+        self.clients1.backplane.close()
+        self.clients2.backplane.close()
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+        # let the backplanes' read coroutines see their streams have closed
+        self.io_loop.add_callback(self.stop)
+        self.wait()
+        super(BrokerBackplaneTestCase, self).tearDown()
+
+    @gen.coroutine
+    def wait_for(self, condition):
+        for _ in range(100):
+            if condition():
+                return
+            yield gen.Task(self.io_loop.add_timeout, self.io_loop.time() + 0.005)
+        raise AssertionError('timed out waiting for condition')
+
+    @gen_test
+    def test_messages(self):
+        yield self.wait_for(lambda: len(self.server.peers) == 2)
+        self.clients1.broadcast('all')
+        self.clients1.group_send('lobby', 'group')
+        self.clients2.send_to_user(42, 'user')
+        yield self.wait_for(lambda: len(self.handlers1[1].messages) == 2)
+        yield self.wait_for(lambda: len(self.handlers2[0].messages) == 2)
+        self.assertEqual(self.handlers1[0].messages, ['all', 'group'])
+        self.assertEqual(self.handlers1[1].messages, ['all', 'user'])
+        self.assertEqual(self.handlers2[0].messages, ['all', 'group'])
+        # clients2 sent "user" itself so it's written to its own clients before "all" arrives from the broker
+        self.assertEqual(self.handlers2[1].messages, ['user', 'all'])
+
+    @gen_test
+    def test_disconnected(self):
+        yield self.wait_for(lambda: len(self.server.peers) == 2)
+        self.server.stop()
+        for peer in list(self.server.peers):
+            peer.close()
+        yield self.wait_for(lambda: self.clients1.backplane.stream is None)
+        self.clients1.broadcast('all')
+        yield gen.Task(self.io_loop.add_callback)
+        self.assertEqual(self.clients1.backplane.dropped, 1)
+        self.assertEqual(self.handlers1[0].messages, ['all'])
+
+
+class FakeStream(object):
+    def __init__(self, buffered=0):
+        self._write_buffer_size = buffered
+        self.written = []
+        self.is_closed = False
+
+    def write(self, data):
+        self.written.append(data)
+        self._write_buffer_size += len(data)
+
+    def closed(self):
+        return self.is_closed
+
+    def close(self):
+        self.is_closed = True
+
+
+class WriteBufferLimitTestCase(AsyncTestCase):
+    def test_broker_disconnects_slow_peer(self):
+        server = BrokerServer(max_buffer=100)
+        sender, fast, slow = FakeStream(), FakeStream(), FakeStream(buffered=90)
+        server.peers.update((sender, fast, slow))
+        server.relay(sender, b'x' * 20)
+        self.assertEqual(fast.written, [b'x' * 20])
+        self.assertEqual(sender.written, [])
+        self.assertEqual(slow.written, [])
+        self.assertTrue(slow.is_closed)
+        self.assertEqual(server.disconnected, 1)
+
+    def test_backplane_drops_when_broker_is_slow(self):
+        clients = AllClients()
+        backplane = BrokerBackplane(clients, address='unix:/nonexistent', max_buffer=100)
+        backplane._closed = True
+        backplane.stream = FakeStream()
+        backplane.send_batch([('all', None, OPCODE_TEXT, b'x' * 50)])
+        self.assertEqual(len(backplane.stream.written), 1)
+        backplane.send_batch([('all', None, OPCODE_TEXT, b'x' * 50), ('user', 42, OPCODE_TEXT, b'y')])
+        self.assertEqual(len(backplane.stream.written), 1)
+        self.assertEqual(backplane.dropped, 2)
@@ -0,0 +1,79 @@
+from django.test import SimpleTestCase
+
+from django_websockets.cache import TTLCache
+
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TTLCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        self.timer = FakeTimer()
+        self.cache = TTLCache(3, 10, timer=self.timer)
+
+    def test_get_set(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(repr(self.cache), '<TTLCache: 1 entries, 1 hits, 1 misses, 0 evictions>')
+
+    def test_expiry(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2, ttl=5)
+        self.cache.set('c', 3, ttl=100)
+        self.timer.now = 5
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertIsNone(self.cache.get('b'))
+        self.timer.now = 10
+        # ttl is limited to the cache's ttl
+        self.assertIsNone(self.cache.get('c'))
+        self.assertEqual(len(self.cache), 1)
+
+    def test_not_cached(self):
+        self.cache.set('a', 1, ttl=0)
+        self.assertEqual(len(self.cache), 0)
+        cache = TTLCache(0, 10)
+        cache.set('a', 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_eviction(self):
+        for k in 'abc':
+            self.cache.set(k, k)
+        self.cache.get('a')
+        self.cache.set('d', 'd')
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual([self.cache.get(k) for k in 'acd'], ['a', 'c', 'd'])
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_discard(self):
+        for i in range(3):
+            self.cache.set(i, i)
+        self.cache.discard(0)
+        self.cache.discard(42)
+        self.assertEqual(len(self.cache), 2)
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+
+    def test_discard_group(self):
+        cache = TTLCache(3, 10, timer=self.timer, group=lambda k: k[0])
+        cache.set((1, 'a'), 'a')
+        cache.set((1, 'b'), 'b', ttl=5)
+        cache.set((2, 'a'), 'c')
+        self.timer.now = 5
+        self.assertIsNone(cache.get((1, 'b')))
+        cache.set((1, 'a'), 'd')
+        cache.set((3, 'a'), 'e')
+        # evicts (2, 'a')
+        cache.set((3, 'b'), 'f')
+        self.assertEqual(cache._groups, {1: {(1, 'a')}, 3: {(3, 'a'), (3, 'b')}})
+        self.assertEqual(cache.discard_group(3), 2)
+        self.assertEqual(cache.discard_group(2), 0)
+        self.assertEqual(len(cache), 1)
+        cache.discard((1, 'a'))
+        self.assertEqual((len(cache), cache._groups), (0, {}))
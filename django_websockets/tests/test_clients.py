@@ -0,0 +1,199 @@
+from functools import partial
+
+from django.test import TestCase
+
+from django_websockets.app import get_app
+from django_websockets.clients import AllClients, all_clients
+from django_websockets.handlers import AnonSocketHandler
+from .utils import WebSocketClient, AsyncHTTPTestCaseExtra, FakeHandler, MessageHandler
+
+
+class AllClientsTestCase(TestCase):
+    def setUp(self):
+        self.clients = AllClients()
+
+    def test_append_remove(self):
+        anon, auth = FakeHandler(), FakeHandler('testing')
+        self.clients.append(anon)
+        self.clients.append(auth)
+        self.assertEqual(len(self.clients), 2)
+        self.assertEqual(list(self.clients), [auth, anon])
+        self.assertEqual(str(self.clients), 'AllClients: 1 auth, 1 anon, 2 total')
+        self.clients.remove(anon)
+        self.assertNotIn(anon, self.clients)
+        self.assertIn(auth, self.clients)
+        self.assertEqual(self.clients.status, '1 auth, 0 anon, 1 total')
+
+    def test_remove_missing(self):
+        h = FakeHandler()
+        self.assertRaises(ValueError, self.clients.remove, h)
+        self.clients.remove(h, lenient=True)
+
+    def test_remove_after_user_changed(self):
+        h = FakeHandler()
+        self.clients.append(h)
+        h.user = 'testing'
+        self.clients.remove(h)
+        self.assertEqual(self.clients.status, '0 auth, 0 anon, 0 total')
+
+    def test_views_are_lazy(self):
+        auth_view = self.clients.auth_clients
+        anon_view = self.clients.anon_clients
+        all_view = self.clients.all_clients
+        self.assertFalse(all_view)
+        handlers = [FakeHandler('testing'), FakeHandler(), FakeHandler()]
+        for h in handlers:
+            self.clients.append(h)
+        self.assertEqual((len(auth_view), len(anon_view), len(all_view)), (1, 2, 3))
+        self.assertEqual(list(auth_view), handlers[:1])
+        self.assertEqual(list(anon_view), handlers[1:])
+        self.assertIn(handlers[0], all_view)
+        self.assertNotIn(handlers[0], anon_view)
+        self.assertEqual(repr(all_view), '<ClientsView: 3 clients>')
+
+
+class FakeUser(object):
+    def __init__(self, pk):
+        self.pk = pk
+
+
+class UserIndexTestCase(TestCase):
+    def setUp(self):
+        self.clients = AllClients()
+
+    def test_clients_for_user(self):
+        user1, user2 = FakeUser(1), FakeUser(2)
+        h1, h2, h3 = FakeHandler(user1), FakeHandler(user1), FakeHandler(user2)
+        for h in (h1, h2, h3, FakeHandler()):
+            self.clients.append(h)
+        self.assertEqual(list(self.clients.clients_for_user(1)), [h1, h2])
+        self.assertEqual(list(self.clients.clients_for_user(2)), [h3])
+        self.assertEqual(len(self.clients.clients_for_user(3)), 0)
+        self.clients.remove(h1)
+        self.assertEqual(list(self.clients.clients_for_user(1)), [h2])
+        self.clients.remove(h2)
+        self.assertEqual(len(self.clients.clients_for_user(1)), 0)
+        self.assertNotIn(1, self.clients._users)
+
+    def test_user_without_pk(self):
+        h = FakeHandler('anon 1234')
+        self.clients.append(h)
+        self.assertEqual(self.clients.status, '1 auth, 0 anon, 1 total')
+        self.assertEqual(self.clients._users, {})
+        self.clients.remove(h)
+        self.assertEqual(len(self.clients), 0)
+
+    def test_send_to_user(self):
+        user = FakeUser(1)
+        h1, h2, other = MessageHandler(user), MessageHandler(user), MessageHandler(FakeUser(2))
+        for h in (h1, h2, other):
+            self.clients.append(h)
+        self.assertEqual(self.clients.send_to_user(1, 'hello'), 2)
+        self.assertEqual(self.clients.send_to_user(3, 'hello'), 0)
+        self.assertEqual((h1.messages, h2.messages, other.messages), (['hello'], ['hello'], []))
+
+
+class GroupsTestCase(TestCase):
+    def setUp(self):
+        self.clients = AllClients()
+
+    def test_join_leave(self):
+        h1, h2 = FakeHandler(), FakeHandler()
+        self.clients.append(h1)
+        self.clients.append(h2)
+        self.clients.join(h1, 'a')
+        self.clients.join(h1, 'a')
+        self.clients.join(h1, 'b')
+        self.clients.join(h2, 'a')
+        self.assertEqual(list(self.clients.clients_in_group('a')), [h1, h2])
+        self.assertEqual(list(self.clients.clients_in_group('b')), [h1])
+        self.assertEqual(self.clients.groups_for_client(h1), {'a', 'b'})
+        self.assertEqual(set(self.clients.groups), {'a', 'b'})
+
+        self.clients.leave(h1, 'b')
+        self.clients.leave(h1, 'b')
+        self.clients.leave(h2, 'c')
+        self.assertEqual(set(self.clients.groups), {'a'})
+        self.assertEqual(len(self.clients.clients_in_group('b')), 0)
+        self.assertEqual(self.clients.groups_for_client(h1), {'a'})
+
+    def test_remove_leaves_groups(self):
+        h1, h2 = FakeHandler(), FakeHandler()
+        for h in (h1, h2):
+            self.clients.append(h)
+            self.clients.join(h, 'a')
+        self.clients.join(h1, 'b')
+        self.clients.remove(h1)
+        self.assertEqual(list(self.clients.clients_in_group('a')), [h2])
+        self.assertEqual(set(self.clients.groups), {'a'})
+        self.assertEqual(self.clients.groups_for_client(h1), set())
+        self.clients.remove(h2)
+        self.assertEqual(self.clients._groups, {})
+        self.assertEqual(self.clients._client_groups, {})
+
+    def test_group_send(self):
+        h1, h2 = MessageHandler(), MessageHandler()
+        self.clients.join(h1, 'a')
+        self.clients.join(h2, 'b')
+        self.assertEqual(self.clients.group_send('a', 'hello'), 1)
+        self.assertEqual(self.clients.group_send('c', 'hello'), 0)
+        self.assertEqual((h1.messages, h2.messages), (['hello'], []))
+
+
+class BroadcastTestCase(TestCase):
+    def setUp(self):
+        self.clients = AllClients()
+        self.handlers = [MessageHandler(), MessageHandler('testing'), MessageHandler()]
+        for h in self.handlers:
+            self.clients.append(h)
+
+    def test_broadcast(self):
+        self.assertEqual(self.clients.broadcast({'a': 1}), 3)
+        frames = [h.ws_connection.frames[0] for h in self.handlers]
+        # the same frame object is written to every client
+        self.assertTrue(all(f is frames[0] for f in frames))
+        self.assertEqual(frames[0], b'\x81\x08{"a": 1}')
+        self.assertEqual(self.handlers[0].messages, ['{"a": 1}'])
+
+    def test_broadcast_predicate_exclude(self):
+        sent = self.clients.broadcast('hello', predicate=lambda h: h.user is None)
+        self.assertEqual(sent, 2)
+        self.assertEqual([h.messages for h in self.handlers], [['hello'], [], ['hello']])
+        sent = self.clients.broadcast('again', exclude=self.handlers[0])
+        self.assertEqual(sent, 2)
+        sent = self.clients.broadcast('last', exclude={self.handlers[0], self.handlers[1]})
+        self.assertEqual(sent, 1)
+        self.assertEqual([h.messages for h in self.handlers], [['hello'], ['again'], ['hello', 'again', 'last']])
+
+    def test_broadcast_closed(self):
+        self.handlers[1].ws_connection = None
+        self.assertEqual(self.clients.broadcast('hello'), 2)
+        self.assertEqual(AllClients().broadcast('hello'), 0)
+
+
+class BroadcastHandler(AnonSocketHandler):
+    def on_message(self, data):
+        all_clients.broadcast({'echo': data})
+
+
+class BroadcastWebSocketTest(AsyncHTTPTestCaseExtra, TestCase):
+    def get_app(self):
+        return get_app(False, [('/', BroadcastHandler)])
+
+    def test_broadcast(self):
+        test_case = self
+
+        class WSClient(WebSocketClient):
+            def on_open(self):
+                self.write_message('hello')
+
+            def on_message(self, data):
+                test_case.delayed_assertions.append((data, '{"echo": "hello"}'))
+                self.close()
+
+            def on_close(self, code=None, reason=None):
+                test_case.io_loop.add_callback(test_case.stop)
+
+        self.io_loop.add_callback(partial(WSClient, self.get_url('/ws/'), self.io_loop, 'anon'))
+        self.wait()
+        self.assertEqual(len(self.delayed_assertions), 1)
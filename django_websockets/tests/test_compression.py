@@ -0,0 +1,292 @@
+import threading
+import zlib
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, TestCase
+from tornado import gen
+from tornado.httpclient import HTTPRequest
+from tornado.testing import AsyncTestCase, gen_test
+from tornado.websocket import websocket_connect
+
+from django_websockets.app import get_app
+from django_websockets.clients import AllClients
+from django_websockets.compression import (COMPRESSION_DEFAULTS, DeflateCompressor, acceptable_offer,
+                                           compression_options, negotiate)
+from django_websockets.handlers import AnonEchoHandler, all_clients
+from django_websockets.protocol import OPCODE_TEXT, WebSocketProtocol, build_frame
+from .test_protocol import FakeHandler as ProtocolHandler
+from .utils import AsyncHTTPTestCaseExtra
+
+MESSAGE = ('{"type": "status", "users": [%s]}' % ', '.join(
+    '{"id": %d, "name": "user %d", "online": true}' % (i, i) for i in range(50))).encode()
+
+compress_message = DeflateCompressor.compress
+
+
+def decompress(data, wbits=zlib.MAX_WBITS):
+    return zlib.decompressobj(-wbits).decompress(data + b'\x00\x00\xff\xff')
+
+
+@gen.coroutine
+def close_connection(conn):
+    # wait for the server to respond so the handler is removed from all_clients before the next test
+    conn.close()
+    while (yield conn.read_message()) is not None:
+        pass
+
+
+class CompressionOptionsTestCase(SimpleTestCase):
+    def test_disabled(self):
+        self.assertIsNone(compression_options(None))
+        self.assertIsNone(compression_options(False))
+
+    def test_preset(self):
+        self.assertEqual(compression_options('default'), COMPRESSION_DEFAULTS)
+        options = compression_options('low_memory')
+        self.assertEqual(options['wbits'], 10)
+        self.assertFalse(options['context_takeover'])
+
+    def test_dict(self):
+        self.assertEqual(compression_options({'level': 1}), dict(COMPRESSION_DEFAULTS, level=1))
+        options = compression_options({'preset': 'low_memory', 'min_size': 10})
+        self.assertEqual((options['wbits'], options['min_size']), (10, 10))
+
+    def test_invalid(self):
+        with self.assertRaisesRegex(ValueError, 'invalid compression preset'):
+            compression_options('foobar')
+        with self.assertRaisesRegex(ValueError, 'invalid compression options: foo'):
+            compression_options({'foo': 1})
+        with self.assertRaisesRegex(ValueError, 'invalid compression wbits 8'):
+            compression_options({'wbits': 8})
+
+
+class DeflateCompressorTestCase(SimpleTestCase):
+    def test_persistent(self):
+        compressor = DeflateCompressor(6, 15, 8, persistent=True)
+        decompressor = zlib.decompressobj(-15)
+        first = compressor.compress(MESSAGE)
+        second = compressor.compress(MESSAGE)
+        self.assertLess(len(second), len(first))
+        self.assertEqual(decompressor.decompress(first + b'\x00\x00\xff\xff'), MESSAGE)
+        self.assertEqual(decompressor.decompress(second + b'\x00\x00\xff\xff'), MESSAGE)
+
+    def test_not_persistent(self):
+        compressor = DeflateCompressor(6, 10, 4, persistent=False)
+        first = compressor.compress(MESSAGE)
+        self.assertLess(len(first), len(MESSAGE) / 3)
+        self.assertEqual(compressor.compress(MESSAGE), first)
+        self.assertEqual(decompress(first), MESSAGE)
+
+    def test_negotiate_default(self):
+        params = {'client_max_window_bits': None}
+        compressor = negotiate(compression_options('default'), params)
+        self.assertEqual(params, {'client_max_window_bits': '15'})
+        self.assertTrue(compressor.persistent)
+        self.assertEqual(compressor.wbits, 15)
+
+    def test_negotiate_low_memory(self):
+        params = {'client_max_window_bits': None}
+        compressor = negotiate(compression_options('low_memory'), params)
+        self.assertEqual(params, {'client_max_window_bits': '10', 'client_no_context_takeover': None,
+                                  'server_no_context_takeover': None})
+        self.assertFalse(compressor.persistent)
+        self.assertEqual(compressor.wbits, 10)
+
+    def test_negotiate_client_limits(self):
+        params = {'server_max_window_bits': '9', 'server_no_context_takeover': None}
+        compressor = negotiate(compression_options('default'), params)
+        self.assertEqual(params, {'server_max_window_bits': '9', 'server_no_context_takeover': None})
+        self.assertFalse(compressor.persistent)
+        self.assertEqual(compressor.wbits, 9)
+
+
+class AcceptableOfferTestCase(SimpleTestCase):
+    def test_acceptable(self):
+        self.assertTrue(acceptable_offer({}))
+        self.assertTrue(acceptable_offer({'client_max_window_bits': None, 'server_no_context_takeover': None}))
+        self.assertTrue(acceptable_offer({'server_max_window_bits': '9', 'client_max_window_bits': '8'}))
+
+    def test_not_acceptable(self):
+        # zlib can't compress with an 8 bit window
+        self.assertFalse(acceptable_offer({'server_max_window_bits': '8'}))
+        self.assertFalse(acceptable_offer({'server_max_window_bits': '16'}))
+        self.assertFalse(acceptable_offer({'client_max_window_bits': 'foo'}))
+        self.assertFalse(acceptable_offer({'foo': None}))
+
+    def test_first_acceptable_offer_used(self):
+        protocol = WebSocketProtocol(ProtocolHandler())
+        extensions = protocol._parse_extensions_header({
+            'Sec-WebSocket-Extensions': 'permessage-deflate; server_max_window_bits=8, '
+                                        'permessage-deflate; server_max_window_bits=10, foo',
+        })
+        self.assertEqual(extensions, [('permessage-deflate', {'server_max_window_bits': '10'}), ('foo', {})])
+
+
+class CompressionWebSocketTest(AsyncHTTPTestCaseExtra, TestCase):
+    def get_app(self):
+        return get_app(False, [('/', AnonEchoHandler, {'compression': 'low_memory'})])
+
+    @gen_test
+    def test_echo(self):
+        conn = yield websocket_connect(self.get_url('/ws/').replace('http', 'ws'), compression_options={})
+        h = next(iter(all_clients))
+        protocol = h.ws_connection
+        self.assertIsInstance(protocol._compressor, DeflateCompressor)
+        self.assertFalse(protocol._compressor.persistent)
+        self.assertEqual(protocol._compressor.wbits, 10)
+        self.assertIsNone(protocol._decompressor._decompressor)
+        self.assertIsNone(conn.protocol._compressor._compressor)
+
+        conn.write_message(MESSAGE.decode())
+        msg = yield conn.read_message()
+        self.assertEqual(msg, MESSAGE.decode())
+        self.assertLess(protocol._wire_bytes_out, len(MESSAGE) / 3)
+
+        # below min_size so sent uncompressed
+        wire_bytes = protocol._wire_bytes_out
+        conn.write_message('hello')
+        msg = yield conn.read_message()
+        self.assertEqual(msg, 'hello')
+        self.assertEqual(protocol._wire_bytes_out - wire_bytes, 2 + len('hello'))
+        yield close_connection(conn)
+        self.assertEqual(len(all_clients), 0)
+
+    @gen_test
+    def test_8_bit_window_offer(self):
+        request = HTTPRequest(self.get_url('/ws/').replace('http', 'ws'), headers={
+            'Sec-WebSocket-Extensions': 'permessage-deflate; server_max_window_bits=8',
+        })
+        conn = yield websocket_connect(request)
+        self.assertIsNone(next(iter(all_clients)).ws_connection._compressor)
+        conn.write_message(MESSAGE.decode())
+        msg = yield conn.read_message()
+        self.assertEqual(msg, MESSAGE.decode())
+        yield close_connection(conn)
+        self.assertEqual(len(all_clients), 0)
+
+    @gen_test
+    def test_client_without_compression(self):
+        conn = yield websocket_connect(self.get_url('/ws/').replace('http', 'ws'))
+        self.assertIsNone(next(iter(all_clients)).ws_connection._compressor)
+        conn.write_message(MESSAGE.decode())
+        msg = yield conn.read_message()
+        self.assertEqual(msg, MESSAGE.decode())
+        yield close_connection(conn)
+        self.assertEqual(len(all_clients), 0)
+
+
+class NoCompressionWebSocketTest(AsyncHTTPTestCaseExtra, TestCase):
+    def get_app(self):
+        return get_app(False, [('/', AnonEchoHandler)])
+
+    @gen_test
+    def test_disabled_by_default(self):
+        conn = yield websocket_connect(self.get_url('/ws/').replace('http', 'ws'), compression_options={})
+        self.assertIsNone(next(iter(all_clients)).ws_connection._compressor)
+        self.assertIsNone(conn.protocol._compressor)
+        yield close_connection(conn)
+        self.assertEqual(len(all_clients), 0)
+
+
+class BroadcastHandler(ProtocolHandler):
+    user = None
+    outbound_buffer_bytes = 1000000
+
+    def __init__(self, compression=None):
+        super(BroadcastHandler, self).__init__()
+        self.ws_connection = WebSocketProtocol(self)
+        options = compression_options(compression)
+        if options:
+            self.ws_connection._compression_options = options
+            self.ws_connection._create_compressors('server', {})
+
+    @property
+    def payloads(self):
+        """
+        decompress everything written, assumes each frame is one write and has a 2 or 4 byte header
+        """
+        payloads = []
+        for frame in self.stream.written:
+            data = frame[4:] if frame[1] == 126 else frame[2:]
+            payloads.append(decompress(data) if frame[0] & 0x40 else data)
+        return payloads
+
+
+class CompressedBroadcastTestCase(AsyncTestCase):
+    def setUp(self):
+        super(CompressedBroadcastTestCase, self).setUp()
+        self.clients = AllClients()
+
+    def add(self, compression):
+        h = BroadcastHandler(compression)
+        self.clients.append(h)
+        return h
+
+    @patch('django_websockets.settings.WS_COMPRESSION_THREADS', 0)
+    def test_shared_frame(self):
+        stateless = [self.add('no_context') for _ in range(3)]
+        other = self.add({'preset': 'no_context', 'level': 1})
+        persistent = [self.add('default') for _ in range(2)]
+        plain = self.add(None)
+        with patch.object(DeflateCompressor, 'compress', side_effect=compress_message, autospec=True) as compress:
+            self.assertEqual(self.clients.broadcast(MESSAGE), 7)
+        # once for each set of stateless options and once for each persistent client
+        self.assertEqual(compress.call_count, 4)
+        self.assertEqual(stateless[0].stream.written, stateless[1].stream.written)
+        self.assertIs(stateless[0].stream.written[0], stateless[2].stream.written[0])
+        self.assertNotEqual(stateless[0].stream.written, other.stream.written)
+        for h in stateless + [other] + persistent + [plain]:
+            self.assertEqual(h.payloads, [MESSAGE])
+            self.assertEqual(h.ws_connection._message_bytes_out, len(MESSAGE))
+        self.assertEqual(plain.stream.written, [build_frame(OPCODE_TEXT, MESSAGE)])
+
+    @patch('django_websockets.settings.WS_COMPRESSION_THREAD_BYTES', 1000)
+    @gen_test
+    def test_compressed_in_thread(self):
+        stateless = [self.add('no_context') for _ in range(2)]
+        persistent = self.add('default')
+        threads = []
+
+        def compress(compressor, data):
+            threads.append(threading.current_thread())
+            return compress_message(compressor, data)
+        with patch.object(DeflateCompressor, 'compress', side_effect=compress, autospec=True):
+            self.clients.broadcast(MESSAGE)
+            self.clients.broadcast('small')
+            self.assertEqual(stateless[0].stream.written, [])
+            self.assertEqual(len(persistent.stream.written), 2)
+            while not stateless[0].stream.written:
+                yield gen.moment
+        self.assertEqual(len(threads), 3)
+        self.assertEqual(sum(t is threading.current_thread() for t in threads), 2)
+        for h in stateless + [persistent]:
+            self.assertEqual(h.payloads, [MESSAGE, b'small'])
+
+    @patch('django_websockets.settings.WS_COMPRESSION_THREADS', 0)
+    def test_compression_error_other_groups(self):
+        failing = self.add('no_context')
+        other = self.add({'preset': 'no_context', 'level': 1})
+
+        def compress(compressor, data):
+            if compressor.level != 1:
+                raise ValueError('Invalid initialization option')
+            return compress_message(compressor, data)
+        with patch.object(DeflateCompressor, 'compress', side_effect=compress, autospec=True), \
+                patch('django_websockets.clients.logger') as logger:
+            self.assertEqual(self.clients.broadcast(MESSAGE), 2)
+        self.assertEqual(failing.stream.written, [])
+        self.assertEqual(other.payloads, [MESSAGE])
+        self.assertTrue(logger.exception.called)
+
+    @patch('django_websockets.settings.WS_COMPRESSION_THREAD_BYTES', 1000)
+    @gen_test
+    def test_compression_error(self):
+        h = self.add('no_context')
+        with patch.object(DeflateCompressor, 'compress', side_effect=RuntimeError('boom')), \
+                patch('django_websockets.clients.logger') as logger:
+            self.clients.broadcast(MESSAGE)
+            self.clients.broadcast('small')
+            while not h.stream.written:
+                yield gen.moment
+        self.assertEqual(h.payloads, [b'small'])
+        self.assertTrue(logger.exception.called)
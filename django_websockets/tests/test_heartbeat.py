@@ -0,0 +1,166 @@
+from functools import partial
+from unittest.mock import patch
+
+from django.test import TestCase
+from tornado.testing import AsyncTestCase
+
+from django_websockets.app import get_app
+from django_websockets.handlers import AnonSocketHandler, all_clients
+from django_websockets.heartbeat import HEARTBEAT_PING, HeartbeatScheduler, get_heartbeat_scheduler, is_heartbeat_pong
+from .utils import AsyncHTTPTestCaseExtra, FakeHandler, WebSocketClient
+
+
+class PingConnection(object):
+    def __init__(self):
+        self.pings = []
+
+    def write_ping(self, data):
+        self.pings.append(data)
+
+
+class HeartbeatHandler(FakeHandler):
+    def __init__(self):
+        super(HeartbeatHandler, self).__init__()
+        self.ws_connection = PingConnection()
+        self.closed = None
+        self.rtts = []
+
+    def close(self, code=None, reason=None):
+        self.closed = code, reason
+
+    def on_heartbeat_rtt(self, rtt):
+        self.rtts.append(rtt)
+
+
+class HeartbeatSchedulerTestCase(AsyncTestCase):
+    def setUp(self):
+        super(HeartbeatSchedulerTestCase, self).setUp()
+        self.scheduler = HeartbeatScheduler(interval=10, slots=5, max_missed=2)
+
+    def tearDown(self):
+        self.scheduler.stop()
+        super(HeartbeatSchedulerTestCase, self).tearDown()
+
+    def tick_interval(self):
+        for _ in range(self.scheduler.slots):
+            self.scheduler.tick()
+
+    def test_spread(self):
+        handlers = [HeartbeatHandler() for _ in range(12)]
+        for h in handlers:
+            self.scheduler.add(h)
+        self.scheduler.add(handlers[0])
+        self.assertEqual(len(self.scheduler), 12)
+        self.assertEqual([len(slot) for slot in self.scheduler._wheel], [3, 3, 2, 2, 2])
+        self.scheduler.tick()
+        self.assertEqual(sum(len(h.ws_connection.pings) for h in handlers), 3)
+        for _ in range(4):
+            self.scheduler.tick()
+        self.assertEqual([h.ws_connection.pings for h in handlers], [[HEARTBEAT_PING + b'\x00\x00\x00\x01']] * 12)
+        self.assertEqual(self.scheduler.pings, 12)
+
+    def test_pong(self):
+        h = HeartbeatHandler()
+        self.scheduler.add(h)
+        for _ in range(3):
+            self.tick_interval()
+            self.scheduler.pong(h, h.ws_connection.pings[-1])
+        self.assertIsNone(h.closed)
+        self.assertEqual(len(h.rtts), 3)
+        self.assertEqual(self.scheduler.rtt_count, 3)
+        self.assertGreaterEqual(self.scheduler.rtt_max, 0)
+        # unexpected pongs are ignored
+        self.scheduler.pong(h, h.ws_connection.pings[-1])
+        self.scheduler.pong(HeartbeatHandler(), h.ws_connection.pings[-1])
+        self.assertEqual(self.scheduler.rtt_count, 3)
+
+    def test_rtt_after_missed_ping(self):
+        h = HeartbeatHandler()
+        self.scheduler.add(h)
+        with patch.object(self.io_loop, 'time') as time:
+            time.return_value = 100
+            self.tick_interval()
+            time.return_value = 110
+            self.tick_interval()
+            time.return_value = 110.05
+            # answers the second ping, the first was lost
+            self.scheduler.pong(h, h.ws_connection.pings[1])
+            self.assertAlmostEqual(h.rtts[0], 0.05)
+            # a late answer to the first ping is ignored
+            self.scheduler.pong(h, h.ws_connection.pings[0])
+        self.assertEqual(len(h.rtts), 1)
+        self.tick_interval()
+        self.tick_interval()
+        self.assertIsNone(h.closed)
+
+    def test_is_heartbeat_pong(self):
+        self.assertTrue(is_heartbeat_pong(HEARTBEAT_PING + b'\x00\x00\x00\x01'))
+        self.assertFalse(is_heartbeat_pong(HEARTBEAT_PING))
+        self.assertFalse(is_heartbeat_pong(b'1434567890.123'))
+
+    def test_reap(self):
+        h = HeartbeatHandler()
+        self.scheduler.add(h)
+        self.tick_interval()
+        self.tick_interval()
+        self.assertIsNone(h.closed)
+        self.assertEqual(len(h.ws_connection.pings), 2)
+        self.tick_interval()
+        self.assertEqual(h.closed, (1001, 'heartbeat timeout'))
+        self.assertNotIn(h, self.scheduler)
+        self.assertEqual(self.scheduler.reaped, 1)
+
+    def test_remove(self):
+        h = HeartbeatHandler()
+        self.scheduler.add(h)
+        self.assertIsNotNone(self.scheduler._periodic)
+        self.scheduler.remove(h)
+        self.scheduler.remove(h)
+        self.assertEqual(len(self.scheduler), 0)
+        self.assertIsNone(self.scheduler._periodic)
+
+    def test_closed_connection(self):
+        h = HeartbeatHandler()
+        h.ws_connection = None
+        self.scheduler.add(h)
+        self.tick_interval()
+        self.assertEqual(len(self.scheduler), 0)
+
+
+class OnPongHandler(AnonSocketHandler):
+    pongs = []
+
+    def on_pong(self, data):
+        # doesn't call super
+        self.pongs.append(data)
+
+
+class HeartbeatWebSocketTest(AsyncHTTPTestCaseExtra, TestCase):
+    def get_app(self):
+        return get_app(False, [('/', OnPongHandler)])
+
+    def test_heartbeat(self):
+        scheduler = HeartbeatScheduler(interval=0.05, slots=5)
+        test_case = self
+
+        class WSClient(WebSocketClient):
+            pings = 0
+
+            def on_ping(self):
+                WSClient.pings += 1
+                if WSClient.pings == 3:
+                    test_case.delayed_assertions.append((len(scheduler), 1))
+                    self.close()
+
+            def on_close(self, code=None, reason=None):
+                test_case.io_loop.add_callback(test_case.stop)
+
+        with patch('django_websockets.heartbeat._scheduler', scheduler):
+            self.assertIs(get_heartbeat_scheduler(), scheduler)
+            self.io_loop.add_callback(partial(WSClient, self.get_url('/ws/'), self.io_loop))
+            self.wait()
+        self.assertGreaterEqual(scheduler.rtt_count, 2)
+        # heartbeat pongs aren't passed to on_pong
+        self.assertEqual(OnPongHandler.pongs, [])
+        self.assertEqual(len(scheduler), 0)
+        self.assertEqual(len(all_clients), 0)
@@ -4,7 +4,7 @@ import io
 from unittest.mock import patch, call
 
 from django.test import TestCase
-from django.core.management import call_command
+from django.core.management import call_command, CommandError
 
 # we have to import this now to avoid it messing with loggers during tests
 import django_websockets.tests.wsgi  # flake8: noqa
@@ -76,6 +76,14 @@ class ManagementCommandTestCase(TestCase):
                                '  "/ws/" > django_websockets.handlers.AnonEchoHandler\n'
                                '  ".*" > tornado.web.FallbackHandler\n')
 
+    @patch('django_websockets.settings.WS_TOKEN_REVOCATION_CACHE', 'default')
+    @patch('django_websockets.management.commands.websockets._start_server')
+    def test_revocation_cache_locmem(self, man_start_server):
+        with CaptureStd():
+            call_command('websockets', '--nodjango')
+        self.assertTrue(self.stream.getvalue().startswith(
+            'WARNING: settings.WS_TOKEN_REVOCATION_CACHE "default" is a local memory cache'))
+
     @patch('logging.Logger.addHandler')
     @patch('logging.Logger.hasHandlers')
     def test_cmd_logger(self, logging_has_handler, logging_add_handler):
@@ -86,3 +94,63 @@ class ManagementCommandTestCase(TestCase):
         importlib.reload(django_websockets.management.commands.websockets)
         self.assertTrue(logging_has_handler.called)
         self.assertTrue(logging_add_handler.called)
+
+    @patch('django_websockets.management.commands.websockets_broker._start_server')
+    @patch('django_websockets.backplane.BrokerServer.bind_address')
+    def test_cmd_broker(self, bind_address, man_start_server):
+        with CaptureStd() as std:
+            call_command('websockets_broker', '--address', 'unix:/tmp/testing.sock')
+        self.assertTrue(man_start_server.called)
+        bind_address.assert_called_once_with('unix:/tmp/testing.sock')
+        self.assertEqual(std.captured, '\ndjango-websockets broker, listening on unix:/tmp/testing.sock\n')
+
+    @patch('django_websockets.settings.DEBUG', False)
+    @patch('django_websockets.management.commands.websockets.IOLoop')
+    @patch('django_websockets.management.commands.websockets.HTTPServer')
+    @patch('django_websockets.management.commands.websockets.fork_processes')
+    @patch('django_websockets.management.commands.websockets.bind_sockets')
+    def test_cmd_workers(self, bind_sockets, fork_processes, http_server, io_loop):
+        fork_processes.return_value = 2
+        with CaptureStd() as std:
+            call_command('websockets', '--workers', '4')
+        bind_sockets.assert_called_once_with(8000)
+        fork_processes.assert_called_once_with(4)
+        http_server.return_value.add_sockets.assert_called_once_with(bind_sockets.return_value)
+        self.assertEqual(io_loop.mock_calls[-2:], [call.instance(), call.instance().start()])
+        self.assertIn('Starting server on port 8000\nUsing 4 worker processes\n', std.captured)
+
+        logs = self.stream.getvalue()
+        self.assertTrue(logs.startswith('WARNING: 4 workers without settings.WS_BACKPLANE'))
+        self.assertIn('worker 2: started, pid', logs)
+        self.assertIn('worker 2: Creating tornado application, with the 2 handlers:\n', logs)
+        self.logger.filters = []
+
+    def test_workers_default(self):
+        try:
+            with self.settings(DEBUG=False):
+                importlib.reload(settings)
+                self.assertEqual(settings.WS_WORKERS, 1)
+            with self.settings(DEBUG=False, WS_BACKPLANE='django_websockets.backplane.BrokerBackplane'):
+                importlib.reload(settings)
+                self.assertEqual(settings.WS_WORKERS, 0)
+            with self.settings(DEBUG=True, WS_BACKPLANE='django_websockets.backplane.BrokerBackplane'):
+                importlib.reload(settings)
+                self.assertEqual(settings.WS_WORKERS, 1)
+        finally:
+            importlib.reload(settings)
+
+    @patch('django_websockets.settings.DEBUG', True)
+    def test_cmd_workers_debug(self):
+        with CaptureStd():
+            self.assertRaises(CommandError, call_command, 'websockets', '--workers', '4')
+
+    @patch('django_websockets.management.commands.websockets.start_watchdog')
+    @patch('django_websockets.management.commands.websockets._start_server')
+    def test_cmd_watchdog(self, man_start_server, start_watchdog):
+        with CaptureStd():
+            call_command('websockets', '--nodjango')
+        self.assertFalse(start_watchdog.called)
+        with CaptureStd():
+            call_command('websockets', '--nodjango', '--watchdog')
+        self.assertTrue(start_watchdog.called)
+        self.assertEqual(man_start_server.call_count, 2)
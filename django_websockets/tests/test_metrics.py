@@ -0,0 +1,90 @@
+from unittest.mock import patch
+
+from django.test import SimpleTestCase
+
+from django_websockets.metrics import LogHistogram, WindowedHistogram, record_rtt, rtt_histograms
+from .test_cache import FakeTimer
+from .utils import FakeHandler
+
+
+class LogHistogramTestCase(SimpleTestCase):
+    def test_empty(self):
+        h = LogHistogram()
+        self.assertIsNone(h.percentile(50))
+        self.assertEqual(h.summary(), {'count': 0, 'mean': None, 'min': None, 'max': None,
+                                       'p50': None, 'p90': None, 'p99': None, 'p999': None})
+
+    def test_percentiles(self):
+        h = LogHistogram()
+        for i in range(1, 1001):
+            h.record(i)
+        summary = h.summary()
+        self.assertEqual((summary['count'], summary['min'], summary['max']), (1000, 1, 1000))
+        self.assertAlmostEqual(summary['mean'], 500.5)
+        for key, expected in (('p50', 500), ('p90', 900), ('p99', 990), ('p999', 999)):
+            # percentiles are within the histogram's relative error
+            self.assertGreaterEqual(summary[key], expected)
+            self.assertLessEqual(summary[key], expected * h.growth)
+
+    def test_range(self):
+        h = LogHistogram(lowest=1, highest=100)
+        h.record(0.001)
+        h.record(10 ** 6)
+        self.assertEqual((h.counts[0], h.counts[-1]), (1, 1))
+        self.assertEqual(h.percentile(0), 1)
+        self.assertEqual(h.percentile(100), 10 ** 6)
+
+    def test_fixed_memory(self):
+        h = LogHistogram()
+        buckets = len(h.counts)
+        for i in range(10000):
+            h.record(i * 1.7)
+        self.assertEqual(len(h.counts), buckets)
+
+    def test_merge(self):
+        a, b = LogHistogram(), LogHistogram()
+        a.record(5)
+        b.record(1)
+        b.record(50)
+        a.merge(b)
+        a.merge(LogHistogram())
+        self.assertEqual((a.count, a.min, a.max, a.total), (3, 1, 50, 56))
+
+
+class WindowedHistogramTestCase(SimpleTestCase):
+    def setUp(self):
+        self.timer = FakeTimer()
+        self.h = WindowedHistogram(window=60, slices=6, timer=self.timer)
+
+    def test_window(self):
+        self.h.record(1)
+        self.timer.now = 30
+        self.h.record(2)
+        self.assertEqual(self.h.snapshot().count, 2)
+        self.timer.now = 65
+        # the first slice has aged out
+        self.assertEqual(self.h.summary()['min'], 2)
+        self.timer.now = 95
+        self.assertEqual(self.h.snapshot().count, 0)
+
+    def test_long_gap(self):
+        self.h.record(1)
+        self.timer.now = 1000
+        self.assertEqual(self.h.snapshot().count, 0)
+        self.h.record(3)
+        self.assertEqual(self.h.snapshot().count, 1)
+
+
+class RecordRttTestCase(SimpleTestCase):
+    def setUp(self):
+        rtt_histograms.clear()
+
+    def test_record_rtt(self):
+        record_rtt(FakeHandler(), 12.5)
+        self.assertEqual(list(rtt_histograms), ['all'])
+        self.assertEqual(rtt_histograms['all'].summary()['p50'], 12.5)
+
+    @patch('django_websockets.settings.WS_RTT_PER_HANDLER', True)
+    def test_per_handler(self):
+        record_rtt(FakeHandler(), 12.5)
+        self.assertEqual(sorted(rtt_histograms), ['FakeHandler', 'all'])
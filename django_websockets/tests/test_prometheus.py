@@ -0,0 +1,92 @@
+from functools import partial
+from unittest.mock import patch
+
+from django.test import TestCase
+from tornado.testing import AsyncTestCase
+
+from django_websockets.app import get_app
+from django_websockets.handlers import AnonEchoHandler
+from django_websockets.metrics import LoopLagMonitor, loop_lag, record_rtt, rtt_histograms
+from django_websockets.prometheus import MetricsWriter, render_metrics
+from django_websockets.protocol import traffic_stats
+from .utils import AsyncHTTPTestCaseExtra, WebSocketClient
+
+
+class MetricsWriterTestCase(TestCase):
+    def test_metric(self):
+        w = MetricsWriter()
+        w.metric('things_total', 'counter', 'Things.', [({'kind': 'a "b"\n'}, 3), ({}, 1.5), ({}, None)])
+        self.assertEqual(w.render(), '# HELP djws_things_total Things.\n'
+                                     '# TYPE djws_things_total counter\n'
+                                     'djws_things_total{kind="a \\"b\\"\\n"} 3\n'
+                                     'djws_things_total 1.5\n')
+
+    def test_render_metrics(self):
+        text = render_metrics()
+        self.assertIn('# TYPE djws_connections gauge\n', text)
+        self.assertIn('djws_token_cache_hits_total{cache="validated"} ', text)
+        self.assertIn('# TYPE djws_broadcast_fanout summary\n', text)
+
+    @patch('django_websockets.settings.WS_RTT_PER_HANDLER', True)
+    def test_rtt(self):
+        rtt_histograms.clear()
+        record_rtt(AnonEchoHandler.__new__(AnonEchoHandler), 12.5)
+        text = render_metrics()
+        rtt_histograms.clear()
+        self.assertIn('djws_ping_rtt_milliseconds{quantile="0.5"} 12.5\n', text)
+        self.assertIn('djws_handler_ping_rtt_milliseconds{handler="AnonEchoHandler",quantile="0.5"} 12.5\n', text)
+        self.assertNotIn('handler="all"', text)
+
+
+class MetricsHandlerTest(AsyncHTTPTestCaseExtra, TestCase):
+    def get_app(self):
+        with patch('django_websockets.settings.WS_METRICS_URL', '/metrics'):
+            return get_app(False, [('/', AnonEchoHandler)])
+
+    def test_metrics(self):
+        r = self.fetch('/metrics')
+        self.assertEqual(r.code, 200)
+        self.assertEqual(r.headers['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        self.assertIn('# TYPE djws_loop_lag_milliseconds summary', r.body.decode())
+
+    def test_connection_counted(self):
+        test_case = self
+        messages_in = traffic_stats['messages_in']
+
+        class WSClient(WebSocketClient):
+            def on_open(self):
+                self.write_message('hello')
+
+            def on_message(self, data):
+                test_case.http_client.fetch(test_case.get_url('/metrics'), self.on_metrics)
+
+            def on_metrics(self, r):
+                test_case.delayed_assertions.append(
+                    ('djws_connections{auth="anon",handler="AnonEchoHandler"} 1' in r.body.decode(), True))
+                self.close()
+
+            def on_close(self, code=None, reason=None):
+                test_case.io_loop.add_callback(test_case.stop)
+
+        self.io_loop.add_callback(partial(WSClient, self.get_url('/ws/'), self.io_loop))
+        self.wait()
+        self.assertEqual(traffic_stats['messages_in'], messages_in + 1)
+
+
+class LoopLagMonitorTestCase(AsyncTestCase):
+    def test_lag(self):
+        count = loop_lag.snapshot().count
+        lags = []
+
+        class Monitor(LoopLagMonitor):
+            def on_lag(self_, lag):
+                lags.append(lag)
+                self_.stop()
+                self.stop()
+
+        monitor = Monitor(0.01)
+        monitor.start(self.io_loop)
+        self.wait()
+        self.assertEqual(len(lags), 1)
+        self.assertGreaterEqual(lags[0], 0)
+        self.assertEqual(loop_lag.snapshot().count, count + 1)
@@ -0,0 +1,292 @@
+from django.test import TestCase
+from tornado import gen
+from tornado.iostream import StreamClosedError
+from tornado.testing import AsyncTestCase, gen_test
+
+from django_websockets.protocol import (build_frame, encode_message, outbound_bytes, slow_consumer_stats,
+                                        traffic_stats, WebSocketProtocol, OPCODE_CLOSE, OPCODE_TEXT, OPCODE_BINARY)
+
+
+class FakeStream(object):
+    def __init__(self):
+        self.written = []
+        self.callback = None
+        self._write_buffer_size = 0
+        self._closed = False
+
+    def write(self, data, callback=None):
+        if self._closed:
+            raise StreamClosedError()
+        if data:
+            self.written.append(data)
+        self._write_buffer_size += len(data)
+        if callback is not None:
+            self.callback = callback
+
+    def drain(self):
+        self._write_buffer_size = 0
+        callback, self.callback = self.callback, None
+        if callback:
+            callback()
+
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        self._closed = True
+
+
+class FakeHandler(object):
+    request = None
+    outbound_buffer_bytes = 10
+    outbound_max_bytes = 100
+    outbound_max_messages = 3
+    outbound_policy = 'drop_oldest'
+    outbound_close_code = 1013
+    coalesce_writes = False
+    coalesce_delay = 0
+    coalesce_max_bytes = 1000
+
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+        self.stream = FakeStream()
+        self.closed_with = None
+
+    def close(self, code=None, reason=None):
+        self.closed_with = code, reason
+
+
+def get_protocol(**attrs):
+    handler = FakeHandler(**attrs)
+    return WebSocketProtocol(handler), handler.stream
+
+
+def frame(i):
+    return build_frame(OPCODE_TEXT, ('message %d' % i).encode())
+
+
+class FramingTestCase(TestCase):
+    def test_encode_message(self):
+        self.assertEqual(encode_message('☃'), (OPCODE_TEXT, b'\xe2\x98\x83'))
+        self.assertEqual(encode_message(b'\x00', binary=True), (OPCODE_BINARY, b'\x00'))
+
+    def test_frame_lengths(self):
+        self.assertEqual(build_frame(OPCODE_TEXT, b'x' * 125)[:2], b'\x81\x7d')
+        self.assertEqual(build_frame(OPCODE_TEXT, b'x' * 126)[:4], b'\x81\x7e\x00\x7e')
+        self.assertEqual(build_frame(OPCODE_BINARY, b'x' * 0x10000)[:10], b'\x82\x7f\x00\x00\x00\x00\x00\x01\x00\x00')
+        self.assertEqual(build_frame(OPCODE_TEXT, b'', fin=False), b'\x01\x00')
+
+
+class OutboundQueueTestCase(TestCase):
+    def setUp(self):
+        slow_consumer_stats.clear()
+
+    def test_write_message(self):
+        protocol, stream = get_protocol()
+        protocol.write_message('hello')
+        self.assertEqual(stream.written, [b'\x81\x05hello'])
+        self.assertEqual(protocol._wire_bytes_out, 7)
+
+    def test_queue_and_flush(self):
+        protocol, stream = get_protocol()
+        protocol.write_frame(frame(0))
+        protocol.write_frame(frame(1))
+        protocol.write_frame(frame(2))
+        self.assertEqual(stream.written, [frame(0)])
+        self.assertEqual((protocol.queued_messages, protocol.queued_bytes), (2, 22))
+        stream.drain()
+        # only one frame is written per drain since each frame is bigger than outbound_buffer_bytes
+        self.assertEqual(stream.written, [frame(0), frame(1)])
+        stream.drain()
+        self.assertEqual(stream.written, [frame(0), frame(1), frame(2)])
+        self.assertEqual((protocol.queued_messages, protocol.queued_bytes), (0, 0))
+        self.assertEqual(slow_consumer_stats, {})
+
+    def test_control_frames_not_queued(self):
+        protocol, stream = get_protocol()
+        protocol.write_frame(frame(0))
+        protocol.write_frame(frame(1))
+        protocol.write_ping(b'')
+        self.assertEqual(stream.written, [frame(0), b'\x89\x00'])
+
+    def _fill(self, protocol, count=5):
+        for i in range(count):
+            protocol.write_frame(frame(i))
+
+    def test_drop_oldest(self):
+        protocol, stream = get_protocol()
+        self._fill(protocol)
+        self.assertEqual(list(protocol._queue), [frame(2), frame(3), frame(4)])
+        self.assertEqual(slow_consumer_stats, {'drop_oldest': 1})
+
+    def test_drop_newest(self):
+        protocol, stream = get_protocol(outbound_policy='drop_newest')
+        self._fill(protocol)
+        self.assertEqual(list(protocol._queue), [frame(1), frame(2), frame(3)])
+        self.assertEqual(slow_consumer_stats, {'drop_newest': 1})
+
+    def test_coalesce(self):
+        protocol, stream = get_protocol(outbound_policy='coalesce')
+        self._fill(protocol)
+        self.assertEqual(list(protocol._queue), [frame(4)])
+        self.assertEqual(slow_consumer_stats, {'coalesce': 1})
+
+    def test_close(self):
+        protocol, stream = get_protocol(outbound_policy='close', outbound_close_code=1008)
+        self._fill(protocol)
+        self.assertEqual(protocol.handler.closed_with, (1008, 'client too slow'))
+        self.assertEqual(protocol.queued_messages, 0)
+        self.assertEqual(slow_consumer_stats, {'close': 1})
+
+    def test_max_bytes(self):
+        protocol, stream = get_protocol(outbound_max_messages=100, outbound_max_bytes=25)
+        self._fill(protocol)
+        self.assertEqual(list(protocol._queue), [frame(3), frame(4)])
+        self.assertEqual(protocol.queued_bytes, 22)
+        self.assertEqual(slow_consumer_stats, {'drop_oldest': 2})
+
+    def test_closed_stream(self):
+        protocol, stream = get_protocol()
+        self._fill(protocol)
+        stream.close()
+        stream.drain()
+        self.assertEqual(stream.written, [frame(0)])
+
+    def test_close_frame_last(self):
+        protocol, stream = get_protocol()
+        self._fill(protocol, 3)
+        # equivalent of WebSocketProtocol13.close without the timeout
+        protocol._write_frame(True, OPCODE_CLOSE, b'\x03\xe8')
+        protocol.server_terminated = True
+        protocol.write_frame(frame(3))
+        protocol.write_message('late')
+        self.assertEqual(stream.written, [frame(0)])
+        for _ in range(4):
+            stream.drain()
+        self.assertEqual(stream.written, [frame(0), frame(1), frame(2), b'\x88\x02\x03\xe8'])
+
+    def test_close_frame_not_queued(self):
+        protocol, stream = get_protocol()
+        protocol._write_frame(True, OPCODE_CLOSE, b'')
+        protocol.server_terminated = True
+        protocol.write_frame(frame(0))
+        self.assertEqual(stream.written, [b'\x88\x00'])
+
+    def test_outbound_bytes(self):
+        outbound_bytes.clear()
+        protocol, stream = get_protocol()
+        self._fill(protocol, 3)
+        self.assertEqual(outbound_bytes, {'queued': protocol.queued_bytes, 'buffered': len(frame(0))})
+        stream.drain()
+        self.assertEqual(outbound_bytes, {'queued': len(frame(2)), 'buffered': len(frame(1))})
+        protocol._abort()
+        self.assertEqual(outbound_bytes, {'queued': 0, 'buffered': 0})
+
+    def test_invalid_policy(self):
+        self.assertRaises(ValueError, get_protocol, outbound_policy='wrong')
+
+
+class HeldFramesTestCase(TestCase):
+    def test_release_in_order(self):
+        protocol, stream = get_protocol(outbound_buffer_bytes=1000)
+        first = protocol.hold()
+        protocol.write_frame(frame(1))
+        second = protocol.hold()
+        protocol.write_frame(frame(3))
+        self.assertEqual(stream.written, [])
+        protocol.release(second, frame(2))
+        self.assertEqual(stream.written, [])
+        protocol.release(first, frame(0))
+        self.assertEqual(stream.written, [frame(0), frame(1), frame(2), frame(3)])
+        protocol.write_frame(frame(4))
+        self.assertEqual(stream.written[-1], frame(4))
+
+    def test_release_nothing(self):
+        protocol, stream = get_protocol(outbound_buffer_bytes=1000)
+        held = protocol.hold()
+        protocol.write_frame(frame(1))
+        protocol.release(held, None)
+        self.assertEqual(stream.written, [frame(1)])
+
+    def test_release_closed(self):
+        protocol, stream = get_protocol(outbound_buffer_bytes=1000)
+        held = protocol.hold()
+        stream.close()
+        protocol.release(held, frame(0))
+        self.assertEqual(stream.written, [])
+        self.assertEqual(len(protocol._held), 0)
+
+    def test_release_after_close(self):
+        protocol, stream = get_protocol(outbound_buffer_bytes=1000)
+        first = protocol.hold()
+        protocol.write_frame(frame(1))
+        second = protocol.hold()
+        protocol._write_frame(True, OPCODE_CLOSE, b'')
+        protocol.server_terminated = True
+        protocol.release(second, frame(2))
+        protocol.release(first, frame(0))
+        self.assertEqual(stream.written, [b'\x88\x00'])
+        self.assertEqual(len(protocol._held), 0)
+        self.assertEqual(protocol._message_bytes_out, 0)
+
+    def test_release_bytes_out(self):
+        protocol, stream = get_protocol(outbound_buffer_bytes=1000)
+        first = protocol.hold()
+        second = protocol.hold()
+        protocol.release(first, frame(0), 9)
+        protocol.release(second, None, 9)
+        self.assertEqual(stream.written, [frame(0)])
+        self.assertEqual(protocol._message_bytes_out, 9)
+
+
+class CoalesceTestCase(AsyncTestCase):
+    def get_protocol(self, **attrs):
+        return get_protocol(**dict(dict(coalesce_writes=True, outbound_buffer_bytes=1000), **attrs))
+
+    @gen_test
+    def test_next_iteration(self):
+        protocol, stream = self.get_protocol()
+        coalesced = traffic_stats['writes_coalesced']
+        for i in range(3):
+            protocol.write_frame(frame(i))
+        self.assertEqual(stream.written, [])
+        yield gen.moment
+        self.assertEqual(stream.written, [frame(0) + frame(1) + frame(2)])
+        self.assertEqual(traffic_stats['writes_coalesced'], coalesced + 2)
+        protocol.write_frame(frame(3))
+        yield gen.moment
+        self.assertEqual(stream.written[1:], [frame(3)])
+
+    @gen_test
+    def test_delay(self):
+        protocol, stream = self.get_protocol(coalesce_delay=0.01)
+        protocol.write_frame(frame(0))
+        yield gen.moment
+        protocol.write_frame(frame(1))
+        self.assertEqual(stream.written, [])
+        yield gen.sleep(0.02)
+        self.assertEqual(stream.written, [frame(0) + frame(1)])
+        self.assertIsNone(protocol._coalesce_timeout)
+
+    def test_max_bytes(self):
+        protocol, stream = self.get_protocol(coalesce_max_bytes=30)
+        for i in range(4):
+            protocol.write_frame(frame(i))
+        self.assertEqual(stream.written, [frame(0) + frame(1) + frame(2)])
+        self.assertEqual(protocol._coalesced, [frame(3)])
+
+    def test_close_frame_flushes(self):
+        protocol, stream = self.get_protocol()
+        protocol.write_frame(frame(0))
+        protocol.write_ping(b'')
+        protocol._write_frame(True, OPCODE_CLOSE, b'')
+        self.assertEqual(stream.written, [b'\x89\x00', frame(0), b'\x88\x00'])
+
+    def test_flushed_before_queue(self):
+        protocol, stream = self.get_protocol(outbound_buffer_bytes=10)
+        protocol.write_frame(frame(0))
+        protocol.write_frame(frame(1))
+        self.assertEqual(stream.written, [frame(0)])
+        self.assertEqual(list(protocol._queue), [frame(1)])
+        stream.drain()
+        self.assertEqual(stream.written, [frame(0), frame(1)])
@@ -0,0 +1,301 @@
+import json
+from functools import partial
+from unittest import skipIf
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from tornado.httpclient import HTTPRequest
+from tornado.testing import gen_test
+from tornado.websocket import websocket_connect
+
+from django_websockets.app import get_app
+from django_websockets.backplane import InProcessBackplane
+from django_websockets.clients import AllClients
+from django_websockets.handlers import AnonSocketHandler, AuthSocketHandler, all_clients, split_subprotocol
+from django_websockets.router import (CODECS, JsonCodec, MessageRouterMixin, MsgpackCodec, OrjsonCodec, get_codec,
+                                      message_handler, router_stats)
+from django_websockets.tokens import make_token
+from .test_compression import close_connection
+from .utils import AsyncHTTPTestCaseExtra, FakeHandler, MessageHandler, WebSocketClient
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+class BinaryJsonCodec(JsonCodec):
+    """
+    json sent as binary frames, used to test binary codecs without msgpack
+    """
+    name = 'bjson'
+    binary = True
+    decoded = []
+
+    def decode(self, data):
+        self.decoded.append(data)
+        return json.loads(bytes(data).decode())
+
+    def encode(self, msg):
+        return super(BinaryJsonCodec, self).encode(msg).encode()
+
+
+class RouterHandler(MessageRouterMixin, FakeHandler):
+    def __init__(self):
+        super(RouterHandler, self).__init__()
+        self.ws_connection = object()
+        self.sent = []
+        self.received = []
+
+    def write_message(self, message, binary=False):
+        self.sent.append((message, binary))
+
+    @message_handler('chat')
+    def on_chat(self, msg):
+        self.received.append(msg)
+
+    @message_handler('ping', 'echo')
+    def on_ping(self, msg):
+        return {'type': 'pong', 'echo': msg.get('echo')}
+
+
+class SubRouterHandler(RouterHandler):
+    @message_handler('chat')
+    def on_sub_chat(self, msg):
+        self.received.append(('sub', msg))
+
+
+class CodecTestCase(SimpleTestCase):
+    def test_json(self):
+        codec = JsonCodec()
+        self.assertEqual(codec.encode({'type': 'x', 'n': [1, 2]}), '{"type":"x","n":[1,2]}')
+        self.assertEqual(codec.decode('{"a": "☃"}'), {'a': '☃'})
+        self.assertEqual(codec.decode('{"a": "☃"}'.encode()), {'a': '☃'})
+        self.assertRaises(ValueError, codec.decode, '{')
+        self.assertRaises(ValueError, codec.decode, b'\xff')
+
+    @skipIf(orjson is None, 'orjson not installed')
+    def test_orjson(self):
+        codec = OrjsonCodec()
+        self.assertEqual(json.loads(codec.encode({'type': 'x'}).decode()), {'type': 'x'})
+        self.assertEqual(codec.decode('{"a": 1}'), {'a': 1})
+        self.assertRaises(ValueError, codec.decode, '{')
+
+    @skipIf(msgpack is None, 'msgpack not installed')
+    def test_msgpack(self):
+        codec = MsgpackCodec()
+        data = codec.encode({'type': 'x', 'values': [1.5, 2], 'raw': b'\x00'})
+        self.assertIsInstance(data, bytes)
+        self.assertEqual(codec.decode(memoryview(data)), {'type': 'x', 'values': [1.5, 2], 'raw': b'\x00'})
+        self.assertRaises(ValueError, codec.decode, data[:-1])
+        self.assertRaises(ValueError, codec.decode, data + b'\xc1')
+
+    @skipIf(msgpack is None, 'msgpack not installed')
+    def test_msgpack_old_version(self):
+        with patch('msgpack.version', (0, 4, 8)):
+            self.assertEqual(MsgpackCodec()._unpack_options, {'encoding': 'utf-8'})
+        self.assertEqual(MsgpackCodec()._unpack_options, {'raw': False})
+
+    def test_get_codec(self):
+        self.assertIsInstance(get_codec('json'), JsonCodec)
+        self.assertIs(get_codec('json'), get_codec('json'))
+        self.assertIsInstance(get_codec('django_websockets.router.JsonCodec'), JsonCodec)
+
+
+class MessageRouterTestCase(SimpleTestCase):
+    def setUp(self):
+        router_stats.clear()
+        self.h = RouterHandler()
+
+    def test_routes(self):
+        self.assertEqual(RouterHandler.get_routes(), {'chat': 'on_chat', 'ping': 'on_ping', 'echo': 'on_ping'})
+        self.assertEqual(SubRouterHandler.get_routes()['chat'], 'on_sub_chat')
+        self.assertIs(RouterHandler.get_routes(), RouterHandler.get_routes())
+
+    def test_dispatch(self):
+        self.h.on_message('{"type": "chat", "text": "hello"}')
+        self.assertEqual(self.h.received, [{'type': 'chat', 'text': 'hello'}])
+        self.assertEqual(self.h.sent, [])
+        self.assertEqual(router_stats, {'routed': 1})
+
+    def test_reply(self):
+        self.h.on_message('{"type": "echo", "echo": 42}')
+        self.assertEqual(self.h.sent, [('{"type":"pong","echo":42}', False)])
+
+    def test_invalid(self):
+        messages = [
+            ('{"type": "chat"', 'invalid json'),
+            ('[1, 2]', 'message is not an object'),
+            ('{"text": "hello"}', 'unknown message type'),
+            ('{"type": "foobar"}', 'unknown message type'),
+            ('{"type": ["chat"]}', 'unknown message type'),
+            ('{"type": "chat", "text": "%s"}' % ('x' * 70000), 'message too large'),
+            # 60000 characters but 180000 bytes
+            ('{"type": "chat", "text": "%s"}' % ('\u20ac' * 60000), 'message too large'),
+            ('[' * 30000, 'invalid json'),
+        ]
+        for data, reason in messages:
+            self.h.on_message(data)
+        self.assertEqual(self.h.received, [])
+        self.assertEqual([json.loads(m)['error'] for m, _ in self.h.sent], [reason for _, reason in messages])
+        self.assertEqual(router_stats, {'invalid': 8})
+
+    @skipIf(orjson is None, 'orjson not installed')
+    @patch.object(RouterHandler, 'codec', 'orjson')
+    def test_orjson_handler(self):
+        self.h.on_message(b'{"type": "ping"}')
+        self.assertEqual(self.h.sent, [(b'{"type":"pong","echo":null}', False)])
+
+
+class ChatHandler(MessageRouterMixin, AnonSocketHandler):
+    @message_handler('chat')
+    def on_chat(self, msg):
+        self.broadcast_message({'type': 'chat', 'text': msg['text']})
+
+
+class RouterWebSocketTest(AsyncHTTPTestCaseExtra, TestCase):
+    def get_app(self):
+        return get_app(False, [('/', ChatHandler)])
+
+    def test_chat(self):
+        test_case = self
+
+        class WSClient(WebSocketClient):
+            def on_open(self):
+                self.write_message('not json')
+                self.write_message('{"type": "chat", "text": "hello"}')
+                self.received = []
+
+            def on_message(self, data):
+                self.received.append(data)
+                if len(self.received) == 2:
+                    test_case.delayed_assertions.extend([
+                        (json.loads(self.received[0]), {'type': 'error', 'error': 'invalid json'}),
+                        (json.loads(self.received[1]), {'type': 'chat', 'text': 'hello'}),
+                    ])
+                    self.close()
+
+            def on_close(self, code=None, reason=None):
+                test_case.io_loop.add_callback(test_case.stop)
+
+        self.io_loop.add_callback(partial(WSClient, self.get_url('/ws/'), self.io_loop))
+        self.wait()
+        self.assertEqual(len(self.delayed_assertions), 2)
+        self.assertEqual(len(all_clients), 0)
+
+
+class NegotiationTestCase(SimpleTestCase):
+    def test_split_subprotocol(self):
+        self.assertEqual(split_subprotocol('anon'), (None, 'anon'))
+        self.assertEqual(split_subprotocol('msgpack+abc-1-ff'), ('msgpack', 'abc-1-ff'))
+        self.assertEqual(split_subprotocol('msgpack+c.abc.d-_'), ('msgpack', 'c.abc.d-_'))
+
+    @patch.dict(CODECS, {'bjson': BinaryJsonCodec})
+    def test_broadcast_mixed_codecs(self):
+        class Handler(MessageRouterMixin, MessageHandler):
+            negotiable_codecs = ('bjson',)
+
+        text, binary, plain = Handler(), Handler(), MessageHandler()
+        binary.codec = 'bjson'
+        clients = AllClients()
+        for h in (text, binary, plain):
+            clients.append(h)
+        with patch('django_websockets.router.all_clients', clients):
+            self.assertEqual(text.broadcast_message({'type': 'x'}), 3)
+            self.assertEqual(text.broadcast_message({'type': 'y'}, predicate=lambda h: h is not text), 2)
+        self.assertEqual(text.messages, ['{"type":"x"}'])
+        self.assertEqual(plain.messages, ['{"type":"x"}', '{"type":"y"}'])
+        self.assertEqual(binary.messages, ['{"type":"x"}', '{"type":"y"}'])
+        self.assertEqual([f[0] for f in binary.ws_connection.frames], [0x82, 0x82])
+        self.assertEqual([f[0] for f in plain.ws_connection.frames], [0x81, 0x81])
+
+    @patch.dict(CODECS, {'bjson': BinaryJsonCodec})
+    def test_broadcast_published(self):
+        class Handler(MessageRouterMixin, MessageHandler):
+            negotiable_codecs = ('bjson',)
+
+        sender = Handler()
+        clients1, clients2 = AllClients(), AllClients()
+        clients1.backplane = InProcessBackplane(clients1, bus='codecs')
+        clients2.backplane = InProcessBackplane(clients2, bus='codecs')
+        text, binary, plain = Handler(), Handler(), MessageHandler()
+        binary.codec = 'bjson'
+        for h in (text, binary, plain):
+            clients2.append(h)
+        try:
+            with patch('django_websockets.router.all_clients', clients1):
+                self.assertEqual(sender.broadcast_message({'type': 'x'}), 0)
+            clients1.backplane._flush()
+        finally:
+            clients1.backplane.close()
+            clients2.backplane.close()
+        self.assertEqual((text.messages, plain.messages, binary.messages), (['{"type":"x"}'],) * 3)
+        self.assertEqual([f[0] for f in binary.ws_connection.frames], [0x82])
+        self.assertEqual([f[0] for f in plain.ws_connection.frames], [0x81])
+        self.assertEqual(clients1.backplane.published, 2)
+        clients2.remove(binary)
+        self.assertEqual(clients2._codecs, {'json': {text: None}})
+
+
+class BinaryChatHandler(ChatHandler):
+    negotiable_codecs = ('bjson',)
+
+    @message_handler('echo')
+    def on_echo(self, msg):
+        return msg
+
+
+class AuthBinaryChatHandler(MessageRouterMixin, AuthSocketHandler):
+    negotiable_codecs = ('bjson',)
+
+    @message_handler('whoami')
+    def on_whoami(self, msg):
+        return {'type': 'user', 'username': self.user.username}
+
+
+@patch.dict(CODECS, {'bjson': BinaryJsonCodec})
+class BinaryModeWebSocketTest(AsyncHTTPTestCaseExtra, TransactionTestCase):
+    def get_app(self):
+        return get_app(False, [('/anon/', BinaryChatHandler), ('/auth/', AuthBinaryChatHandler)])
+
+    def connect(self, path, subprotocols):
+        url = self.get_url('/ws/%s/' % path).replace('http', 'ws')
+        return websocket_connect(HTTPRequest(url, headers={'Sec-WebSocket-Protocol': subprotocols}))
+
+    @gen_test
+    def test_binary_mode(self):
+        BinaryJsonCodec.decoded = []
+        conn = yield self.connect('anon', 'bjson+anon, anon')
+        self.assertEqual(conn.headers['Sec-WebSocket-Protocol'], 'bjson+anon')
+        conn.write_message(b'{"type": "echo", "n": 1}', binary=True)
+        msg = yield conn.read_message()
+        self.assertEqual(msg, b'{"type":"echo","n":1}')
+        self.assertIsInstance(BinaryJsonCodec.decoded[0], memoryview)
+        yield close_connection(conn)
+
+    @gen_test
+    def test_text_fallback(self):
+        with patch.object(BinaryChatHandler, 'negotiable_codecs', ()):
+            conn = yield self.connect('anon', 'bjson+anon, anon')
+        self.assertEqual(conn.headers['Sec-WebSocket-Protocol'], 'anon')
+        conn.write_message('{"type": "echo"}')
+        msg = yield conn.read_message()
+        self.assertEqual(msg, '{"type":"echo"}')
+        yield close_connection(conn)
+
+    @gen_test
+    def test_auth_binary_mode(self):
+        user = User.objects.create_user('testing', email='testing@example.com')
+        token = make_token(user, '127.0.0.1')
+        conn = yield self.connect('auth', 'bjson+%s, %s' % (token, token))
+        self.assertEqual(conn.headers['Sec-WebSocket-Protocol'], 'bjson+' + token)
+        conn.write_message(b'{"type": "whoami"}', binary=True)
+        msg = yield conn.read_message()
+        self.assertEqual(msg, b'{"type":"user","username":"testing"}')
+        yield close_connection(conn)
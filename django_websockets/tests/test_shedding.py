@@ -0,0 +1,101 @@
+from functools import partial
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, TestCase
+
+from django_websockets.app import get_app
+from django_websockets.handlers import AnonSocketHandler, all_clients
+from django_websockets.metrics import handshakes_rejected
+from django_websockets.shedding import LoadShedder
+from .utils import AsyncHTTPTestCaseExtra, FakeHandler, WebSocketClient
+
+
+class FakeMonitor(object):
+    lag = None
+
+
+class LoadShedderTestCase(SimpleTestCase):
+    def test_no_limits(self):
+        shedder = LoadShedder(clients=[FakeHandler()] * 10, check_interval=0)
+        self.assertEqual(shedder.loads(), {})
+        self.assertFalse(shedder.check())
+
+    def test_connections_hysteresis(self):
+        clients = [FakeHandler()] * 10
+        shedder = LoadShedder(clients=clients, max_connections=10, resume_ratio=0.5, check_interval=0)
+        self.assertFalse(shedder.check())
+        clients.append(FakeHandler())
+        self.assertTrue(shedder.check())
+        # below the limit but not far enough below to resume
+        del clients[8:]
+        self.assertEqual(shedder.loads(), {'connections': 8})
+        self.assertTrue(shedder.check())
+        del clients[5:]
+        self.assertFalse(shedder.check())
+
+    def test_check_interval(self):
+        clients = [FakeHandler()] * 3
+        shedder = LoadShedder(clients=clients, max_connections=2, check_interval=60)
+        self.assertTrue(shedder.check())
+        clients.clear()
+        self.assertTrue(shedder.check())
+        shedder._checked -= 60
+        self.assertFalse(shedder.check())
+
+    @patch.dict('django_websockets.shedding.outbound_bytes', {'queued': 100, 'buffered': 1050}, clear=True)
+    def test_outbound_bytes(self):
+        shedder = LoadShedder(clients=[FakeHandler()] * 3, max_outbound_bytes=1000, check_interval=0)
+        self.assertEqual(shedder.loads(), {'outbound_bytes': 1150})
+        self.assertTrue(shedder.check())
+
+    def test_loop_lag(self):
+        monitor = FakeMonitor()
+        shedder = LoadShedder(clients=[], max_loop_lag=100, check_interval=0)
+        with patch('django_websockets.shedding.start_loop_lag_monitor', return_value=monitor):
+            self.assertEqual(shedder.loads(), {'loop_lag': 0})
+            monitor.lag = 0.2
+            self.assertTrue(shedder.check())
+            monitor.lag = 0.05
+            self.assertFalse(shedder.check())
+
+
+class SheddingWebSocketTest(AsyncHTTPTestCaseExtra, TestCase):
+    def get_app(self):
+        return get_app(False, [('/', AnonSocketHandler)])
+
+    def setUp(self):
+        super(SheddingWebSocketTest, self).setUp()
+        shedder = LoadShedder(clients=[FakeHandler()], max_connections=0)
+        patcher = patch('django_websockets.handlers.load_shedder', shedder)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_http_503(self):
+        rejected = handshakes_rejected[503]
+        response = self.fetch('/ws/')
+        self.assertEqual(response.code, 503)
+        self.assertEqual(response.headers['Retry-After'], '5')
+        self.assertEqual(handshakes_rejected[503], rejected + 1)
+
+    def test_close_1013(self):
+        rejected = handshakes_rejected[1013]
+        test_case = self
+
+        class WSClient(WebSocketClient):
+            def on_open(self):
+                test_case.delayed_assertions.append(('opened', 'opened'))
+
+            def on_close(self, code=None, reason=None):
+                test_case.io_loop.add_callback(test_case.stop)
+
+        with patch.object(AnonSocketHandler, 'shed_mode', 'close'):
+            self.io_loop.add_callback(partial(WSClient, self.get_url('/ws/'), self.io_loop))
+            self.wait()
+        self.assertEqual(handshakes_rejected[1013], rejected + 1)
+        self.assertEqual(len(all_clients), 0)
+
+    def test_shed_load_false(self):
+        with patch.object(AnonSocketHandler, 'shed_load', False):
+            response = self.fetch('/ws/')
+        # not refused, tornado rejects it since it's not a websocket request
+        self.assertEqual(response.code, 400)
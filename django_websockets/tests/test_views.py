@@ -1,10 +1,14 @@
 import re
+from unittest.mock import patch
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.test import TestCase, RequestFactory
 from django.conf.urls import url
 from django.http import HttpResponse
 from django.template import Template, RequestContext
 
+from django_websockets.templatetags.websockets import get_ws_url
+from django_websockets.tokens import issued_token_cache, make_token
+
 
 def simple_view(request):
     t = Template('{% load websockets %}{% websocket_info %}')
@@ -36,3 +40,40 @@ class ViewsTestCase(TestCase):
         self.assertEqual(content, '<script>\n'
                                   '  var djws = {"token": "xyz", "ws_url": "ws://testserver/ws/"};\n'
                                   '</script>\n')
+
+    def _login_render_tokens(self, renders):
+        user = User.objects.create_user('testing', email='testing@example.com', password='testing')
+        self.client.login(username='testing', password='testing')
+        tokens = []
+        with patch('django_websockets.tokens.make_token', wraps=make_token) as mock_make_token:
+            for _ in range(renders):
+                r = self.client.get('/simple_view/')
+                tokens.append(re.search('"token": "(.*?)"', r.content.decode('utf-8')).group(1))
+        return user, tokens, mock_make_token.call_count
+
+    def test_token_reused(self):
+        issued_token_cache.clear()
+        user, tokens, make_token_calls = self._login_render_tokens(3)
+        self.assertEqual(make_token_calls, 1)
+        self.assertEqual(len(set(tokens)), 1)
+
+        # saving the user (eg. changing their password) means a new token is created
+        user.save()
+        self.assertEqual(len(issued_token_cache), 0)
+
+    @patch('django_websockets.settings.WS_TOKEN_REUSE_SECONDS', 0)
+    def test_token_not_reused(self):
+        user, tokens, make_token_calls = self._login_render_tokens(2)
+        self.assertEqual(make_token_calls, 2)
+
+
+class WsUrlTestCase(TestCase):
+    def test_get_ws_url(self):
+        request = RequestFactory().get('/')
+        self.assertEqual(get_ws_url(request, ''), 'ws://testserver/ws/')
+        self.assertEqual(get_ws_url(request, '/foo/'), 'ws://testserver/ws/foo/')
+
+    @patch('django_websockets.settings.WS_PORT', 8001)
+    def test_get_ws_url_port(self):
+        request = RequestFactory().get('/', HTTP_HOST='example.com:8000', secure=True)
+        self.assertEqual(get_ws_url(request, 'foo'), 'wss://example.com:8001/ws/foo/')
@@ -0,0 +1,60 @@
+import threading
+import time
+from unittest.mock import patch
+
+from django.test import SimpleTestCase
+from tornado.testing import AsyncTestCase
+
+from django_websockets.metrics import loop_lag
+from django_websockets.watchdog import LoopWatchdog, watchdog_stats
+
+
+class LoopWatchdogTestCase(SimpleTestCase):
+    def setUp(self):
+        self.watchdog = LoopWatchdog(threshold=0.1, log_interval=10)
+        self.watchdog.loop_thread_id = threading.get_ident()
+
+    def test_not_blocked(self):
+        self.watchdog.last_beat = time.monotonic()
+        self.assertFalse(self.watchdog.check())
+
+    def test_blocked(self):
+        before = watchdog_stats.copy()
+        self.watchdog.last_beat = time.monotonic() - 1
+        with patch('django_websockets.watchdog.logger') as logger:
+            self.assertTrue(self.watchdog.check())
+        self.assertEqual(logger.warning.call_count, 1)
+        msg = logger.warning.call_args[0][0] % logger.warning.call_args[0][1:]
+        self.assertTrue(msg.startswith('IOLoop blocked for'))
+        # the stack of the "loop" thread, in this case the test
+        self.assertIn('in test_blocked', msg)
+
+        # the same block isn't counted twice
+        self.assertTrue(self.watchdog.check())
+        # a new block within log_interval isn't logged
+        self.watchdog.last_beat = time.monotonic() - 2
+        self.assertTrue(self.watchdog.check())
+        self.assertEqual(watchdog_stats['blocked'], before['blocked'] + 2)
+        self.assertEqual(watchdog_stats['logged'], before['logged'] + 1)
+        self.assertEqual(watchdog_stats['suppressed'], before['suppressed'] + 1)
+
+
+class WatchdogLoopTestCase(AsyncTestCase):
+    def test_blocking_callback(self):
+        watchdog = LoopWatchdog(threshold=0.05, log_interval=0)
+        blocked = watchdog_stats['blocked']
+        lag_samples = loop_lag.snapshot().count
+
+        def blocking_callback():
+            time.sleep(0.3)
+            self.stop()
+
+        with patch('django_websockets.watchdog.logger') as logger:
+            watchdog.start(self.io_loop)
+            self.io_loop.add_timeout(self.io_loop.time() + 0.05, blocking_callback)
+            self.wait()
+            watchdog.stop()
+        self.assertEqual(watchdog_stats['blocked'], blocked + 1)
+        # the watchdog's beats aren't recorded as loop lag
+        self.assertEqual(loop_lag.snapshot().count, lag_samples)
+        self.assertIn('in blocking_callback', logger.warning.call_args[0][3])
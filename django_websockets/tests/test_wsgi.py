@@ -0,0 +1,75 @@
+import threading
+
+from django.test import TestCase
+from tornado.testing import AsyncHTTPTestCase
+from tornado.web import Application, FallbackHandler
+
+from django_websockets.app import get_app
+from django_websockets.wsgi import ThreadPoolWSGIContainer
+
+
+class DjangoThreadPoolTestCase(AsyncHTTPTestCase, TestCase):
+    def get_app(self):
+        return get_app(True, [])
+
+    def test_django_view(self):
+        r = self.fetch('/simple_view/')
+        self.assertEqual(r.code, 200)
+        self.assertEqual(r.body.decode(), '<script>\n'
+                                          '  var djws = {"token": "anon", "ws_url": "ws://localhost:%d/ws/"};\n'
+                                          '</script>\n' % self.get_http_port())
+
+    def test_container_used(self):
+        fallback = self._app.handlers[0][1][-1].kwargs['fallback']
+        self.assertIsInstance(fallback, ThreadPoolWSGIContainer)
+        self.assertEqual(fallback.max_workers, 10)
+
+
+class BlockingApp(object):
+    def __init__(self):
+        self.release = threading.Event()
+
+    def __call__(self, environ, start_response):
+        if environ['PATH_INFO'] == '/error/':
+            raise RuntimeError('intentional test exception')
+        self.release.wait(5)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'hello']
+
+
+class ThreadPoolContainerTestCase(AsyncHTTPTestCase):
+    def get_app(self):
+        self.wsgi_app = BlockingApp()
+        self.container = ThreadPoolWSGIContainer(self.wsgi_app, max_workers=1, max_queue=1)
+        return Application([('.*', FallbackHandler, {'fallback': self.container})])
+
+    def tearDown(self):
+        self.wsgi_app.release.set()
+        super(ThreadPoolContainerTestCase, self).tearDown()
+
+    def test_queue_full(self):
+        responses = []
+
+        def on_response(response):
+            responses.append(response)
+            # the first request blocks the only thread, the second is queued and the third refused,
+            # once the third has been refused let the app return
+            self.wsgi_app.release.set()
+            if len(responses) == 3:
+                self.stop()
+
+        for _ in range(3):
+            self.http_client.fetch(self.get_url('/'), on_response)
+        self.wait()
+        self.assertEqual(sorted(r.code for r in responses), [200, 200, 503])
+        refused = [r for r in responses if r.code == 503][0]
+        self.assertEqual(refused.headers['Retry-After'], '1')
+        self.assertEqual(self.container.rejected, 1)
+        self.assertEqual(self.container.requests, 2)
+        self.assertEqual(self.container.pending, 0)
+        self.assertGreater(self.container.queue_wait_max, 0)
+
+    def test_error(self):
+        r = self.fetch('/error/')
+        self.assertEqual(r.code, 500)
+        self.assertEqual(self.container.errors, 1)
@@ -43,6 +43,34 @@ class AsyncHTTPTestCaseExtra(AsyncHTTPTestCase):  # pragma: no cover
             self.assertEqual(*args)
 
 
+class FakeHandler(object):  # pragma: no cover
+    def __init__(self, user=None):
+        self.user = user
+
+
+class FakeConnection(object):  # pragma: no cover
+    def __init__(self):
+        self.messages = []
+        self.frames = []
+
+    def stateless_compressor(self, data):
+        return None
+
+    def write_prepared(self, opcode, data, frame):
+        self.messages.append(data.decode())
+        self.frames.append(frame)
+
+
+class MessageHandler(FakeHandler):  # pragma: no cover
+    def __init__(self, user=None):
+        super(MessageHandler, self).__init__(user)
+        self.ws_connection = FakeConnection()
+
+    @property
+    def messages(self):
+        return self.ws_connection.messages
+
+
 class CaptureStd(object):  # pragma: no cover
     _captured = ''
 
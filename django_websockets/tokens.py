@@ -4,85 +4,427 @@ Modified copy of django/contrib/auth/tokens.py
 The slightly weird singleton setup has been removed and the
 logic has been modified to be suitable for websocket tokens.
 """
+import hashlib
+import hmac
+import json
 import logging
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from collections import Counter, namedtuple
 from datetime import datetime
+from operator import itemgetter
+from django.conf import settings as django_settings
+from django.core.cache import caches
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
-from django.utils.crypto import salted_hmac, constant_time_compare
+from django.utils.crypto import constant_time_compare
+from django.utils.encoding import force_bytes
 from django.utils.http import int_to_base36, base36_to_int
 from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+from .cache import TTLCache
 from . import settings
 
 logger = logging.getLogger(settings.WS_LOGGER_NAME)
 
 User = get_user_model()
 
+KEY_SALT = 'WebSocketTokenGenerator'
+CLAIMS_KEY_SALT = 'WebSocketClaimsTokenGenerator'
+# claims tokens start with this, "hash" tokens never contain a "."
+CLAIMS_PREFIX = 'c.'
+TOKEN_FORMATS = ('hash', 'claims')
+# keys of claims in claims tokens, see make_claims_token
+CLAIMS = frozenset(('id', 'u', 'a', 'st', 'su', 'g', 'ts', 'e', 'k'))
 
-def make_token(user, ip_address):
+# largest user id a token can refer to, larger ids can't be primary keys and make some database drivers raise
+# errors rather than find no user
+MAX_USER_ID = 2 ** 63 - 1
+
+# result of precheck_token, expires_in is the number of seconds until the token expires
+ParsedToken = namedtuple('ParsedToken', ['ts', 'user_id', 'expires_in'])
+
+# the first item of every token cache key is the user id, entries are grouped by it so a user's entries can be
+# removed when they're saved, see _invalidate_user_tokens
+_user_id = itemgetter(0)
+
+# validated tokens keyed by (user id, token, ip address), see check_token_get_user
+token_cache = TTLCache(settings.WS_TOKEN_CACHE_SIZE, settings.WS_TOKEN_CACHE_TTL, group=_user_id)
+
+# tokens recently rejected after loading the user, same keys as token_cache, saves repeating the database query
+# for clients which keep reconnecting with a bad token
+rejected_token_cache = TTLCache(settings.WS_TOKEN_CACHE_SIZE, settings.WS_TOKEN_CACHE_TTL, group=_user_id)
+
+# number of tokens rejected at each stage: "format", "expired", "rejected_cache", "user", "signature" and
+# for claims tokens "epoch" and "revoked"
+rejected_tokens = Counter()
+
+# tokens created by get_or_make_token keyed by (user id, ip address, token format, time bucket)
+issued_token_cache = TTLCache(settings.WS_TOKEN_CACHE_SIZE, settings.WS_TOKEN_REUSE_SECONDS, group=_user_id)
+
+# key salt -> (SECRET_KEY, hmac object) see _token_hmac
+_hmac_bases = {}
+
+
+def make_token(user, ip_address, token_format=None):
     """
     Returns a token that can be used once to do a password reset
     for the given user.
     :param: use to generate token for
     :param: ip_address of user's client
+    :param: token_format "hash" or "claims", defaults to settings.WS_TOKEN_FORMAT, see make_claims_token
     :return: new token
     """
-    logger.debug('generating token for user %d, ip address: %s' % (user.id, ip_address))
+    token_format = token_format or settings.WS_TOKEN_FORMAT
+    logger.debug('generating %s token for user %d, ip address: %s', token_format, user.id, ip_address)
+    if token_format == 'claims':
+        return make_claims_token(user, ip_address)
+    elif token_format != 'hash':
+        raise ValueError('invalid token format %r, should be one of %s' % (token_format, ', '.join(TOKEN_FORMATS)))
     return _make_token_with_timestamp(user, ip_address, _secs_since_2015())
 
 
+def get_or_make_token(user, ip_address):
+    """
+    Like make_token but tokens are reused for up to settings.WS_TOKEN_REUSE_SECONDS, so rendering many pages
+    (or one page several times) for the same user doesn't create a new token each time. Reused tokens are always
+    valid for at least TOKEN_VALIDITY_SECONDS - WS_TOKEN_REUSE_SECONDS.
+    :param: user to generate token for
+    :param: ip_address of user's client
+    :return: token
+    """
+    reuse = settings.WS_TOKEN_REUSE_SECONDS
+    if not reuse:
+        return make_token(user, ip_address)
+    key = user.pk, ip_address, settings.WS_TOKEN_FORMAT, _secs_since_2015() // reuse
+    token = issued_token_cache.get(key)
+    if token is None:
+        token = make_token(user, ip_address)
+        issued_token_cache.set(key, token)
+    return token
+
+
+def make_claims_token(user, ip_address):
+    """
+    Create a token containing signed claims about the user: id, username, is_active, is_staff, is_superuser,
+    group names, the time it was created, settings.WS_TOKEN_EPOCH and a digest of the user's password,
+    ws_auth_key_salt and is_active. These tokens are checked without accessing the database, the handler's user
+    is a ClaimsUser.
+
+    Claims tokens are invalidated by expiring, by changing WS_TOKEN_EPOCH (which invalidates all claims tokens)
+    or, like "hash" tokens, by changing the user's password, ws_auth_key_salt or is_active, see
+    settings.WS_TOKEN_REVOCATION_CACHE.
+
+    :param: user to generate token for
+    :param: ip_address of user's client, the token is only valid for this ip address
+    :return: new token, containing only characters valid in a websocket subprotocol
+    """
+    claims = {
+        'id': user.pk,
+        'u': user.get_username(),
+        'a': user.is_active,
+        'st': user.is_staff,
+        'su': user.is_superuser,
+        'g': sorted(user.groups.values_list('name', flat=True)),
+        'ts': _secs_since_2015(),
+        'e': settings.WS_TOKEN_EPOCH,
+        'k': _user_key(user),
+    }
+    payload = _b64encode(json.dumps(claims, separators=(',', ':')).encode())
+    return CLAIMS_PREFIX + payload + '.' + _claims_signature(payload, ip_address)
+
+
 def check_token_get_user(token, ip_address):
     """
     Check that a websocket token is valid for a given ip_address.
 
+    Checks are made cheapest first so invalid tokens are usually rejected without a database query, see
+    precheck_token. Valid tokens are cached (see token_cache) so reconnecting clients don't repeat the database
+    query and hmac, cached tokens still expire at the right time.
+
+    See auth.check_token_get_user_async for the version used by handlers.
+
     :param: token to check
     :param: ip_address of client
     :return: user instance or False if invalid token
     """
-    # Parse the token
+    result = precheck_token(token, ip_address)
+    if isinstance(result, ClaimsUser):
+        return check_claims_user(result, get_revocation_key(result.pk))
+    if not isinstance(result, ParsedToken):
+        return result
+
+    try:
+        user = User.objects.get(id=result.user_id)
+    except (ObjectDoesNotExist, MultipleObjectsReturned):
+        user = None
+    return check_user_token(user, token, ip_address, result)
+
+
+def precheck_token(token, ip_address):
+    """
+    Checks which don't need the user: parse the token, check it hasn't expired, then check the caches of
+    rejected and validated tokens.
+
+    :param: token to check
+    :param: ip_address of client
+    :return: False if the token is invalid, the user if the token is cached as valid, a ClaimsUser to be passed to
+        check_claims_user if it's a valid claims token, otherwise the ParsedToken to be passed to check_user_token
+        once the user is loaded.
+    """
+    if token.startswith(CLAIMS_PREFIX):
+        return check_claims_token(token, ip_address)
+
     try:
         ts_b36, uid_b36, hash = token.split('-')
     except ValueError:
-        logger.debug('invalid token, value error splitting token')
-        return False
+        return _reject('format', 'invalid token, value error splitting token')
 
     try:
         ts = base36_to_int(ts_b36)
         user_id = base36_to_int(uid_b36)
     except ValueError:
-        logger.debug('invalid token, value error changing base')
-        return False
+        return _reject('format', 'invalid token, value error changing base')
+    if user_id > MAX_USER_ID:
+        return _reject('format', 'invalid token, user id out of range')
 
-    try:
-        user = User.objects.get(id=user_id)
-    except (ObjectDoesNotExist, MultipleObjectsReturned):
-        logger.debug('invalid token, unable to get user')
-        return False
+    expires_in = ts + settings.TOKEN_VALIDITY_SECONDS - _secs_since_2015()
+    if expires_in < 0:
+        return _reject('expired', 'invalid token, token expired')
+
+    cache_key = user_id, token, ip_address
+    if rejected_token_cache.get(cache_key):
+        return _reject('rejected_cache', 'invalid token, recently rejected')
+
+    user = token_cache.get(cache_key)
+    if user is not None:
+        return user
+    return ParsedToken(ts, user_id, expires_in)
+
+
+def check_user_token(user, token, ip_address, parsed):
+    """
+    Check a parsed token was generated for this user and ip address. Valid tokens are added to token_cache,
+    invalid ones to rejected_token_cache.
+
+    :param: user the token's user id refers to, None if no such user exists
+    :param: token to check
+    :param: ip_address of client
+    :param: parsed result of precheck_token(token, ip_address)
+    :return: user instance or False if invalid token
+    """
+    cache_key = parsed.user_id, token, ip_address
+    if user is None:
+        rejected_token_cache.set(cache_key, True)
+        return _reject('user', 'invalid token, unable to get user')
 
     # Check that the timestamp/token has not been tampered with
-    if not constant_time_compare(_make_token_with_timestamp(user, ip_address, ts), token):
-        logger.debug('invalid token, token not valid')
-        return False
+    if not constant_time_compare(_make_token_with_timestamp(user, ip_address, parsed.ts), token):
+        rejected_token_cache.set(cache_key, True)
+        return _reject('signature', 'invalid token, token not valid')
 
-    # Check the timestamp is within limit
-    if (_secs_since_2015() - ts) > settings.TOKEN_VALIDITY_SECONDS:
-        logger.debug('invalid token, token expired')
-        return False
+    token_cache.set(cache_key, user, parsed.expires_in)
     return user
 
 
+def check_claims_token(token, ip_address):
+    """
+    Check a token created by make_claims_token, the database isn't accessed. Revocation isn't checked here since
+    it needs the revocation cache, see check_claims_user.
+
+    :param: token to check
+    :param: ip_address of client
+    :return: ClaimsUser or False if the token is invalid
+    """
+    try:
+        payload, signature = token[len(CLAIMS_PREFIX):].split('.')
+    except ValueError:
+        return _reject('format', 'invalid claims token, value error splitting token')
+
+    if not constant_time_compare(_claims_signature(payload, ip_address), signature):
+        return _reject('signature', 'invalid claims token, token not valid')
+
+    try:
+        claims = json.loads(_b64decode(payload).decode())
+    except (BinasciiError, ValueError):
+        return _reject('format', 'invalid claims token, unable to decode claims')
+    if not CLAIMS.issubset(claims):
+        # eg. tokens made by an older version
+        return _reject('format', 'invalid claims token, claims missing')
+
+    if claims['ts'] + settings.TOKEN_VALIDITY_SECONDS - _secs_since_2015() < 0:
+        return _reject('expired', 'invalid claims token, token expired')
+
+    if claims['e'] != settings.WS_TOKEN_EPOCH:
+        return _reject('epoch', 'invalid claims token, epoch changed')
+
+    return ClaimsUser(claims)
+
+
+def get_revocation_key(user_id):
+    """
+    Get a user's current key from settings.WS_TOKEN_REVOCATION_CACHE, this may query a remote cache so
+    auth.check_token_get_user_async calls it in the auth thread pool.
+
+    :param: user_id of claims token
+    :return: the key or None if the cache is disabled or the user hasn't been saved recently
+    """
+    cache = _revocation_cache()
+    return None if cache is None else cache.get(_revocation_cache_key(user_id))
+
+
+def check_claims_user(user, revocation_key):
+    """
+    Check a claims token's user hasn't been changed or deleted since the token was made.
+
+    :param: user ClaimsUser returned by precheck_token
+    :param: revocation_key result of get_revocation_key(user.pk)
+    :return: user or False if the token has been revoked
+    """
+    if revocation_key is not None and revocation_key != user.user_key:
+        return _reject('revoked', 'invalid claims token, user changed')
+    return user
+
+
+class ClaimsUser(object):
+    """
+    User built from the claims in a token, id, pk, username, is_active, is_staff, is_superuser and group_names
+    are available without accessing the database. Accessing any other attribute loads the user from the database
+    (on the IOLoop, so avoid this in busy handlers), after which this behaves like the real user.
+    """
+    def __init__(self, claims):
+        self.pk = self.id = claims['id']
+        self.username = claims['u']
+        self.is_active = claims['a']
+        self.is_staff = claims['st']
+        self.is_superuser = claims['su']
+        self.group_names = frozenset(claims['g'])
+        self.user_key = claims['k']
+        self._user = None
+
+    def is_authenticated(self):
+        return True
+
+    def is_anonymous(self):
+        return False
+
+    def get_username(self):
+        return self.username
+
+    def get_user(self):
+        """
+        :return: the real user instance, loaded from the database the first time this is called
+        """
+        if self._user is None:
+            logger.debug('loading user %d for claims token', self.pk)
+            self._user = User.objects.get(pk=self.pk)
+        return self._user
+
+    def __getattr__(self, item):
+        if item.startswith('__'):
+            raise AttributeError(item)
+        return getattr(self.get_user(), item)
+
+    def __eq__(self, other):
+        return isinstance(other, (ClaimsUser, User)) and other.pk == self.pk
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.pk)
+
+    def __str__(self):
+        return self.username
+
+    def __repr__(self):
+        return '<ClaimsUser: %s>' % self.username
+
+
+def _reject(stage, msg):
+    rejected_tokens[stage] += 1
+    logger.debug(msg)
+    return False
+
+
+def _invalidate_user_tokens(sender, instance, **kwargs):
+    """
+    Remove a user's tokens from the token caches when they're saved or deleted, the password or
+    ws_auth_key_salt may have changed. The user's current key is stored in the revocation cache so claims
+    tokens made with a different one are rejected.
+    """
+    for cache in (token_cache, rejected_token_cache, issued_token_cache):
+        cache.discard_group(instance.pk)
+
+    cache = _revocation_cache()
+    if cache is not None:
+        # deleted users get a key no token can have
+        user_key = '' if kwargs['signal'] is post_delete else _user_key(instance)
+        # tokens made before the change have expired once this does
+        cache.set(_revocation_cache_key(instance.pk), user_key, settings.TOKEN_VALIDITY_SECONDS)
+
+
+post_save.connect(_invalidate_user_tokens, sender=User, dispatch_uid='ws_token_cache_save')
+post_delete.connect(_invalidate_user_tokens, sender=User, dispatch_uid='ws_token_cache_delete')
+
+
+def _revocation_cache():
+    alias = settings.WS_TOKEN_REVOCATION_CACHE
+    return caches[alias] if alias else None
+
+
+def _revocation_cache_key(user_id):
+    return 'djws-user-key-%s' % user_id
+
+
+def _user_key(user):
+    """
+    Digest of everything which should invalidate a user's claims tokens when changed, it's signed since claims
+    can be read by anyone with the token.
+    """
+    custom_key_salt = user.ws_auth_key_salt() if hasattr(user, 'ws_auth_key_salt') else ''
+    value = 'user-key:%s%s%s' % (user.password, custom_key_salt, user.is_active)
+    return _b64encode(_token_hmac(value, CLAIMS_KEY_SALT).digest()[:9])
+
+
 def _make_token_with_timestamp(user, ip_address, timestamp):
     ts_b36 = int_to_base36(timestamp)
     uid_b36 = int_to_base36(user.id)
 
-    key_salt = 'WebSocketTokenGenerator'
-
     # ws_auth_key_salt allows the user's ws token to be invalidated, it should return a string,
     # changing that string will invalidate the websocket token
     no_user_key_salt = lambda: ''
     custom_key_salt = getattr(user, 'ws_auth_key_salt', no_user_key_salt)()
 
     value = uid_b36 + user.password + str(ip_address) + str(custom_key_salt) + str(timestamp)
-    hash = salted_hmac(key_salt, value).hexdigest()
-    return '%s-%s-%s' % (ts_b36, uid_b36, hash)
+    return '%s-%s-%s' % (ts_b36, uid_b36, _token_hmac(value).hexdigest())
+
+
+def _claims_signature(payload, ip_address):
+    return _b64encode(_token_hmac(payload + str(ip_address), CLAIMS_KEY_SALT).digest())
+
+
+def _token_hmac(value, key_salt=KEY_SALT):
+    """
+    Equivalent to django.utils.crypto.salted_hmac(key_salt, value), but the key is only derived
+    (and the hmac initialised) once per SECRET_KEY rather than for every token.
+    """
+    secret = django_settings.SECRET_KEY
+    base = _hmac_bases.get(key_salt)
+    if base is None or base[0] != secret:
+        key = hashlib.sha1((key_salt + secret).encode()).digest()
+        base = _hmac_bases[key_salt] = secret, hmac.new(key, digestmod=hashlib.sha1)
+    h = base[1].copy()
+    h.update(force_bytes(value))
+    return h
+
+
+def _b64encode(b):
+    # url safe base64 without padding, "=" isn't allowed in subprotocols
+    return urlsafe_b64encode(b).decode().rstrip('=')
+
+
+def _b64decode(s):
+    return urlsafe_b64decode(s + '=' * (-len(s) % 4))
 
 
 def _secs_since_2015():
@@ -0,0 +1,132 @@
+"""
+Watchdog which detects callbacks blocking the IOLoop and logs what the loop thread was doing.
+
+The IOLoop records a beat every few hundred milliseconds (independently of metrics.LoopLagMonitor which exports
+the lag), a sidecar thread checks the beats and when the loop hasn't beaten for more than threshold seconds it captures
+the loop thread's stack with sys._current_frames, so the log shows the code which was blocking.
+"""
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+from tornado.ioloop import IOLoop
+
+from . import settings
+
+logger = logging.getLogger(settings.WS_LOGGER_NAME)
+
+# "blocked": times the loop was found blocked, "logged": stacks logged, "suppressed": stacks not logged
+# because of the rate limit
+watchdog_stats = Counter()
+
+_watchdog = None
+
+
+def start_watchdog(io_loop=None):
+    """
+    Start the process's watchdog, must be called in the process which runs the loop (eg. after forking).
+    :param io_loop: loop to watch, defaults to the current IOLoop
+    :return: LoopWatchdog
+    """
+    global _watchdog
+    if _watchdog is not None:
+        _watchdog.stop()
+    _watchdog = LoopWatchdog()
+    _watchdog.start(io_loop)
+    return _watchdog
+
+
+class _BeatTimer(object):
+    """
+    Sets the watchdog's last_beat from a callback run every interval seconds. This doesn't record into
+    metrics.loop_lag so the exported lag comes from one monitor at one interval.
+    """
+    def __init__(self, interval, watchdog):
+        self.interval = interval
+        self.watchdog = watchdog
+        self.io_loop = None
+        self._timeout = None
+
+    def start(self, io_loop):
+        self.stop()
+        self.io_loop = io_loop
+        self._schedule()
+
+    def stop(self):
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+
+    def _schedule(self):
+        self._timeout = self.io_loop.add_timeout(self.io_loop.time() + self.interval, self._beat)
+
+    def _beat(self):
+        self.watchdog.last_beat = time.monotonic()
+        self._schedule()
+
+
+class LoopWatchdog(object):
+    """
+    Logs the stack of the loop thread when the loop is blocked for more than threshold seconds, at most one
+    stack is logged every log_interval seconds.
+    """
+    def __init__(self, threshold=None, log_interval=None):
+        self.threshold = threshold or settings.WS_WATCHDOG_THRESHOLD
+        self.log_interval = settings.WS_WATCHDOG_LOG_INTERVAL if log_interval is None else log_interval
+        # the loop beats at least twice per threshold so a blocked loop is noticed promptly
+        self.beat_interval = min(settings.WS_LOOP_LAG_INTERVAL, self.threshold / 2)
+        self.last_beat = None
+        self.loop_thread_id = None
+        self._timer = _BeatTimer(self.beat_interval, self)
+        self._stop = threading.Event()
+        self._thread = None
+        self._reported_beat = None
+        self._last_log = None
+
+    def start(self, io_loop=None):
+        """
+        :param io_loop: loop to watch, it's assumed the loop is (or will be) run in the current thread
+        """
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self._timer.start(io_loop or IOLoop.current())
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='djws-watchdog', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._timer.stop()
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.threshold / 4):
+            self.check()
+
+    def check(self):
+        """
+        Called periodically from the sidecar thread, capture the loop thread's stack if it's blocked.
+        :return: True if the loop is blocked
+        """
+        last_beat = self.last_beat
+        blocked_for = time.monotonic() - last_beat - self.beat_interval
+        if blocked_for < self.threshold:
+            return False
+        if self._reported_beat == last_beat:
+            # already reported this block
+            return True
+        self._reported_beat = last_beat
+        watchdog_stats['blocked'] += 1
+        now = time.monotonic()
+        if self._last_log is not None and now - self._last_log < self.log_interval:
+            watchdog_stats['suppressed'] += 1
+            return True
+        self._last_log = now
+        watchdog_stats['logged'] += 1
+        frame = sys._current_frames().get(self.loop_thread_id)
+        stack = ''.join(traceback.format_stack(frame)) if frame is not None else 'loop thread not found\n'
+        logger.warning('IOLoop blocked for %0.3fs, loop thread stack (%d blocks not logged):\n%s',
+                       blocked_for, watchdog_stats['suppressed'], stack)
+        return True
@@ -0,0 +1,114 @@
+"""
+WSGI container which runs django (or any wsgi application) in a thread pool so slow views and queries
+don't block the IOLoop and therefore every websocket served by the process.
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import tornado
+import tornado.wsgi
+from tornado import escape
+from tornado.ioloop import IOLoop
+
+from . import settings
+
+logger = logging.getLogger(settings.WS_LOGGER_NAME)
+
+
+class ThreadPoolWSGIContainer(tornado.wsgi.WSGIContainer):
+    """
+    Child of tornado.wsgi.WSGIContainer which calls the wsgi application in a thread pool and writes the
+    response back on the IOLoop.
+
+    At most max_queue requests may be waiting for a free thread, further requests are refused with
+    a 503 response.
+    """
+    def __init__(self, wsgi_application, max_workers=None, max_queue=None):
+        super(ThreadPoolWSGIContainer, self).__init__(wsgi_application)
+        self.max_workers = max_workers or settings.WS_WSGI_THREADS
+        self.max_queue = settings.WS_WSGI_MAX_QUEUE if max_queue is None else max_queue
+        self.executor = ThreadPoolExecutor(self.max_workers)
+        # requests submitted to the executor which haven't finished yet, includes those running
+        self.pending = 0
+        self.requests = 0
+        self.rejected = 0
+        self.errors = 0
+        # time requests spent waiting for a free thread in seconds
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+
+    @property
+    def queued(self):
+        return max(self.pending - self.max_workers, 0)
+
+    def __call__(self, request):
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            logger.warning('wsgi queue full, %d requests queued, refusing request', self.queued)
+            self._write(request, '503 Service Unavailable', [('Retry-After', '1')], b'Service Unavailable')
+            return
+        self.pending += 1
+        environ = self.environ(request)
+        future = self.executor.submit(self._call_app, environ, time.time())
+        IOLoop.current().add_future(future, partial(self._on_response, request))
+
+    def _call_app(self, environ, submitted):
+        """
+        Called in a worker thread, returns the time the request waited for a thread and the response.
+        """
+        queue_wait = time.time() - submitted
+        data = {}
+        response = []
+
+        def start_response(status, response_headers, exc_info=None):
+            data['status'] = status
+            data['headers'] = response_headers
+            return response.append
+        app_response = self.wsgi_application(environ, start_response)
+        try:
+            response.extend(app_response)
+            body = b''.join(response)
+        finally:
+            if hasattr(app_response, 'close'):
+                app_response.close()
+        if not data:
+            raise Exception('WSGI app did not call start_response')
+        return queue_wait, data['status'], data['headers'], body
+
+    def _on_response(self, request, future):
+        self.pending -= 1
+        self.requests += 1
+        try:
+            queue_wait, status, headers, body = future.result()
+        except Exception:
+            self.errors += 1
+            logger.exception('Uncaught exception in wsgi application %s', request.path)
+            self._write(request, '500 Internal Server Error', [], b'Internal Server Error')
+            return
+        self.queue_wait_total += queue_wait
+        self.queue_wait_max = max(self.queue_wait_max, queue_wait)
+        self._write(request, status, headers, body)
+
+    def _write(self, request, status, headers, body):
+        # this is the second half of tornado.wsgi.WSGIContainer.__call__
+        status_code = int(status.split()[0])
+        header_set = set(k.lower() for (k, v) in headers)
+        body = escape.utf8(body)
+        if status_code != 304:
+            if 'content-length' not in header_set:
+                headers.append(('Content-Length', str(len(body))))
+            if 'content-type' not in header_set:
+                headers.append(('Content-Type', 'text/html; charset=UTF-8'))
+        if 'server' not in header_set:
+            headers.append(('Server', 'TornadoServer/%s' % tornado.version))
+
+        parts = [escape.utf8('HTTP/1.1 ' + status + '\r\n')]
+        for key, value in headers:
+            parts.append(escape.utf8(key) + b': ' + escape.utf8(value) + b'\r\n')
+        parts.append(b'\r\n')
+        parts.append(body)
+        request.write(b''.join(parts))
+        request.finish()
+        self._log(status_code, request)